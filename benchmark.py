@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks do armazenamento do bot
+
+Uso:
+    python benchmark.py storage --sizes 10000,100000,1000000
+    python benchmark.py memory --orders 100000
+    python benchmark.py durability --orders 2000 --threads 8
+    python benchmark.py startup --sizes 10000,100000,1000000
+    python benchmark.py serializers --users 100000
+    python benchmark.py carts --ops 2000 [--redis-url redis://localhost:6379/15]
+    python benchmark.py webhook --messages 50 --interval 0.5
+
+Cada benchmark gera dados sintéticos num diretório temporário, de modo que
+nada em ``data/`` é tocado.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from redis_store import FakeRedisServer, RedisCartStore, RedisClient
+from serializers import SERIALIZERS
+from sqlite_store import SQLiteDataStore
+from storage import DURABILITY_MODES, CartItem, CartStore, DataStore, Order
+from webhook import FakeBotApi, WebhookServer, derive_secret_token
+
+ORDERS_PER_USER = 5
+STATUSES = ("pendente", "pago", "entregue", "cancelado")
+
+# 2025-01-01 00:00:00 UTC; um pedido por minuto a partir daí
+SYNTHETIC_START_TS = 1735689600.0
+
+def _synthetic_orders(count):
+    """Gera pedidos sintéticos no formato de orders.jsonl"""
+    for i in range(count):
+        order_id = f"{i:08x}"
+        created_ts = SYNTHETIC_START_TS + i * 60
+        yield order_id, {
+            'id': order_id,
+            'user_id': 1000 + i // ORDERS_PER_USER,
+            'items': [
+                {'name': "📺 EI TV (13,50und)", 'price': 270.0,
+                 'details': {'credits': 20, 'discount': True, 'original_price': 13.5}},
+                {'name': "📡 IBO TV OFICIAL R$50", 'price': 50.0,
+                 'details': {'fields': {'MAC': '00:1A:2B:3C:4D:5E'}}},
+            ],
+            'status': STATUSES[i % len(STATUSES)],
+            'payment_id': 100000000 + i,
+            'created_ts': created_ts,
+            'created_at': datetime.fromtimestamp(created_ts).strftime("%Y-%m-%d %H:%M:%S")
+        }
+
+def _write_json_dataset(data_dir, count):
+    users = {}
+    carts = {}
+    orders = {}
+    for order_id, order in _synthetic_orders(count):
+        orders[order_id] = order
+        user_id = order['user_id']
+        users[str(user_id)] = {'id': user_id, 'nome': f"Cliente {user_id}", 'telefone': "11999999999"}
+        # Um em cada dez clientes com um carrinho aberto
+        if user_id % 10 == 0:
+            carts[str(user_id)] = {'items': order['items'], 'touched': time.time()}
+    for name, data in (("users.json", users), ("carts.json", carts)):
+        with open(os.path.join(data_dir, name), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(data_dir, "orders.jsonl"), 'w', encoding='utf-8') as f:
+        for order in orders.values():
+            f.write(json.dumps(order, ensure_ascii=False, separators=(',', ':')) + "\n")
+
+def _write_sqlite_dataset(path, count):
+    SQLiteDataStore(path).close()
+    conn = sqlite3.connect(path)
+    with conn:
+        users = set()
+        order_rows = []
+        item_rows = []
+        for order_id, order in _synthetic_orders(count):
+            users.add(order['user_id'])
+            order_rows.append((order_id, order['user_id'], order['status'], str(order['payment_id']),
+                               order['created_at'], order['created_ts']))
+            for position, item in enumerate(order['items']):
+                item_rows.append((order_id, position, item['name'], item['price'], json.dumps(item['details'])))
+        conn.executemany("INSERT INTO users VALUES (?, ?, ?)",
+                         ((user_id, f"Cliente {user_id}", "11999999999") for user_id in users))
+        conn.executemany("INSERT INTO orders (id, user_id, status, payment_id, created_at, created_ts) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", order_rows)
+        conn.executemany("INSERT INTO order_items VALUES (?, ?, ?, ?, ?)", item_rows)
+    conn.close()
+
+def _timed(func, repeat=1):
+    """Retorna o tempo médio (ms) de ``repeat`` execuções de ``func``"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+def _measure(store_factory, count, repeat):
+    results = {}
+    start = time.perf_counter()
+    store = store_factory()
+    results['load'] = (time.perf_counter() - start) * 1000
+
+    user_id = 1000 + (count // ORDERS_PER_USER) // 2
+    item = CartItem("🎯 X SERVER PLAY (14,50und)", 290.0, {'credits': 20})
+    results['add_to_cart'] = _timed(lambda: store.add_to_cart(user_id, item), repeat)
+    results['clear_cart'] = _timed(lambda: store.clear_cart(user_id), repeat)
+    order = store.create_order(user_id, [item])
+    results['create_order'] = _timed(lambda: store.create_order(user_id, [item]), repeat)
+    results['update_status'] = _timed(lambda: store.update_order_status(order.id, "pago", 42), repeat)
+    results['get_user_orders'] = _timed(lambda: store.get_user_orders(user_id), repeat)
+    results['list_pending'] = _timed(lambda: store.list_orders_by_status("pendente", "pago"), repeat)
+    # Um dia no meio do período sintético (1440 pedidos)
+    day_start = SYNTHETIC_START_TS + (count // 2) * 60
+    results['range_1d'] = _timed(lambda: list(store.iter_orders_between(day_start, day_start + 86400)), repeat)
+    store.close()
+    return results
+
+def bench_storage(args):
+    sizes = [int(size) for size in args.sizes.split(",")]
+    columns = ('load', 'add_to_cart', 'clear_cart', 'create_order', 'update_status',
+               'get_user_orders', 'list_pending', 'range_1d')
+    print(f"{'backend':<8} {'pedidos':>9} " + " ".join(f"{c:>15}" for c in columns) + "   (ms)")
+
+    for count in sizes:
+        # Regravar JSON de 1M pedidos a cada mutação é muito lento: menos repetições
+        repeat = args.repeat if count < 100000 else 1
+        work_dir = tempfile.mkdtemp(prefix="bench_storage_")
+        try:
+            json_dir = os.path.join(work_dir, "json")
+            os.makedirs(json_dir)
+            _write_json_dataset(json_dir, count)
+            sqlite_path = os.path.join(work_dir, "bot.db")
+            _write_sqlite_dataset(sqlite_path, count)
+
+            for backend, factory in (("json", lambda: DataStore(json_dir)),
+                                     ("sqlite", lambda: SQLiteDataStore(sqlite_path))):
+                results = _measure(factory, count, repeat)
+                print(f"{backend:<8} {count:>9} " + " ".join(f"{results[c]:>15.2f}" for c in columns))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+class _LegacyCartItem:
+    """CartItem antes de __slots__ e internação, para comparação"""
+
+    def __init__(self, name, price, details=None):
+        self.name = name
+        self.price = price
+        self.details = details or {}
+
+class _LegacyOrder:
+    """Order antes de __slots__ e internação, para comparação"""
+
+    def __init__(self, data):
+        self.id = data['id']
+        self.user_id = data['user_id']
+        self.items = [_LegacyCartItem(item['name'], item['price'], item.get('details', {}))
+                      for item in data['items']]
+        self.status = data.get('status', 'pendente')
+        self.payment_id = data.get('payment_id')
+        self.created_at = data.get('created_at')
+        self.created_ts = data.get('created_ts')
+
+def _traced_bytes(build):
+    """Memória (bytes) que continua alocada pelo resultado de ``build``"""
+    tracemalloc.start()
+    result = build()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return current
+
+def bench_memory(args):
+    # Cada linha é desserializada separadamente, como ao hidratar do disco
+    lines = [json.dumps(order, ensure_ascii=False) for _, order in _synthetic_orders(args.orders)]
+
+    legacy = _traced_bytes(lambda: [_LegacyOrder(json.loads(line)) for line in lines])
+    slotted = _traced_bytes(lambda: [Order.from_dict(json.loads(line)) for line in lines])
+
+    print(f"{'modelo':<10} {'pedidos':>9} {'MB':>10} {'bytes/pedido':>14}")
+    for label, size in (("legado", legacy), ("slots", slotted)):
+        print(f"{label:<10} {args.orders:>9} {size / 1024 / 1024:>10.1f} {size / args.orders:>14.0f}")
+    print(f"economia: {100 * (1 - slotted / legacy):.1f}%")
+
+def _orders_per_second(store, orders, threads):
+    """Cria ``orders`` pedidos divididos entre ``threads`` threads; retorna pedidos/s"""
+    item = CartItem("🎯 X SERVER PLAY (14,50und)", 290.0, {'credits': 20})
+
+    def worker(index):
+        for i in range(orders // threads):
+            store.create_order(index * 1000 + i % 10, [item])
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (orders // threads) * threads / (time.perf_counter() - start)
+
+def bench_durability(args):
+    print(f"{'backend':<14} {'modo':<8} {'pedidos/s':>12}")
+    for durability in DURABILITY_MODES:
+        backends = (
+            ("json", lambda path: DataStore(path, durability=durability, group_commit_ms=args.group_commit_ms)),
+            ("json+journal", lambda path: DataStore(path, journal=True, snapshot_every=args.orders * 2,
+                                                    durability=durability, group_commit_ms=args.group_commit_ms)),
+            ("sqlite", lambda path: SQLiteDataStore(os.path.join(path, "bot.db"), durability=durability)),
+        )
+        for backend, factory in backends:
+            work_dir = tempfile.mkdtemp(prefix="bench_durability_")
+            try:
+                store = factory(work_dir)
+                rate = _orders_per_second(store, args.orders, args.threads)
+                store.close()
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            print(f"{backend:<14} {durability:<8} {rate:>12.0f}")
+
+# Roda num processo novo para que o pico de RSS seja só o da carga. VmHWM em
+# vez de ru_maxrss, que no Linux herda o pico do processo pai
+_STARTUP_SCRIPT = """
+import json, resource, sys, time
+from storage import DataStore
+
+def peak_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+baseline = peak_kb()
+start = time.perf_counter()
+store = DataStore(sys.argv[1], cart_ttl=float("inf"))
+elapsed = time.perf_counter() - start
+peak = peak_kb()
+print(json.dumps({'load_ms': elapsed * 1000, 'baseline_kb': baseline, 'peak_kb': peak,
+                  'users': len(store.users), 'carts': len(store.carts), 'orders': len(store.orders)}))
+store.close()
+"""
+
+def bench_startup(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'pedidos':>9} {'usuários':>9} {'carrinhos':>9} {'MB em disco':>12} {'carga (ms)':>11} "
+          f"{'RSS base MB':>12} {'RSS pico MB':>12}")
+    for count in (int(size) for size in args.sizes.split(",")):
+        work_dir = tempfile.mkdtemp(prefix="bench_startup_")
+        try:
+            _write_json_dataset(work_dir, count)
+            disk = sum(os.path.getsize(os.path.join(work_dir, name)) for name in os.listdir(work_dir))
+            output = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT, work_dir], cwd=here,
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{result['orders']:>9} {result['users']:>9} {result['carts']:>9} {disk / 1024 / 1024:>12.1f} "
+                  f"{result['load_ms']:>11.0f} {result['baseline_kb'] / 1024:>12.1f} {result['peak_kb'] / 1024:>12.1f}")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def bench_serializers(args):
+    # O conteúdo de users + carts, que é o que o formato configurado grava
+    data = {'users': {}, 'carts': {}}
+    for _, order in _synthetic_orders(args.users * ORDERS_PER_USER):
+        user_id = order['user_id']
+        data['users'][str(user_id)] = {'id': user_id, 'nome': f"Cliente {user_id}", 'telefone': "11999999999"}
+        if user_id % 10 == 0:
+            data['carts'][str(user_id)] = {'items': order['items'], 'touched': SYNTHETIC_START_TS}
+    print(f"{'formato':<18} {'gravar (ms)':>12} {'ler (ms)':>10} {'tamanho KB':>11}")
+    for name, serializer in SERIALIZERS.items():
+        raw = serializer.dumps(data)
+        assert serializer.loads(raw) == data
+        dump_ms = _timed(lambda: serializer.dumps(data), args.repeat)
+        load_ms = _timed(lambda: serializer.loads(raw), args.repeat)
+        print(f"{name:<18} {dump_ms:>12.1f} {load_ms:>10.1f} {len(raw) / 1024:>11.0f}")
+
+def bench_carts(args):
+    # Sem --redis-url, o servidor em processo: mede o custo do protocolo,
+    # não o de um Redis na rede
+    server = None if args.redis_url else FakeRedisServer().start()
+    client = RedisClient(args.redis_url or server.url)
+    work_dir = tempfile.mkdtemp(prefix="bench_carts_")
+    stores = (
+        ("memória", CartStore(os.path.join(work_dir, "carts.json"))),
+        ("redis", RedisCartStore(client, prefix="bench:")),
+    )
+    item = CartItem("🎯 X SERVER PLAY (14,50und)", 290.0, {'credits': 20})
+    print(f"{'carrinhos':<10} {'add (ms)':>9} {'get (ms)':>9} {'clear (ms)':>11}")
+    try:
+        for name, store in stores:
+            users = iter(range(args.ops))
+            add_ms = _timed(lambda: store.add(next(users) % 100, item), args.ops)
+            users = iter(range(args.ops))
+            get_ms = _timed(lambda: store.get(next(users) % 100), args.ops)
+            users = iter(range(100))
+            clear_ms = _timed(lambda: store.clear(next(users)), 100)
+            print(f"{name:<10} {add_ms:>9.3f} {get_ms:>9.3f} {clear_ms:>11.3f}")
+    finally:
+        client.close()
+        if server:
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def _reply_latencies(mode, args):
+    """Latências (ms) entre a mensagem do cliente chegar à Bot API e a resposta do bot"""
+    # Só este benchmark precisa do python-telegram-bot
+    from telegram.ext import Filters, MessageHandler, Updater
+
+    sent = {}
+    latencies = []
+    done = threading.Event()
+
+    def on_send(chat_id, text):
+        latencies.append((time.perf_counter() - sent[text]) * 1000)
+        if len(latencies) == args.messages:
+            done.set()
+
+    api = FakeBotApi(on_send=on_send).start()
+    updater = Updater("123:fake", base_url=api.base_url, use_context=True)
+    updater.dispatcher.add_handler(MessageHandler(Filters.text, lambda update, context:
+                                                  update.message.reply_text(update.message.text)))
+    server = None
+    try:
+        if mode == "polling":
+            # Os mesmos parâmetros do bot
+            updater.start_polling(timeout=30, poll_interval=args.poll_interval)
+        else:
+            secret = derive_secret_token("123:fake")
+            server = WebhookServer(updater.dispatcher, listen="127.0.0.1", port=0, secret_token=secret).start()
+            updater.bot.set_webhook(url=f"http://127.0.0.1:{server.port}{server.path}",
+                                    api_kwargs={'secret_token': secret})
+        time.sleep(0.5)
+        # Chegadas espalhadas, para não ficarem em fase com o ciclo do polling
+        rng = random.Random(42)
+        for number in range(args.messages):
+            text = str(number)
+            sent[text] = time.perf_counter()
+            api.push_update(1000 + number % 50, text)
+            time.sleep(rng.uniform(0, 2 * args.interval))
+        done.wait(30)
+    finally:
+        if server:
+            server.stop()
+        # A Bot API primeiro, para soltar o getUpdates pendurado
+        api.stop()
+        updater.stop()
+    return latencies
+
+def bench_webhook(args):
+    print(f"{'modo':<9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'máx (ms)':>9}")
+    for mode in ("polling", "webhook"):
+        latencies = _reply_latencies(mode, args)
+        if len(latencies) < args.messages:
+            print(f"{mode:<9} só {len(latencies)} de {args.messages} respostas")
+            continue
+        print(f"{mode:<9} {_percentile(latencies, 0.5):>9.1f} {_percentile(latencies, 0.95):>9.1f} "
+              f"{max(latencies):>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks do armazenamento do bot")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    storage_parser = subparsers.add_parser("storage", help="JSON vs SQLite por volume de pedidos")
+    storage_parser.add_argument("--sizes", default="10000,100000,1000000")
+    storage_parser.add_argument("--repeat", type=int, default=5)
+    storage_parser.set_defaults(func=bench_storage)
+
+    memory_parser = subparsers.add_parser("memory", help="memória dos modelos com e sem __slots__")
+    memory_parser.add_argument("--orders", type=int, default=100000)
+    memory_parser.set_defaults(func=bench_memory)
+
+    durability_parser = subparsers.add_parser("durability", help="pedidos/s em cada modo de fsync")
+    durability_parser.add_argument("--orders", type=int, default=2000)
+    durability_parser.add_argument("--threads", type=int, default=8)
+    durability_parser.add_argument("--group-commit-ms", type=float, default=5)
+    durability_parser.set_defaults(func=bench_durability)
+
+    startup_parser = subparsers.add_parser("startup", help="tempo e pico de RSS da carga por tamanho do histórico")
+    startup_parser.add_argument("--sizes", default="10000,100000,1000000")
+    startup_parser.set_defaults(func=bench_startup)
+
+    serializers_parser = subparsers.add_parser("serializers", help="tempo e tamanho de cada formato de arquivo")
+    serializers_parser.add_argument("--users", type=int, default=100000)
+    serializers_parser.add_argument("--repeat", type=int, default=3)
+    serializers_parser.set_defaults(func=bench_serializers)
+
+    carts_parser = subparsers.add_parser("carts", help="latência dos carrinhos em memória vs Redis")
+    carts_parser.add_argument("--ops", type=int, default=2000)
+    carts_parser.add_argument("--redis-url", default="", help="Redis de verdade (padrão: servidor em processo)")
+    carts_parser.set_defaults(func=bench_carts)
+
+    webhook_parser = subparsers.add_parser("webhook", help="latência das respostas com polling vs webhook")
+    webhook_parser.add_argument("--messages", type=int, default=50)
+    webhook_parser.add_argument("--interval", type=float, default=0.5, help="segundos médios entre mensagens")
+    webhook_parser.add_argument("--poll-interval", type=float, default=1.0)
+    webhook_parser.set_defaults(func=bench_webhook)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
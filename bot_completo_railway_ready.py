@@ -1,11 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import json
 import logging
 import os
 import time
-import uuid
 import sys
 import io
 import signal
@@ -54,7 +52,17 @@ try:
                         ReplyKeyboardMarkup, Update)
     from telegram.ext import (CallbackContext, CallbackQueryHandler,
                             CommandHandler, ConversationHandler, Filters,
-                            MessageHandler, Updater)
+                            ExtBot, MessageHandler, TypeHandler, Updater)
+    from telegram.error import BadRequest
+    from redis_store import RedisCartStore, RedisClient, RedisPersistence
+    from serializers import JsonSerializer, get_serializer
+    from sqlite_store import SQLiteDataStore
+    from storage import CartItem, DataStore
+    from broadcast import (BLOCKED, DONE, FAILED, PENDING, RUNNING, SENDING, SENT, UNKNOWN, Broadcaster,
+                           BroadcastStore)
+    from handler_pool import HandlerPool
+    from outbox import Outbox, OutboxRequest, as_notification, until_sent
+    from webhook import WebhookServer, derive_secret_token, run_webhook
 except ImportError as e:
     print(f"Erro ao importar dependências: {e}")
     print("Por favor, instale as dependências com: pip install -r requirements_render.txt")
@@ -69,6 +77,110 @@ TOKEN = os.getenv("TELEGRAM_TOKEN")
 MERCADO_PAGO_TOKEN = os.getenv("MERCADO_PAGO_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
 
+# Persistência: com STORAGE_JOURNAL=1 cada mutação vira um registro no journal
+# em vez de regravar todos os arquivos de dados
+STORAGE_JOURNAL = os.getenv("STORAGE_JOURNAL", "").lower() in ("1", "true", "yes")
+STORAGE_SNAPSHOT_EVERY = int(os.getenv("STORAGE_SNAPSHOT_EVERY", "1000"))
+# Quando gravar os arquivos: immediate, interval (thread de fundo) ou shutdown
+STORAGE_FLUSH_POLICY = os.getenv("STORAGE_FLUSH_POLICY", "immediate").lower()
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "1.0"))
+# fsync das gravações: os (nenhum), always (a cada gravação) ou batch (group
+# commit: sob carga, gravações dentro de STORAGE_GROUP_COMMIT_MS dividem um
+# fsync; no SQLite batch equivale a always)
+STORAGE_DURABILITY = os.getenv("STORAGE_DURABILITY", "os").lower()
+STORAGE_GROUP_COMMIT_MS = float(os.getenv("STORAGE_GROUP_COMMIT_MS", "5"))
+# Formato de users/carts e do catálogo: json, json-compact, msgpack,
+# json-compact+gz ou msgpack+gz (arquivos existentes: python serializers.py convert)
+STORAGE_FORMAT = os.getenv("STORAGE_FORMAT", "json").lower()
+CATALOG_FORMAT = os.getenv("CATALOG_FORMAT", "json").lower()
+# JSON com indent=4 (o formato histórico do catálogo) ou o formato configurado
+CATALOG_SERIALIZER = JsonSerializer(indent=4) if CATALOG_FORMAT == "json" else get_serializer(CATALOG_FORMAT)
+CATALOG_FILE = os.path.join("data", "catalog" + CATALOG_SERIALIZER.extension)
+# Pedidos entregues/cancelados há mais dias que isso vão para o arquivo morto
+STORAGE_ARCHIVE_AFTER_DAYS = int(os.getenv("STORAGE_ARCHIVE_AFTER_DAYS", "7"))
+# Ler pedidos de orders.jsonl via mmap em vez de seek + read
+STORAGE_ORDERS_MMAP = os.getenv("STORAGE_ORDERS_MMAP", "").lower() in ("1", "true", "yes")
+# STORAGE_BACKEND=sqlite troca os arquivos JSON por um banco SQLite; é o
+# backend exigido para rodar várias réplicas do bot sobre os mesmos dados
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+STORAGE_SQLITE_PATH = os.getenv("STORAGE_SQLITE_PATH", os.path.join("data", "bot.db"))
+# Segundos que uma réplica espera pela escrita de outra antes de desistir
+STORAGE_SQLITE_BUSY_TIMEOUT = float(os.getenv("STORAGE_SQLITE_BUSY_TIMEOUT", "5.0"))
+# Carrinhos parados há mais segundos que isso são descartados; a limpeza
+# (que também grava carts.json) roda a cada STORAGE_CART_SWEEP_INTERVAL segundos
+STORAGE_CART_TTL = int(os.getenv("STORAGE_CART_TTL", str(24 * 60 * 60)))
+STORAGE_CART_SWEEP_INTERVAL = int(os.getenv("STORAGE_CART_SWEEP_INTERVAL", "300"))
+# Retenção (tarefa periódica a cada RETENTION_INTERVAL_HOURS): pedidos
+# pendentes há mais de RETENTION_PENDING_HOURS viram cancelados, cancelados sem
+# pagamento há mais de RETENTION_ORPHAN_DAYS são apagados (0 desativa a regra)
+# e os arquivos são compactados
+RETENTION_PENDING_HOURS = float(os.getenv("RETENTION_PENDING_HOURS", "24"))
+RETENTION_ORPHAN_DAYS = float(os.getenv("RETENTION_ORPHAN_DAYS", "7"))
+RETENTION_INTERVAL_HOURS = float(os.getenv("RETENTION_INTERVAL_HOURS", "6"))
+# Pedidos gravados num formato antigo são atualizados ao serem lidos e, em
+# segundo plano, regravados SCHEMA_UPGRADE_BATCH por vez a cada
+# SCHEMA_UPGRADE_INTERVAL segundos até não restar nenhum (0 desativa)
+SCHEMA_UPGRADE_BATCH = int(os.getenv("SCHEMA_UPGRADE_BATCH", "1000"))
+SCHEMA_UPGRADE_INTERVAL = float(os.getenv("SCHEMA_UPGRADE_INTERVAL", "10"))
+# Com REDIS_URL (redis://[:senha@]host:porta/db) carrinhos, context.user_data e
+# o estado das conversas ficam no Redis, compartilhados entre as réplicas
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "bot:")
+# Sessões (user_data) sem uso há mais segundos que isso expiram
+REDIS_SESSION_TTL = int(os.getenv("REDIS_SESSION_TTL", str(7 * 24 * 60 * 60)))
+# Com WEBHOOK_URL (https://host público, sem o caminho) o bot recebe os updates
+# por webhook num listener próprio em WEBHOOK_LISTEN:WEBHOOK_PORT (no Railway,
+# a PORT do serviço web) em vez de long polling. O segredo, se não definido,
+# é derivado do token (o mesmo em todas as réplicas). Updates além de
+# WEBHOOK_QUEUE_SIZE na fila são recusados com 503 e reenviados pelo Telegram
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# Handlers que esperam o Mercado Pago ou o Telegram (checkout, pagamento,
+# entrega, cancelamento) rodam em DISPATCHER_WORKERS threads em vez de na
+# thread do dispatcher. A ocupação do pool vai para o log a cada
+# DISPATCHER_METRICS_INTERVAL segundos (0 desliga) e, no modo webhook,
+# para GET /metrics no mesmo listener
+DISPATCHER_WORKERS = int(os.getenv("DISPATCHER_WORKERS", "8"))
+DISPATCHER_METRICS_INTERVAL = float(os.getenv("DISPATCHER_METRICS_INTERVAL", "60"))
+# Segundos que a confirmação de uma ação admin fica na tela antes de o menu
+# ser redesenhado (por um job, sem ocupar o worker)
+ADMIN_REDRAW_DELAY = float(os.getenv("ADMIN_REDRAW_DELAY", "1.0"))
+# Toda chamada à Bot API com chat_id passa por uma fila que respeita os
+# limites do Telegram: OUTBOX_GLOBAL_RATE mensagens/s no total,
+# OUTBOX_CHAT_RATE/s por chat privado (com rajadas de OUTBOX_CHAT_BURST) e
+# OUTBOX_GROUP_PER_MINUTE por grupo. Respostas aos clientes passam na frente
+# das notificações; um 429 é repetido após o retry_after, até
+# OUTBOX_MAX_RETRIES vezes. Quem envia são OUTBOX_SENDERS threads da fila;
+# o handler espera a resposta por até OUTBOX_CALLER_WAIT segundos e depois
+# segue, com a mensagem ainda na fila. As métricas saem junto com as do pool
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_GROUP_PER_MINUTE = float(os.getenv("OUTBOX_GROUP_PER_MINUTE", "20"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))
+OUTBOX_SENDERS = int(os.getenv("OUTBOX_SENDERS", "8"))
+OUTBOX_CALLER_WAIT = float(os.getenv("OUTBOX_CALLER_WAIT", "1.0"))
+# /broadcast envia um aviso a todos os usuários, BROADCAST_RATE por segundo
+# em lotes de BROADCAST_INTERVAL segundos (cada lote agenda o seguinte; um job
+# a cada BROADCAST_INTERVAL retoma envios parados), até BROADCAST_CONCURRENCY
+# ao mesmo tempo, como notificação (atrás das respostas aos clientes). O
+# estado de cada entrega fica em BROADCAST_DB (com
+# o backend SQLite, o próprio banco, visível a todas as réplicas), então um
+# reinício retoma o envio; outra réplica assume um envio sem notícias há
+# BROADCAST_LEASE segundos. O progresso na mensagem do admin é atualizado a
+# cada BROADCAST_REPORT_INTERVAL segundos
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_INTERVAL = float(os.getenv("BROADCAST_INTERVAL", "5"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "4"))
+BROADCAST_LEASE = float(os.getenv("BROADCAST_LEASE", "60"))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "30"))
+BROADCAST_DB = os.getenv("BROADCAST_DB", STORAGE_SQLITE_PATH if STORAGE_BACKEND == "sqlite"
+                         else os.path.join("data", "broadcasts.db"))
+
 # Configurações GitHub removidas
 
 # Verificação de variáveis de ambiente obrigatórias
@@ -199,223 +311,29 @@ CONFIRM_DELETE = 6
 EDIT_PRODUCT_FIELD = 7
 EDIT_PRODUCT_VALUE = 8
 
-# Dados temporários para admin
-product_temp_data = {}
-
-# CLASSES DE MODELO
-
-class User:
-    def __init__(self, id, nome, telefone):
-        self.id = id
-        self.nome = nome
-        self.telefone = telefone
-        
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'nome': self.nome,
-            'telefone': self.telefone
-        }
-
-class CartItem:
-    def __init__(self, name, price, details=None):
-        self.name = name
-        self.price = price
-        self.details = details or {}
-        
-    def to_dict(self):
-        return {
-            'name': self.name,
-            'price': self.price,
-            'details': self.details
-        }
-        
-    @classmethod
-    def from_dict(cls, data):
-        return cls(
-            name=data['name'],
-            price=data['price'],
-            details=data.get('details', {})
-        )
-
-class Order:
-    def __init__(self, id, user_id, items, status="pendente", payment_id=None):
-        self.id = id
-        self.user_id = user_id
-        self.items = [CartItem.from_dict(item) if isinstance(item, dict) else item for item in items]
-        self.status = status
-        self.payment_id = payment_id
-        self.created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'items': [item.to_dict() for item in self.items],
-            'status': self.status,
-            'payment_id': self.payment_id,
-            'created_at': self.created_at
-        }
-        
-    @classmethod
-    def from_dict(cls, data):
-        return cls(
-            id=data['id'],
-            user_id=data['user_id'],
-            items=data['items'],
-            status=data.get('status', 'pendente'),
-            payment_id=data.get('payment_id')
-        )
-
-class DataStore:
-    """Handle in-memory data persistence for users, carts, and orders with file backup"""
-    
-    def __init__(self):
-        self.users = {}  # user_id -> User
-        self.carts = {}  # user_id -> [CartItem]
-        self.orders = {}  # order_id -> Order
-        self.users_file = os.path.join("data", "users.json")
-        self.orders_file = os.path.join("data", "orders.json")
-        self.carts_file = os.path.join("data", "carts.json")
-        
-        # Garantir que o diretório de dados existe
-        os.makedirs("data", exist_ok=True)
-        
-        # Carregar dados salvos anteriormente, se existirem
-        self._load_data()
-    
-    def _load_data(self):
-        """Carrega dados dos arquivos JSON"""
-        try:
-            # Carregar usuários
-            if os.path.exists(self.users_file):
-                with open(self.users_file, 'r', encoding='utf-8') as f:
-                    users_data = json.load(f)
-                    for user_id, user_data in users_data.items():
-                        self.users[int(user_id)] = User(
-                            int(user_id),
-                            user_data['nome'],
-                            user_data['telefone']
-                        )
-                logger.info(f"Carregados {len(self.users)} usuários do arquivo")
-            
-            # Carregar carrinhos
-            if os.path.exists(self.carts_file):
-                with open(self.carts_file, 'r', encoding='utf-8') as f:
-                    carts_data = json.load(f)
-                    for user_id, cart_items in carts_data.items():
-                        self.carts[int(user_id)] = [CartItem.from_dict(item) for item in cart_items]
-                logger.info(f"Carregados {len(self.carts)} carrinhos do arquivo")
-            
-            # Carregar pedidos
-            if os.path.exists(self.orders_file):
-                with open(self.orders_file, 'r', encoding='utf-8') as f:
-                    orders_data = json.load(f)
-                    for order_id, order_data in orders_data.items():
-                        self.orders[order_id] = Order.from_dict(order_data)
-                logger.info(f"Carregados {len(self.orders)} pedidos do arquivo")
-        
-        except Exception as e:
-            logger.error(f"Erro ao carregar dados: {e}")
-    
-    def _save_data(self):
-        """Salva todos os dados em arquivos JSON"""
-        try:
-            # Salvar usuários
-            users_data = {}
-            for user_id, user in self.users.items():
-                users_data[str(user_id)] = user.to_dict()
-            
-            with open(self.users_file, 'w', encoding='utf-8') as f:
-                json.dump(users_data, f, ensure_ascii=False, indent=2)
-            
-            # Salvar carrinhos
-            carts_data = {}
-            for user_id, cart_items in self.carts.items():
-                carts_data[str(user_id)] = [item.to_dict() for item in cart_items]
-            
-            with open(self.carts_file, 'w', encoding='utf-8') as f:
-                json.dump(carts_data, f, ensure_ascii=False, indent=2)
-            
-            # Salvar pedidos
-            orders_data = {}
-            for order_id, order in self.orders.items():
-                orders_data[order_id] = order.to_dict()
-            
-            with open(self.orders_file, 'w', encoding='utf-8') as f:
-                json.dump(orders_data, f, ensure_ascii=False, indent=2)
-            
-            logger.info("Dados salvos em arquivos com sucesso")
-            
-        except Exception as e:
-            logger.error(f"Erro ao salvar dados: {e}")
-        
-    def save_user(self, user_id, name, phone):
-        """Save user information"""
-        self.users[user_id] = User(user_id, name, phone)
-        # Salvar imediatamente
-        self._save_data()
-        return self.users[user_id]
-        
-    def get_user(self, user_id):
-        """Get user by ID"""
-        return self.users.get(user_id)
-        
-    def add_to_cart(self, user_id, item):
-        """Add item to user's cart"""
-        if user_id not in self.carts:
-            self.carts[user_id] = []
-            
-        # Convert dict to CartItem if needed
-        if isinstance(item, dict):
-            item = CartItem.from_dict(item)
-            
-        self.carts[user_id].append(item)
-        # Salvar imediatamente
-        self._save_data()
-        return self.carts[user_id]
-        
-    def get_cart(self, user_id):
-        """Get user's cart"""
-        return self.carts.get(user_id, [])
-        
-    def clear_cart(self, user_id):
-        """Clear user's cart"""
-        self.carts[user_id] = []
-        # Salvar imediatamente
-        self._save_data()
-        
-    def create_order(self, user_id, cart_items, payment_id=None):
-        """Create a new order"""
-        order_id = str(uuid.uuid4().hex[:8])  # Generate unique order ID
-        order = Order(order_id, user_id, cart_items, payment_id=payment_id)
-        self.orders[order_id] = order
-        # Salvar imediatamente
-        self._save_data()
-        return order
-        
-    def get_order(self, order_id):
-        """Get order by ID"""
-        return self.orders.get(order_id)
-        
-    def update_order_status(self, order_id, status, payment_id=None):
-        """Update order status and optionally payment_id"""
-        order = self.get_order(order_id)
-        if order:
-            order.status = status
-            if payment_id:
-                order.payment_id = payment_id
-            # Salvar imediatamente
-            self._save_data()
-            return order
-        return None
-        
-    def get_user_orders(self, user_id):
-        """Get all orders for a user"""
-        return [order for order in self.orders.values() if order.user_id == user_id]
-
 # Inicializar armazenamento de dados
-db = DataStore()
+redis_client = RedisClient(REDIS_URL) if REDIS_URL else None
+cart_store = RedisCartStore(redis_client, ttl=STORAGE_CART_TTL, prefix=REDIS_PREFIX) if redis_client else None
+if STORAGE_BACKEND == "sqlite":
+    db = SQLiteDataStore(STORAGE_SQLITE_PATH, cart_ttl=STORAGE_CART_TTL,
+                         busy_timeout=STORAGE_SQLITE_BUSY_TIMEOUT, durability=STORAGE_DURABILITY,
+                         cart_store=cart_store)
+else:
+    db = DataStore(
+        journal=STORAGE_JOURNAL,
+        snapshot_every=STORAGE_SNAPSHOT_EVERY,
+        flush_policy=STORAGE_FLUSH_POLICY,
+        flush_interval=STORAGE_FLUSH_INTERVAL,
+        orders_mmap=STORAGE_ORDERS_MMAP,
+        cart_ttl=STORAGE_CART_TTL,
+        durability=STORAGE_DURABILITY,
+        group_commit_ms=STORAGE_GROUP_COMMIT_MS,
+        serializer=STORAGE_FORMAT,
+        cart_store=cart_store
+    )
+broadcasts = BroadcastStore(BROADCAST_DB, busy_timeout=STORAGE_SQLITE_BUSY_TIMEOUT)
+broadcaster = Broadcaster(broadcasts, rate=BROADCAST_RATE, lease=BROADCAST_LEASE,
+                          concurrency=BROADCAST_CONCURRENCY)
 
 # FUNÇÕES UTILITÁRIAS
 
@@ -431,9 +349,7 @@ def save_catalog_to_git():
     try:
         # Criar diretório se não existir
         os.makedirs('data', exist_ok=True)
-        # Salvar catálogo em JSON
-        with open('data/catalog.json', 'w', encoding='utf-8') as f:
-            json.dump(PRODUCT_CATALOG, f, ensure_ascii=False, indent=4)
+        CATALOG_SERIALIZER.dump(CATALOG_FILE, PRODUCT_CATALOG)
         logger.info("Catálogo salvo com sucesso")
         return True
     except Exception as e:
@@ -1051,6 +967,7 @@ def handle_quantity(update: Update, context: CallbackContext):
             name=product['name'],
             price=total_price,
             details={
+                "kind": "credits",
                 "credits": quantity,
                 "discount": has_discount,
                 "original_price": base_price
@@ -1165,7 +1082,7 @@ def collect_product_fields(update: Update, context: CallbackContext):
         cart_item = CartItem(
             name=product['name'],
             price=product['price'],
-            details={"fields": fields_collected}
+            details={"kind": "app", "fields": fields_collected}
         )
         
         # Add to cart
@@ -1827,7 +1744,7 @@ def check_payment_status(update: Update, context: CallbackContext):
                     # Update order with payment ID
                     order.payment_id = payment_id
                     # This persists the payment ID to the order
-                    db.update_order_status(order_id, order.status)
+                    db.update_order_status(order_id, order.status, payment_id)
                     
                 else:
                     # No payment found
@@ -1867,11 +1784,9 @@ def check_payment_status(update: Update, context: CallbackContext):
             
         # Process payment status
         if payment_status == "approved":
-            # If order wasn't marked as paid yet
-            if order.status != "pago":
-                # Update order status
-                db.update_order_status(order_id, "pago")
-                
+            # If order wasn't marked as paid yet. A troca é atômica (inclusive entre
+            # réplicas): dois cliques simultâneos notificariam o admin duas vezes
+            if db.transition_order_status(order_id, "pago", ("pendente", "cancelado")):
                 # Send admin notification about new paid order
                 notify_admin_new_order(context, order, user)
             
@@ -1942,7 +1857,7 @@ def list_orders(update: Update, context: CallbackContext):
             return
         
         # Sort orders by creation date (newest first)
-        orders.sort(key=lambda x: x.created_at, reverse=True)
+        orders.sort(key=lambda x: x.created_ts, reverse=True)
         
         # Format orders list
         message = "📋 *Seus Pedidos*\n\n"
@@ -2073,7 +1988,7 @@ def check_payment_callback(update: Update, context: CallbackContext):
             return
         
         # Sort orders by creation date (newest first)
-        orders.sort(key=lambda x: x.created_at, reverse=True)
+        orders.sort(key=lambda x: x.created_ts, reverse=True)
         
         # Create keyboard with order details buttons
         keyboard = []
@@ -2136,12 +2051,13 @@ def notify_admin_new_order(context: CallbackContext, order, user):
     ]
     
     try:
-        context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=message,
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        with as_notification():
+            context.bot.send_message(
+                chat_id=ADMIN_ID,
+                text=message,
+                parse_mode="Markdown",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
     except Exception as e:
         logger.error(f"Error sending admin notification: {e}")
 
@@ -2178,15 +2094,16 @@ def mark_as_delivered(update: Update, context: CallbackContext):
     
     # Notify customer
     try:
-        context.bot.send_message(
-            chat_id=order.user_id,
-            text=(
-                f"✅ *Pedido Entregue!*\n\n"
-                f"Seu pedido #{order_id} foi marcado como ENTREGUE.\n\n"
-                f"Obrigado por comprar conosco!"
-            ),
-            parse_mode="Markdown"
-        )
+        with as_notification():
+            context.bot.send_message(
+                chat_id=order.user_id,
+                text=(
+                    f"✅ *Pedido Entregue!*\n\n"
+                    f"Seu pedido #{order_id} foi marcado como ENTREGUE.\n\n"
+                    f"Obrigado por comprar conosco!"
+                ),
+                parse_mode="Markdown"
+            )
     except Exception as e:
         logger.error(f"Error notifying customer about delivery: {e}")
 
@@ -2223,15 +2140,16 @@ def cancel_order(update: Update, context: CallbackContext):
     
     # Notify customer
     try:
-        context.bot.send_message(
-            chat_id=order.user_id,
-            text=(
-                f"❌ *Pedido Cancelado*\n\n"
-                f"Infelizmente seu pedido #{order_id} foi cancelado.\n\n"
-                f"Entre em contato conosco para mais informações."
-            ),
-            parse_mode="Markdown"
-        )
+        with as_notification():
+            context.bot.send_message(
+                chat_id=order.user_id,
+                text=(
+                    f"❌ *Pedido Cancelado*\n\n"
+                    f"Infelizmente seu pedido #{order_id} foi cancelado.\n\n"
+                    f"Entre em contato conosco para mais informações."
+                ),
+                parse_mode="Markdown"
+            )
     except Exception as e:
         logger.error(f"Error notifying customer about cancellation: {e}")
 
@@ -2306,9 +2224,8 @@ def list_pending_orders(update: Update, context: CallbackContext):
     if is_callback:
         update.callback_query.answer()
     
-    # Get all orders
-    all_orders = db.orders.values()
-    pending_orders = [order for order in all_orders if order.status == "pendente" or order.status == "pago"]
+    # Get pending and paid orders
+    pending_orders = db.list_orders_by_status("pendente", "pago")
     
     # Mensagem para quando não há pedidos pendentes
     if not pending_orders:
@@ -2330,7 +2247,7 @@ def list_pending_orders(update: Update, context: CallbackContext):
         return
     
     # Sort by date (newest first)
-    pending_orders.sort(key=lambda x: x.created_at, reverse=True)
+    pending_orders.sort(key=lambda x: x.created_ts, reverse=True)
     
     # Create keyboard with order buttons
     keyboard = []
@@ -2460,6 +2377,123 @@ def admin_products(update: Update, context: CallbackContext):
     
     return CATEGORY_SELECTION
 
+def admin_categories_menu():
+    """Texto e teclado da lista de categorias do painel admin"""
+    keyboard = []
+    for category in PRODUCT_CATALOG.keys():
+        keyboard.append([InlineKeyboardButton(f"📂 {category}", callback_data=f"admin_cat_{category}")])
+    
+    # Add button to add new category
+    keyboard.append([InlineKeyboardButton("➕ Adicionar Categoria", callback_data="admin_add_category")])
+    
+    return dict(
+        text="🛠️ *Gerenciamento de Produtos*\n\n"
+            "Selecione uma categoria para gerenciar seus produtos:",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+def admin_category_menu(category_name):
+    """Texto e teclado dos produtos de uma categoria no painel admin"""
+    products = PRODUCT_CATALOG.get(category_name, [])
+    
+    keyboard = []
+    for i, product in enumerate(products):
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{product['name']} - R${product['price']:.2f}", 
+                callback_data=f"admin_prod_{i}"
+            )
+        ])
+    
+    # Add button to add new product
+    keyboard.append([InlineKeyboardButton("➕ Adicionar Produto", callback_data="admin_add_product")])
+    # Add button to delete category
+    keyboard.append([InlineKeyboardButton("❌ Excluir Categoria", callback_data=f"admin_delete_category_{category_name}")])
+    # Add button to go back
+    keyboard.append([InlineKeyboardButton("◀️ Voltar", callback_data="admin_back_to_categories")])
+    
+    return dict(
+        text=f"🛠️ *Gerenciamento de Produtos: {category_name}*\n\n"
+            f"Selecione um produto para editar ou excluir:",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+def admin_product_menu(category, product_index):
+    """Texto e teclado dos detalhes de um produto no painel admin"""
+    product = PRODUCT_CATALOG[category][product_index]
+    
+    # Show product details with edit/delete options
+    fields_text = ", ".join(product.get('fields', [])) if 'fields' in product else "Nenhum"
+    discount_text = "Sim" if product.get('discount', False) else "Não"
+    
+    product_info = (
+        f"🔍 *Detalhes do Produto*\n\n"
+        f"📝 Nome: {product['name']}\n"
+        f"💰 Preço: R${product['price']:.2f}\n"
+    )
+    
+    if 'fields' in product:
+        product_info += f"📋 Campos: {fields_text}\n"
+    
+    if 'discount' in product:
+        product_info += f"🏷️ Desconto: {discount_text}\n"
+    
+    keyboard = [
+        [InlineKeyboardButton("✏️ Editar Nome", callback_data="admin_edit_name")],
+        [InlineKeyboardButton("💰 Editar Preço", callback_data="admin_edit_price")]
+    ]
+    
+    if 'fields' in product:
+        keyboard.append([InlineKeyboardButton("📋 Editar Campos", callback_data="admin_edit_fields")])
+    
+    if 'discount' in product:
+        keyboard.append([InlineKeyboardButton("🏷️ Alterar Desconto", callback_data="admin_edit_discount")])
+    
+    keyboard.append([InlineKeyboardButton("❌ Excluir Produto", callback_data="admin_delete_product")])
+    keyboard.append([InlineKeyboardButton("◀️ Voltar", callback_data=f"admin_cat_{category}")])
+    
+    return dict(
+        text=product_info,
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# Redesenhos pendentes do painel admin: user_id -> job do JobQueue
+_admin_redraws = {}
+
+def schedule_admin_redraw(context: CallbackContext, user_id, redraw):
+    """Chama ``redraw()`` num job daqui a ADMIN_REDRAW_DELAY segundos
+    
+    A confirmação de uma ação admin fica visível por um instante antes da
+    tela seguinte, sem o handler dormir num worker do dispatcher. Se o admin
+    mandar outra coisa antes, o redesenho é descartado (cancel_admin_redraw).
+    """
+    cancel_admin_redraw_for(user_id)
+    
+    def run(job_context: CallbackContext):
+        # Já substituído ou cancelado por um update mais novo
+        if _admin_redraws.get(user_id) is not job_context.job:
+            return
+        _admin_redraws.pop(user_id, None)
+        try:
+            redraw()
+        except Exception as e:
+            logger.error(f"Erro ao voltar ao menu admin do usuário {user_id}: {e}")
+    
+    _admin_redraws[user_id] = context.job_queue.run_once(run, ADMIN_REDRAW_DELAY)
+
+def cancel_admin_redraw_for(user_id):
+    job = _admin_redraws.pop(user_id, None)
+    if job is not None:
+        job.schedule_removal()
+
+def cancel_admin_redraw(update: Update, context: CallbackContext):
+    """Descarta o redesenho pendente de quem mandou um update novo"""
+    if update.effective_user and update.effective_user.id in _admin_redraws:
+        cancel_admin_redraw_for(update.effective_user.id)
+
 def admin_select_category(update: Update, context: CallbackContext):
     """Handle admin category selection"""
     query = update.callback_query
@@ -2486,30 +2520,7 @@ def admin_select_category(update: Update, context: CallbackContext):
     context.user_data['admin_category'] = category_name
     
     # Show products in this category
-    products = PRODUCT_CATALOG.get(category_name, [])
-    
-    keyboard = []
-    for i, product in enumerate(products):
-        keyboard.append([
-            InlineKeyboardButton(
-                f"{product['name']} - R${product['price']:.2f}", 
-                callback_data=f"admin_prod_{i}"
-            )
-        ])
-    
-    # Add button to add new product
-    keyboard.append([InlineKeyboardButton("➕ Adicionar Produto", callback_data="admin_add_product")])
-    # Add button to delete category
-    keyboard.append([InlineKeyboardButton("❌ Excluir Categoria", callback_data=f"admin_delete_category_{category_name}")])
-    # Add button to go back
-    keyboard.append([InlineKeyboardButton("◀️ Voltar", callback_data="admin_back_to_categories")])
-    
-    query.edit_message_text(
-        f"🛠️ *Gerenciamento de Produtos: {category_name}*\n\n"
-        f"Selecione um produto para editar ou excluir:",
-        parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    query.edit_message_text(**admin_category_menu(category_name))
     
     return PRODUCT_ACTION
 
@@ -2527,20 +2538,7 @@ def admin_select_product(update: Update, context: CallbackContext):
     
     # Handle back button
     if data == "admin_back_to_categories":
-        # Create keyboard with categories
-        keyboard = []
-        for category in PRODUCT_CATALOG.keys():
-            keyboard.append([InlineKeyboardButton(f"📂 {category}", callback_data=f"admin_cat_{category}")])
-        
-        # Add button to add new category
-        keyboard.append([InlineKeyboardButton("➕ Adicionar Categoria", callback_data="admin_add_category")])
-        
-        query.edit_message_text(
-            "🛠️ *Gerenciamento de Produtos*\n\n"
-            "Selecione uma categoria para gerenciar seus produtos:",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        query.edit_message_text(**admin_categories_menu())
         
         return CATEGORY_SELECTION
     
@@ -2560,44 +2558,9 @@ def admin_select_product(update: Update, context: CallbackContext):
     category = context.user_data.get('admin_category')
     product_index = int(data.split("_")[2])
     
-    product = PRODUCT_CATALOG[category][product_index]
     context.user_data['admin_product_index'] = product_index
     
-    # Show product details with edit/delete options
-    fields_text = ", ".join(product.get('fields', [])) if 'fields' in product else "Nenhum"
-    discount_text = "Sim" if product.get('discount', False) else "Não"
-    
-    product_info = (
-        f"🔍 *Detalhes do Produto*\n\n"
-        f"📝 Nome: {product['name']}\n"
-        f"💰 Preço: R${product['price']:.2f}\n"
-    )
-    
-    if 'fields' in product:
-        product_info += f"📋 Campos: {fields_text}\n"
-    
-    if 'discount' in product:
-        product_info += f"🏷️ Desconto: {discount_text}\n"
-    
-    keyboard = [
-        [InlineKeyboardButton("✏️ Editar Nome", callback_data="admin_edit_name")],
-        [InlineKeyboardButton("💰 Editar Preço", callback_data="admin_edit_price")]
-    ]
-    
-    if 'fields' in product:
-        keyboard.append([InlineKeyboardButton("📋 Editar Campos", callback_data="admin_edit_fields")])
-    
-    if 'discount' in product:
-        keyboard.append([InlineKeyboardButton("🏷️ Alterar Desconto", callback_data="admin_edit_discount")])
-    
-    keyboard.append([InlineKeyboardButton("❌ Excluir Produto", callback_data="admin_delete_product")])
-    keyboard.append([InlineKeyboardButton("◀️ Voltar", callback_data=f"admin_cat_{category}")])
-    
-    query.edit_message_text(
-        product_info,
-        parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    query.edit_message_text(**admin_product_menu(category, product_index))
     
     return EDIT_PRODUCT_FIELD
 
@@ -2734,15 +2697,9 @@ def admin_edit_discount(update: Update, context: CallbackContext):
         )
         
         # Salvar o catálogo localmente (removida integração com Git)
-        try:
-            # Apenas exportamos o catálogo para JSON
-            with open('data/catalog.json', 'w', encoding='utf-8') as f:
-                json.dump(PRODUCT_CATALOG, f, ensure_ascii=False, indent=4)
+        save_success = save_catalog_to_git()
+        if save_success:
             logger.info(f"Catálogo salvo após atualizar desconto do produto '{product['name']}'")
-            save_success = True
-        except Exception as e:
-            logger.error(f"Erro ao salvar catálogo após atualizar desconto: {e}")
-            save_success = False
         
         # Mostrar mensagem de confirmação
         query.edit_message_text(
@@ -2758,11 +2715,9 @@ def admin_edit_discount(update: Update, context: CallbackContext):
         context.user_data['admin_action'] = None
         context.user_data['admin_edit_field'] = None
         
-        # Wait a moment before returning to product view
-        time.sleep(1)
-        
-        # Now get product details again
-        return admin_select_product(update, context)
+        # Voltar aos detalhes do produto depois de um instante
+        schedule_admin_redraw(context, user_id,
+                              lambda: query.edit_message_text(**admin_product_menu(category, product_index)))
     
     return EDIT_PRODUCT_FIELD
 
@@ -2904,22 +2859,7 @@ def admin_confirm_delete_product(update: Update, context: CallbackContext):
             )
         
         # Return to categories list after a short delay
-        time.sleep(1)
-        
-        # Show admin menu again with updated categories
-        keyboard = []
-        for category in PRODUCT_CATALOG.keys():
-            keyboard.append([InlineKeyboardButton(f"📂 {category}", callback_data=f"admin_cat_{category}")])
-        
-        # Add button to add new category
-        keyboard.append([InlineKeyboardButton("➕ Adicionar Categoria", callback_data="admin_add_category")])
-        
-        query.edit_message_text(
-            "🛠️ *Gerenciamento de Produtos*\n\n"
-            "Selecione uma categoria para gerenciar seus produtos:",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        schedule_admin_redraw(context, user_id, lambda: query.edit_message_text(**admin_categories_menu()))
         
         return CATEGORY_SELECTION
     
@@ -2959,10 +2899,9 @@ def admin_confirm_delete_product(update: Update, context: CallbackContext):
         )
         
         # Return to category view after a short delay
-        time.sleep(1)
+        schedule_admin_redraw(context, user_id, lambda: query.edit_message_text(**admin_category_menu(category)))
         
-        # Show products in this category again
-        return admin_select_category(update, context)
+        return PRODUCT_ACTION
     
     # If not confirmed, go back
     if data.startswith("admin_prod_"):
@@ -3052,11 +2991,11 @@ def admin_add_product_name(update: Update, context: CallbackContext):
         
         user_id = update.effective_user.id
         # Store in temporary storage
-        product_temp_data[user_id] = {'name': product_name}
+        context.user_data['product_temp'] = {'name': product_name}
         
         # Log para debug
         from utils import log_error
-        log_error(f"Produto temp iniciado: {product_temp_data[user_id]}", f"Usuário {user_id}")
+        log_error(f"Produto temp iniciado: {context.user_data['product_temp']}", f"Usuário {user_id}")
         
         update.message.reply_text(
             "💰 *Preço do Produto*\n\n"
@@ -3092,17 +3031,17 @@ def admin_add_product_price(update: Update, context: CallbackContext):
         
         # Store price in temp data
         user_id = update.effective_user.id
-        if user_id not in product_temp_data:
+        if 'product_temp' not in context.user_data:
             # Log para debug
             from utils import log_error
             log_error("Produto temp não encontrado ao tentar adicionar preço", f"Usuário {user_id}")
-            product_temp_data[user_id] = {}
+            context.user_data['product_temp'] = {}
         
-        product_temp_data[user_id]['price'] = price
+        context.user_data['product_temp']['price'] = price
         
         # Log para debug
         from utils import log_error
-        log_error(f"Preço adicionado ao produto temp: {product_temp_data[user_id]}", f"Usuário {user_id}")
+        log_error(f"Preço adicionado ao produto temp: {context.user_data['product_temp']}", f"Usuário {user_id}")
         
         # Ask for product type: app (with fields), credit (with discount), or fixed price (no discount)
         update.message.reply_text(
@@ -3134,7 +3073,7 @@ def admin_add_product_type(update: Update, context: CallbackContext):
     user_id = query.from_user.id
     category = context.user_data.get('admin_category')
     
-    if user_id not in product_temp_data:
+    if 'product_temp' not in context.user_data:
         query.edit_message_text("❌ Erro nos dados do produto. Por favor, comece novamente.")
         return ConversationHandler.END
     
@@ -3145,7 +3084,7 @@ def admin_add_product_type(update: Update, context: CallbackContext):
             "Por favor, informe os campos necessários, separados por vírgula.\n"
             "Exemplo: MAC, Email, Senha"
         )
-        product_temp_data[user_id]['type'] = 'app'
+        context.user_data['product_temp']['type'] = 'app'
         return ADD_PRODUCT_FIELDS
     
     # Handle credit product (has discount option)
@@ -3155,8 +3094,8 @@ def admin_add_product_type(update: Update, context: CallbackContext):
         
         # Finalize product creation
         new_product = {
-            'name': product_temp_data[user_id]['name'],
-            'price': product_temp_data[user_id]['price'],
+            'name': context.user_data['product_temp']['name'],
+            'price': context.user_data['product_temp']['price'],
             'discount': True if is_credit else False  # Only apply discount for credit products
         }
         
@@ -3179,8 +3118,7 @@ def admin_add_product_type(update: Update, context: CallbackContext):
             save_success = False
         
         # Clear temp data
-        if user_id in product_temp_data:
-            del product_temp_data[user_id]
+        context.user_data.pop('product_temp', None)
         
         # Mostrar mensagem de confirmação com informação sobre desconto
         discount_info = "com desconto aplicável" if is_credit else "sem desconto aplicável"
@@ -3193,10 +3131,9 @@ def admin_add_product_type(update: Update, context: CallbackContext):
         )
         
         # Return to category view after a short delay
-        time.sleep(1)
+        schedule_admin_redraw(context, user_id, lambda: query.edit_message_text(**admin_category_menu(category)))
         
-        # Show updated category
-        return admin_select_category(update, context)
+        return PRODUCT_ACTION
     
     return ADD_PRODUCT_FIELDS
 
@@ -3212,28 +3149,13 @@ def admin_add_product_fields(update: Update, context: CallbackContext):
         
         if query.data == "admin_cancel_add":
             # Clear temp data
-            if user_id in product_temp_data:
-                del product_temp_data[user_id]
+            context.user_data.pop('product_temp', None)
                 
             query.edit_message_text("❌ Adição de produto cancelada.")
             
             # Show categories after a moment
-            time.sleep(1)
-            
-            # Create keyboard with categories
-            keyboard = []
-            for cat in PRODUCT_CATALOG.keys():
-                keyboard.append([InlineKeyboardButton(f"📂 {cat}", callback_data=f"admin_cat_{cat}")])
-            
-            keyboard.append([InlineKeyboardButton("➕ Adicionar Categoria", callback_data="admin_add_category")])
-            
-            context.bot.send_message(
-                chat_id=user_id,
-                text="🛠️ *Gerenciamento de Produtos*\n\n"
-                    "Selecione uma categoria para gerenciar seus produtos:",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            schedule_admin_redraw(context, user_id,
+                                  lambda: context.bot.send_message(chat_id=user_id, **admin_categories_menu()))
             
             return CATEGORY_SELECTION
         return ADD_PRODUCT_FIELDS
@@ -3247,7 +3169,7 @@ def admin_add_product_fields(update: Update, context: CallbackContext):
     fields_text = update.message.text.strip()
     fields = [f.strip() for f in fields_text.split(',') if f.strip()]
     
-    if user_id not in product_temp_data:
+    if 'product_temp' not in context.user_data:
         # Não temos dados temporários - precisamos informar o usuário
         update.message.reply_text(
             "❌ Erro: não encontramos dados do produto em andamento. Por favor, inicie o processo novamente usando o comando de administração.",
@@ -3256,8 +3178,8 @@ def admin_add_product_fields(update: Update, context: CallbackContext):
         return ConversationHandler.END
         
     # Verificar se temos tipo definido (app ou credit)
-    if 'type' not in product_temp_data[user_id]:
-        product_temp_data[user_id]['type'] = 'app'  # Define padrão como app se não estiver definido
+    if 'type' not in context.user_data['product_temp']:
+        context.user_data['product_temp']['type'] = 'app'  # Define padrão como app se não estiver definido
     
     if not fields:
         update.message.reply_text(
@@ -3268,8 +3190,8 @@ def admin_add_product_fields(update: Update, context: CallbackContext):
     
     # Create new app product
     new_product = {
-        'name': product_temp_data[user_id]['name'],
-        'price': product_temp_data[user_id]['price'],
+        'name': context.user_data['product_temp']['name'],
+        'price': context.user_data['product_temp']['price'],
         'fields': fields
     }
     
@@ -3292,8 +3214,7 @@ def admin_add_product_fields(update: Update, context: CallbackContext):
         save_success = False
     
     # Clear temp data
-    if user_id in product_temp_data:
-        del product_temp_data[user_id]
+    context.user_data.pop('product_temp', None)
     
     update.message.reply_text(
         f"✅ *Produto Adicionado!*\n\n"
@@ -3323,8 +3244,7 @@ def admin_cancel(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     
     # Clear temp data
-    if user_id in product_temp_data:
-        del product_temp_data[user_id]
+    context.user_data.pop('product_temp', None)
     
     context.user_data.pop('admin_category', None)
     context.user_data.pop('admin_product_index', None)
@@ -3340,22 +3260,8 @@ def admin_cancel(update: Update, context: CallbackContext):
         )
         
         # Return to main admin panel after a moment
-        time.sleep(1)
-        
-        # Create keyboard with categories
-        keyboard = []
-        for cat in PRODUCT_CATALOG.keys():
-            keyboard.append([InlineKeyboardButton(f"📂 {cat}", callback_data=f"admin_cat_{cat}")])
-        
-        keyboard.append([InlineKeyboardButton("➕ Adicionar Categoria", callback_data="admin_add_category")])
-        
-        context.bot.send_message(
-            chat_id=user_id,
-            text="🛠️ *Gerenciamento de Produtos*\n\n"
-                "Selecione uma categoria para gerenciar seus produtos:",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        schedule_admin_redraw(context, user_id,
+                              lambda: context.bot.send_message(chat_id=user_id, **admin_categories_menu()))
         
         return CATEGORY_SELECTION
     elif update.message:
@@ -3376,8 +3282,7 @@ def admin_cancel_callback(update: Update, context: CallbackContext):
     user_id = query.from_user.id
     
     # Clear temp data
-    if user_id in product_temp_data:
-        del product_temp_data[user_id]
+    context.user_data.pop('product_temp', None)
     
     context.user_data.pop('admin_category', None)
     context.user_data.pop('admin_product_index', None)
@@ -3387,24 +3292,145 @@ def admin_cancel_callback(update: Update, context: CallbackContext):
     query.edit_message_text("❌ Operação administrativa cancelada.")
     
     # Return to main admin panel after a moment
-    time.sleep(1)
+    schedule_admin_redraw(context, user_id,
+                          lambda: context.bot.send_message(chat_id=user_id, **admin_categories_menu()))
     
-    # Create keyboard with categories
-    keyboard = []
-    for cat in PRODUCT_CATALOG.keys():
-        keyboard.append([InlineKeyboardButton(f"📂 {cat}", callback_data=f"admin_cat_{cat}")])
+    return CATEGORY_SELECTION
+
+# BROADCAST
+
+# broadcast_id -> instante (monotonic) da última atualização do progresso
+_broadcast_reports = {}
+
+def format_broadcast_progress(progress):
+    """Texto do progresso de um broadcast para o admin"""
+    counts = progress['counts']
+    total = progress['total']
+    processed = total - counts[PENDING] - counts[SENDING]
+    percent = processed * 100 // total if total else 100
+    status = {RUNNING: "⏳ enviando", DONE: "✅ concluído"}.get(progress['status'], "⛔ cancelado")
+    lines = [
+        f"📣 *Broadcast #{progress['id']}* - {status}",
+        "",
+        f"Processados: {processed} de {total} ({percent}%)",
+        f"✅ Entregues: {counts[SENT]}",
+        f"🚫 Bloquearam o bot: {counts[BLOCKED]}",
+        f"⚠️ Falhas: {counts[FAILED]}",
+    ]
+    if counts[UNKNOWN]:
+        lines.append(f"❔ Sem confirmação: {counts[UNKNOWN]}")
+    if progress['status'] == RUNNING and processed:
+        elapsed = time.time() - progress['created_ts']
+        remaining = (total - processed) * elapsed / processed
+        lines.append(f"\nPrevisão de término: ~{max(1, round(remaining / 60))} min")
+    return "\n".join(lines)
+
+def broadcast_command(update: Update, context: CallbackContext):
+    """Mostra a prévia de um aviso para todos os usuários (admin): /broadcast <texto>"""
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("❌ Você não tem permissão para realizar esta ação.")
+        return
     
-    keyboard.append([InlineKeyboardButton("➕ Adicionar Categoria", callback_data="admin_add_category")])
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        update.message.reply_text(
+            "📣 *Broadcast*\n\n"
+            "Envie `/broadcast` seguido do texto do aviso (aceita *negrito* e _itálico_).\n"
+            "/broadcast\\_status - Progresso do envio\n"
+            "/broadcast\\_cancel - Interromper o envio",
+            parse_mode="Markdown"
+        )
+        return
     
-    context.bot.send_message(
-        chat_id=user_id,
-        text="🛠️ *Gerenciamento de Produtos*\n\n"
-            "Selecione uma categoria para gerenciar seus produtos:",
-        parse_mode="Markdown",
+    running = broadcasts.running()
+    if running:
+        update.message.reply_text(
+            f"⚠️ O broadcast #{running['id']} ainda está em andamento. "
+            f"Acompanhe com /broadcast_status ou interrompa com /broadcast_cancel."
+        )
+        return
+    
+    # A prévia sai com a mesma formatação do envio: um erro de Markdown
+    # aparece aqui e não em cada um dos usuários (por isso espera o envio)
+    try:
+        with until_sent():
+            update.message.reply_text(text, parse_mode="Markdown", disable_web_page_preview=True)
+    except BadRequest as e:
+        update.message.reply_text(f"❌ A formatação do texto é inválida: {e}")
+        return
+    
+    audience = sum(1 for user in db.iter_users() if not broadcasts.is_unreachable(user.id))
+    context.user_data['broadcast_draft'] = text
+    keyboard = [
+        [InlineKeyboardButton(f"✅ Enviar para {audience} usuários", callback_data="broadcast_confirm")],
+        [InlineKeyboardButton("❌ Descartar", callback_data="broadcast_discard")]
+    ]
+    update.message.reply_text(
+        f"👆 Prévia do aviso.\n\n"
+        f"Destinatários: {audience} usuários "
+        f"({broadcasts.unreachable_count()} que bloquearam o bot ficam de fora).",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
+
+def broadcast_confirm(update: Update, context: CallbackContext):
+    """Cria o broadcast confirmado pelo admin; o envio fica com broadcast_job"""
+    query = update.callback_query
+    query.answer()
     
-    return CATEGORY_SELECTION
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        query.edit_message_text("❌ Você não tem permissão para realizar esta ação.")
+        return
+    
+    text = context.user_data.pop('broadcast_draft', None)
+    if query.data == "broadcast_discard":
+        query.edit_message_text("❌ Broadcast descartado.")
+        return
+    if not text:
+        query.edit_message_text("❌ Nenhum aviso pendente. Use /broadcast seguido do texto.")
+        return
+    running = broadcasts.running()
+    if running:
+        query.edit_message_text(f"⚠️ O broadcast #{running['id']} ainda está em andamento.")
+        return
+    
+    broadcast_id = broadcasts.create(text, [user.id for user in db.iter_users()], created_by=user_id,
+                                     parse_mode="Markdown")
+    query.edit_message_text(format_broadcast_progress(broadcasts.progress(broadcast_id)), parse_mode="Markdown")
+    broadcasts.set_report_message(broadcast_id, query.message.chat_id, query.message.message_id)
+    logger.info(f"Broadcast #{broadcast_id} iniciado pelo admin {user_id}")
+    # O primeiro lote já; os seguintes são agendados por ele
+    context.job_queue.run_once(broadcast_job, 0)
+
+def broadcast_status(update: Update, context: CallbackContext):
+    """Progresso do broadcast em andamento ou do último (admin)"""
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ Você não tem permissão para realizar esta ação.")
+        return
+    latest = broadcasts.latest()
+    if not latest:
+        update.message.reply_text("Nenhum broadcast foi enviado ainda.")
+        return
+    update.message.reply_text(format_broadcast_progress(broadcasts.progress(latest['id'])), parse_mode="Markdown")
+
+def broadcast_cancel(update: Update, context: CallbackContext):
+    """Interrompe o broadcast em andamento (admin)"""
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ Você não tem permissão para realizar esta ação.")
+        return
+    running = broadcasts.running()
+    if not running or not broadcasts.cancel(running['id']):
+        update.message.reply_text("Nenhum broadcast em andamento.")
+        return
+    logger.info(f"Broadcast #{running['id']} cancelado")
+    update.message.reply_text(format_broadcast_progress(broadcasts.progress(running['id'])), parse_mode="Markdown")
+
+def broadcast_mark_reachable(update: Update, context: CallbackContext):
+    """Quem bloqueou o bot e voltou a falar com ele volta a receber broadcasts"""
+    if update.effective_user:
+        broadcasts.mark_reachable(update.effective_user.id)
 
 # OTHER COMMANDS
 
@@ -3438,11 +3464,12 @@ def github_sync_command(update: Update, context: CallbackContext):
         )
         return
     
-    # Enviar mensagem de processamento
-    msg = update.message.reply_text(
-        "🔄 Sincronizando catálogo com GitHub...",
-        reply_markup=MAIN_KEYBOARD
-    )
+    # Enviar mensagem de processamento (espera o envio: ela é editada abaixo)
+    with until_sent():
+        msg = update.message.reply_text(
+            "🔄 Sincronizando catálogo com GitHub...",
+            reply_markup=MAIN_KEYBOARD
+        )
     
     try:
         # Criar uma cópia do catálogo para exportação
@@ -3468,7 +3495,7 @@ def github_sync_command(update: Update, context: CallbackContext):
                 text="✅ Catálogo sincronizado com sucesso no GitHub!\n\n"
                      f"Repositório: {GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}\n"
                      f"Branch: {GITHUB_BRANCH}\n"
-                     f"Arquivo: data/catalog.json"
+                     f"Arquivo: {CATALOG_FILE}"
             )
         else:
             context.bot.edit_message_text(
@@ -3515,11 +3542,12 @@ def github_info_command(update: Update, context: CallbackContext):
         )
         return
     
-    # Enviar mensagem de processamento
-    msg = update.message.reply_text(
-        "🔄 Obtendo informações do repositório GitHub...",
-        reply_markup=MAIN_KEYBOARD
-    )
+    # Enviar mensagem de processamento (espera o envio: ela é editada abaixo)
+    with until_sent():
+        msg = update.message.reply_text(
+            "🔄 Obtendo informações do repositório GitHub...",
+            reply_markup=MAIN_KEYBOARD
+        )
     
     try:
         # Obter informações do repositório
@@ -3540,7 +3568,7 @@ def github_info_command(update: Update, context: CallbackContext):
                 f"• Forks: {repo_info.get('forks_count', 0)}\n"
                 f"• Issues abertas: {repo_info.get('open_issues_count', 0)}\n\n"
                 f"*Configuração do Bot:*\n"
-                f"• Arquivo de catálogo: data/catalog.json\n"
+                f"• Arquivo de catálogo: {CATALOG_FILE}\n"
                 f"• Último sync: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
             )
             
@@ -3720,7 +3748,7 @@ def github_sync_callback(update: Update, context: CallbackContext):
                 "✅ Catálogo sincronizado com sucesso no GitHub!\n\n"
                 f"Repositório: {GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}\n"
                 f"Branch: {GITHUB_BRANCH}\n"
-                f"Arquivo: data/catalog.json",
+                f"Arquivo: {CATALOG_FILE}",
                 parse_mode="HTML"
             )
         else:
@@ -3792,7 +3820,7 @@ def github_info_callback(update: Update, context: CallbackContext):
                 f"• Forks: {repo_info.get('forks_count', 0)}\n"
                 f"• Issues abertas: {repo_info.get('open_issues_count', 0)}\n\n"
                 f"<b>Configuração do Bot:</b>\n"
-                f"• Arquivo de catálogo: data/catalog.json\n"
+                f"• Arquivo de catálogo: {CATALOG_FILE}\n"
                 f"• Último sync: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
             )
             
@@ -3972,7 +4000,7 @@ def github_token_input_handler(update: Update, context: CallbackContext):
     ], one_time_keyboard=True, resize_keyboard=True)
     
     # Solicitar o nome do dono do repositório
-    response = update.message.reply_text(
+    update.message.reply_text(
         "👤 <b>Dono do Repositório</b>\n\n"
         "Por favor, envie o nome do usuário ou organização dona do repositório.\n"
         "Este é o primeiro componente da URL do seu repositório: github.com/<b>DONO</b>/nome-do-repo\n\n"
@@ -4201,6 +4229,9 @@ def help_command(update: Update, context: CallbackContext):
             "👑 <b>Comandos de Administrador</b>\n\n"
             "/admin - Gerenciar produtos e categorias\n"
             "/pending - Ver pedidos pendentes\n"
+            "/broadcast - Enviar um aviso a todos os usuários\n"
+            "/broadcast_status - Progresso do último aviso\n"
+            "/broadcast_cancel - Interromper o aviso em andamento\n"
             "/github_sync - Sincronizar catálogo com GitHub\n"
             "/github_info - Ver informações do repositório\n"
             "/github_setup - Configurar integração com GitHub\n"
@@ -4223,6 +4254,117 @@ def error_handler(update, context):
     except Exception as e:
         logger.error(f"ERROR - Error details: {e}")
 
+# TAREFAS AGENDADAS
+
+def archive_orders_job(context: CallbackContext):
+    """Move pedidos finalizados antigos para o arquivo morto"""
+    try:
+        archived = db.archive_finished_orders(STORAGE_ARCHIVE_AFTER_DAYS)
+        if archived:
+            logger.info(f"Arquivamento diário: {archived} pedidos arquivados")
+    except Exception as e:
+        logger.error(f"Erro ao arquivar pedidos: {e}")
+
+def sweep_carts_job(context: CallbackContext):
+    """Descarta carrinhos abandonados e grava os carrinhos alterados"""
+    try:
+        expired = db.sweep_carts()
+        if expired:
+            logger.info(f"Limpeza de carrinhos: {expired} carrinhos expirados")
+    except Exception as e:
+        logger.error(f"Erro ao limpar carrinhos: {e}")
+
+def schema_upgrade_job(context: CallbackContext):
+    """Regrava um lote de pedidos de versões antigas do schema; sai da fila quando não resta nenhum"""
+    try:
+        upgraded = db.upgrade_records(SCHEMA_UPGRADE_BATCH)
+    except Exception as e:
+        logger.error(f"Erro ao atualizar pedidos para o schema atual: {e}")
+        return
+    if upgraded:
+        logger.info(f"Schema: {upgraded} pedidos regravados no formato atual")
+    else:
+        logger.info("Schema: todos os pedidos estão no formato atual")
+        context.job.schedule_removal()
+
+def broadcast_job(context: CallbackContext):
+    """Começa um lote do broadcast em andamento, sem esperar os envios
+
+    Ao fim do lote, o próximo é agendado com ``run_once`` no ritmo de
+    BROADCAST_RATE; com um lote ainda saindo, a chamada não faz nada.
+    """
+    bot, job_queue = context.bot, context.job_queue
+
+    def batch_done(progress, delay):
+        report_broadcast_progress(bot, progress)
+        if progress['status'] == RUNNING:
+            job_queue.run_once(broadcast_job, delay)
+
+    try:
+        progress = broadcaster.run_batch(bot, BROADCAST_INTERVAL, on_done=batch_done)
+    except Exception as e:
+        logger.error(f"Erro no envio do broadcast: {e}")
+        return
+    if progress is not None and progress['status'] != RUNNING:
+        # Concluído agora (sem lote a enviar)
+        report_broadcast_progress(bot, progress)
+
+def report_broadcast_progress(bot, progress):
+    """Atualiza o progresso na mensagem do admin, no máximo a cada BROADCAST_REPORT_INTERVAL"""
+    if not progress['report_chat_id']:
+        return
+    now = time.monotonic()
+    finished = progress['status'] != RUNNING
+    if not finished and now - _broadcast_reports.get(progress['id'], 0) < BROADCAST_REPORT_INTERVAL:
+        return
+    _broadcast_reports[progress['id']] = now
+    try:
+        with as_notification():
+            bot.edit_message_text(format_broadcast_progress(progress), chat_id=progress['report_chat_id'],
+                                  message_id=progress['report_message_id'], parse_mode="Markdown")
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            logger.warning(f"Erro ao atualizar o progresso do broadcast: {e}")
+    except Exception as e:
+        logger.warning(f"Erro ao atualizar o progresso do broadcast: {e}")
+
+def metrics_job(context: CallbackContext):
+    """Registra a ocupação do pool de handlers e da fila de envio desde a última execução"""
+    for source in context.job.context:
+        source.log_metrics()
+
+def retention_job(context: CallbackContext):
+    """Expira pedidos abandonados, descarta carrinhos, compacta os dados e relata o que foi liberado"""
+    steps = (
+        ("pedidos pendentes cancelados",
+         lambda: db.expire_pending_orders(RETENTION_PENDING_HOURS * 60 * 60) if RETENTION_PENDING_HOURS > 0 else 0),
+        ("pedidos sem pagamento apagados",
+         lambda: db.delete_orphan_orders(RETENTION_ORPHAN_DAYS * 24 * 60 * 60) if RETENTION_ORPHAN_DAYS > 0 else 0),
+        ("carrinhos expirados", db.sweep_carts),
+        ("KB liberados em disco", lambda: db.compact() // 1024),
+    )
+    report = []
+    for label, step in steps:
+        try:
+            count = step()
+        except Exception as e:
+            logger.error(f"Retenção: erro em '{label}': {e}")
+            continue
+        if count:
+            report.append(f"• {label}: {count}")
+
+    if not report:
+        logger.info("Retenção: nada a liberar")
+        return
+    logger.info("Retenção: " + "; ".join(line[2:] for line in report))
+    if ADMIN_ID:
+        try:
+            with as_notification():
+                context.bot.send_message(chat_id=ADMIN_ID, text="🧹 *Limpeza de dados*\n\n" + "\n".join(report),
+                                         parse_mode='Markdown')
+        except Exception as e:
+            logger.error(f"Erro ao enviar relatório de retenção: {e}")
+
 # MAIN BOT FUNCTION
 
 def main():
@@ -4256,30 +4398,13 @@ def main():
         # Verifica se estamos no Heroku
         is_heroku = bool(os.environ.get('DYNO'))
         
-        # Garantir que os diretórios e arquivos de dados existam
+        # Garantir que o diretório de dados exista
         data_dir = "data"
         os.makedirs(data_dir, exist_ok=True)
         
-        # Verificar arquivos de persistência
-        users_file = os.path.join(data_dir, "users.json")
-        orders_file = os.path.join(data_dir, "orders.json")
-        carts_file = os.path.join(data_dir, "carts.json")
-        
-        # Criar arquivos vazios se não existirem
-        if not os.path.exists(users_file):
-            with open(users_file, 'w', encoding='utf-8') as f:
-                json.dump({}, f)
-            logger.info(f"Arquivo {users_file} criado")
-                
-        if not os.path.exists(orders_file):
-            with open(orders_file, 'w', encoding='utf-8') as f:
-                json.dump({}, f)
-            logger.info(f"Arquivo {orders_file} criado")
-                
-        if not os.path.exists(carts_file):
-            with open(carts_file, 'w', encoding='utf-8') as f:
-                json.dump({}, f)
-            logger.info(f"Arquivo {carts_file} criado")
+        # Os arquivos de users, carts e pedidos não são criados aqui: o
+        # DataStore já lida com arquivos ausentes, e um arquivo vazio no
+        # formato de STORAGE_FORMAT esconderia os dados ainda em outro formato
     except Exception as e:
         logger.error(f"Erro durante a inicialização dos arquivos de dados: {e}")
     
@@ -4323,11 +4448,25 @@ def main():
     
     try:
         # Create the Updater and pass it your bot's token
-        updater = Updater(TOKEN, use_context=True)
+        # Com Redis, user_data e as conversas são relidos do servidor a cada update
+        persistence = RedisPersistence(redis_client, prefix=REDIS_PREFIX,
+                                       session_ttl=REDIS_SESSION_TTL) if redis_client else None
+        handler_pool = HandlerPool(DISPATCHER_WORKERS)
+        outbox = Outbox(global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST,
+                        group_per_minute=OUTBOX_GROUP_PER_MINUTE, max_retries=OUTBOX_MAX_RETRIES,
+                        senders=OUTBOX_SENDERS, caller_wait=OUTBOX_CALLER_WAIT).start()
+        # Conexões para as threads da fila, os workers, a thread do dispatcher, o polling e os jobs
+        bot = ExtBot(TOKEN, request=OutboxRequest(outbox, con_pool_size=outbox.senders + handler_pool.workers + 4))
+        updater = Updater(bot=bot, use_context=True, persistence=persistence, workers=handler_pool.workers)
         
         # Get the dispatcher to register handlers
         dp = updater.dispatcher
         
+        # Antes de tudo: um update novo do admin cancela o redesenho de menu pendente
+        dp.add_handler(TypeHandler(Update, cancel_admin_redraw), group=-1)
+        # Em outro grupo: num mesmo grupo só o primeiro handler que aceita o update roda
+        dp.add_handler(TypeHandler(Update, broadcast_mark_reachable), group=-2)
+        
         # Registration conversation handler
         registration_handler = ConversationHandler(
             entry_points=[CommandHandler('start', start)],
@@ -4338,7 +4477,9 @@ def main():
                     MessageHandler(Filters.text & ~Filters.command, handle_phone)
                 ],
             },
-            fallbacks=[CommandHandler('cancel', cancel)]
+            fallbacks=[CommandHandler('cancel', cancel)],
+            name="registration",
+            persistent=persistence is not None
         )
         dp.add_handler(registration_handler)
         
@@ -4376,7 +4517,9 @@ def main():
                     MessageHandler(Filters.text & ~Filters.command, admin_handle_edit_value)
                 ],
             },
-            fallbacks=[CommandHandler('cancel', admin_cancel)]
+            fallbacks=[CommandHandler('cancel', admin_cancel)],
+            name="admin_products",
+            persistent=persistence is not None
         )
         dp.add_handler(admin_product_conv)
         
@@ -4397,7 +4540,8 @@ def main():
         dp.add_handler(MessageHandler(Filters.regex(r'^🛒 Ver Carrinho$'), view_cart))
         dp.add_handler(CallbackQueryHandler(view_cart_callback, pattern=r'^view_cart$'))
         dp.add_handler(CallbackQueryHandler(clear_cart, pattern=r'^clear_cart$'))
-        dp.add_handler(CallbackQueryHandler(checkout, pattern=r'^checkout$'))
+        # Checkout chama process_payment, que espera o Mercado Pago
+        dp.add_handler(CallbackQueryHandler(handler_pool.wrap(checkout), pattern=r'^checkout$'))
         
         # Handler para adicionar ao carrinho
         def add_cart_handler(update, context):
@@ -4475,7 +4619,7 @@ def main():
                 item = CartItem(
                     product['name'], 
                     product['price'],
-                    {"tipo": "preço fixo", "discount": False}
+                    {"kind": "fixed", "discount": False}
                 )
                 db.add_to_cart(user_id, item.to_dict())
                 
@@ -4515,7 +4659,7 @@ def main():
         dp.add_handler(CallbackQueryHandler(add_to_cart_fixed_handler, pattern=r'^add_to_cart_fixed$'))
         
         # Payment handlers
-        dp.add_handler(CallbackQueryHandler(check_payment_status, pattern=r'^check_payment_'))
+        dp.add_handler(CallbackQueryHandler(handler_pool.wrap(check_payment_status), pattern=r'^check_payment_'))
         
         # Order handlers
         dp.add_handler(MessageHandler(Filters.regex(r'^📋 Meus Pedidos$'), list_orders))
@@ -4534,16 +4678,24 @@ def main():
             states={
                 ADMIN_AUTH: [MessageHandler(Filters.text & ~Filters.command, admin_auth_handler)],
             },
-            fallbacks=[CommandHandler('cancel', cancel)]
+            fallbacks=[CommandHandler('cancel', cancel)],
+            name="admin_auth",
+            persistent=persistence is not None
         )
         dp.add_handler(admin_auth_conv)
         
         # Admin handlers
         dp.add_handler(CommandHandler('pending', list_pending_orders))
+        dp.add_handler(CommandHandler('broadcast', broadcast_command))
+        dp.add_handler(CommandHandler('broadcast_status', broadcast_status))
+        dp.add_handler(CommandHandler('broadcast_cancel', broadcast_cancel))
+        # Montar a lista de 50 mil destinatários não segura o dispatcher
+        dp.add_handler(CallbackQueryHandler(handler_pool.wrap(broadcast_confirm),
+                                            pattern=r'^broadcast_(confirm|discard)$'))
         dp.add_handler(CallbackQueryHandler(admin_view_order, pattern=r'^admin_view_order_'))
         dp.add_handler(CallbackQueryHandler(list_pending_orders, pattern=r'^admin_back_to_pending$'))
-        dp.add_handler(CallbackQueryHandler(mark_as_delivered, pattern=r'^admin_deliver_'))
-        dp.add_handler(CallbackQueryHandler(cancel_order, pattern=r'^admin_cancel_'))
+        dp.add_handler(CallbackQueryHandler(handler_pool.wrap(mark_as_delivered), pattern=r'^admin_deliver_'))
+        dp.add_handler(CallbackQueryHandler(handler_pool.wrap(cancel_order), pattern=r'^admin_cancel_'))
         
         # General commands
         dp.add_handler(CommandHandler('help', help_command))
@@ -4554,6 +4706,24 @@ def main():
         # Error handler
         dp.add_error_handler(error_handler)
         
+        # Arquivar pedidos finalizados uma vez por dia
+        updater.job_queue.run_repeating(archive_orders_job, interval=24 * 60 * 60, first=60)
+        # Carrinhos: descartar os expirados e gravar os alterados
+        updater.job_queue.run_repeating(sweep_carts_job, interval=STORAGE_CART_SWEEP_INTERVAL,
+                                        first=STORAGE_CART_SWEEP_INTERVAL)
+        # Retenção: pedidos abandonados, carrinhos mortos e compactação
+        updater.job_queue.run_repeating(retention_job, interval=RETENTION_INTERVAL_HOURS * 60 * 60, first=5 * 60)
+        # Formato dos registros: regravar aos poucos o que ainda está numa versão antiga
+        if SCHEMA_UPGRADE_BATCH > 0:
+            updater.job_queue.run_repeating(schema_upgrade_job, interval=SCHEMA_UPGRADE_INTERVAL,
+                                            first=SCHEMA_UPGRADE_INTERVAL)
+        # Broadcast: os lotes se agendam um após o outro; este job retoma um
+        # envio interrompido (reinício, concessão vencida de outra réplica)
+        updater.job_queue.run_repeating(broadcast_job, interval=BROADCAST_INTERVAL, first=BROADCAST_INTERVAL)
+        if DISPATCHER_METRICS_INTERVAL > 0:
+            updater.job_queue.run_repeating(metrics_job, interval=DISPATCHER_METRICS_INTERVAL,
+                                            first=DISPATCHER_METRICS_INTERVAL, context=(handler_pool, outbox))
+        
         # Configura um keep-alive para o Heroku
         if keep_alive_url:
             logger.info(f"Configurando keep-alive para Heroku: {keep_alive_url}")
@@ -4570,6 +4740,20 @@ def main():
             job_queue = updater.job_queue
             job_queue.run_repeating(lambda ctx: keep_alive_ping(), interval=1200)
         
+        allowed_updates = ['message', 'callback_query', 'chat_member']
+        if WEBHOOK_URL:
+            logger.info("Starting bot webhook...")
+            webhook = WebhookServer(dp, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                                    secret_token=WEBHOOK_SECRET or derive_secret_token(TOKEN),
+                                    queue_size=WEBHOOK_QUEUE_SIZE,
+                                    metrics=lambda: {'pool': handler_pool.snapshot(), 'envio': outbox.snapshot()})
+            # Bloqueia até SIGINT/SIGTERM/SIGABRT
+            run_webhook(updater, webhook, WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, allowed_updates)
+            outbox.close()
+            db.close()
+            broadcasts.close()
+            return
+
         # Start the Bot - configurar com parâmetros mais seguros para maior estabilidade
         logger.info("Starting bot polling...")
         
@@ -4587,12 +4771,18 @@ def main():
             timeout=30,  # Este é o único timeout usado na versão 13.15
             drop_pending_updates=True, 
             poll_interval=1.0,
-            allowed_updates=['message', 'callback_query', 'chat_member']
+            allowed_updates=allowed_updates
         )
         
         # Run the bot until the user presses Ctrl-C or the process receives SIGINT/SIGTERM
         updater.idle(stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT))
         
+        # Entregar o que ainda está na fila de envio e gravar o que estiver
+        # pendente no armazenamento antes de sair
+        outbox.close()
+        db.close()
+        broadcasts.close()
+        
     except Exception as e:
         logger.error(f"Erro crítico ao iniciar o bot: {e}")
         sys.exit(1)
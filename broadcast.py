@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""Aviso para todos os usuários (broadcast), em lotes e retomável
+
+Ao criar um broadcast, a lista de destinatários é gravada inteira em
+``broadcast_deliveries``, uma linha por usuário com o estado da entrega.
+Cada chamada de ``Broadcaster.run_batch`` reserva um lote de pendentes e o
+envia em threads próprias (como notificação na fila de ``outbox``, atrás
+das respostas aos clientes); ao fim do lote o resultado de cada usuário é
+gravado e o próximo lote é agendado (``run_once``) para manter a média de
+``rate`` mensagens por segundo. Como tudo fica no banco, um reinício no
+meio de um envio para 50 mil usuários continua de onde parou.
+
+- Cada broadcast em andamento tem um dono (o processo que o envia) com
+  uma concessão de ``lease`` segundos, renovada a cada lote. Com várias
+  réplicas só uma envia; se ela morrer, outra assume quando a concessão
+  vencer.
+- Antes de enviar, o lote fica ``enviando``. Quem assume um broadcast
+  marca como ``incerto`` o que ficou nesse estado, em vez de reenviar:
+  ninguém recebe o aviso duas vezes.
+- Quem bloqueou o bot (ou apagou a conta) é marcado ``bloqueado`` e vai
+  para ``unreachable_users``, que fica de fora dos próximos broadcasts
+  até o usuário falar com o bot de novo (``mark_reachable``). O cadastro
+  em si continua, para o histórico de pedidos.
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from outbox import as_notification, until_sent
+
+try:
+    from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut, Unauthorized
+except ImportError:
+    # Só o BroadcastStore pode ser usado sem o python-telegram-bot
+    BadRequest = NetworkError = RetryAfter = TelegramError = TimedOut = Unauthorized = None
+
+logger = logging.getLogger('bot.broadcast')
+
+# Estados do broadcast
+RUNNING = "enviando"
+DONE = "concluido"
+CANCELLED = "cancelado"
+
+# Estados de cada entrega
+PENDING = "pendente"
+SENDING = "enviando"
+SENT = "enviado"
+BLOCKED = "bloqueado"
+FAILED = "falhou"
+# O envio pode ter chegado ou não (timeout, ou o processo parou no meio)
+UNKNOWN = "incerto"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    parse_mode TEXT,
+    created_by INTEGER,
+    created_ts REAL NOT NULL,
+    finished_ts REAL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    report_chat_id INTEGER,
+    report_message_id INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    ts REAL,
+    PRIMARY KEY (broadcast_id, user_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_deliveries_status ON broadcast_deliveries(broadcast_id, status, user_id);
+
+CREATE TABLE IF NOT EXISTS unreachable_users (
+    user_id INTEGER PRIMARY KEY,
+    reason TEXT,
+    since REAL NOT NULL
+);
+"""
+
+BROADCAST_COLUMNS = ("id", "text", "parse_mode", "created_by", "created_ts", "finished_ts", "status", "total",
+                     "owner", "lease_until", "report_chat_id", "report_message_id")
+
+class BroadcastStore:
+    """Broadcasts, estado de entrega por usuário e usuários inalcançáveis, em SQLite
+
+    Pode usar o mesmo arquivo do ``sqlite_store.SQLiteDataStore`` (as tabelas
+    não se misturam) para que todas as réplicas vejam o mesmo estado.
+    ``clock`` (epoch em segundos) marca as entregas e vence as concessões;
+    testes podem passar um relógio próprio.
+    """
+
+    def __init__(self, path, busy_timeout=5.0, clock=time.time):
+        self.path = path
+        self._clock = clock
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        # Cópia em memória para mark_reachable não ir ao banco a cada update
+        self._unreachable = {row[0] for row in self.conn.execute("SELECT user_id FROM unreachable_users")}
+
+    def _write(self, func):
+        """Executa ``func(cursor)`` numa transação ``BEGIN IMMEDIATE`` (ver ``SQLiteDataStore._write``)"""
+        with self._lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                result = func(cursor)
+                cursor.execute("COMMIT")
+                return result
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    # BROADCASTS
+
+    def create(self, text, user_ids, created_by=None, parse_mode=None):
+        """Cria um broadcast para ``user_ids`` (menos os inalcançáveis) e devolve o ID"""
+        def create(cursor):
+            unreachable = {row[0] for row in cursor.execute("SELECT user_id FROM unreachable_users")}
+            cursor.execute(
+                "INSERT INTO broadcasts (text, parse_mode, created_by, created_ts, status) VALUES (?, ?, ?, ?, ?)",
+                (text, parse_mode, created_by, self._clock(), RUNNING)
+            )
+            broadcast_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status) VALUES (?, ?, ?)",
+                ((broadcast_id, user_id, PENDING) for user_id in user_ids if user_id not in unreachable)
+            )
+            total = cursor.execute("SELECT COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ?",
+                                   (broadcast_id,)).fetchone()[0]
+            cursor.execute("UPDATE broadcasts SET total = ? WHERE id = ?", (total, broadcast_id))
+            return broadcast_id
+        broadcast_id = self._write(create)
+        logger.info(f"Broadcast #{broadcast_id} criado")
+        return broadcast_id
+
+    def get(self, broadcast_id):
+        rows = self._query(f"SELECT {', '.join(BROADCAST_COLUMNS)} FROM broadcasts WHERE id = ?", (broadcast_id,))
+        return dict(zip(BROADCAST_COLUMNS, rows[0])) if rows else None
+
+    def latest(self):
+        """O broadcast em andamento ou, sem nenhum, o mais recente"""
+        rows = self._query("SELECT id FROM broadcasts ORDER BY status = ? DESC, id DESC LIMIT 1", (RUNNING,))
+        return self.get(rows[0][0]) if rows else None
+
+    def running(self):
+        rows = self._query("SELECT id FROM broadcasts WHERE status = ? ORDER BY id LIMIT 1", (RUNNING,))
+        return self.get(rows[0][0]) if rows else None
+
+    def set_report_message(self, broadcast_id, chat_id, message_id):
+        """Mensagem do admin em que o progresso do broadcast é atualizado"""
+        self._write(lambda cursor: cursor.execute(
+            "UPDATE broadcasts SET report_chat_id = ?, report_message_id = ? WHERE id = ?",
+            (chat_id, message_id, broadcast_id)
+        ))
+
+    def cancel(self, broadcast_id):
+        """Interrompe o broadcast; os pendentes ficam como estão. Devolve se ele estava em andamento"""
+        return self._write(lambda cursor: cursor.execute(
+            "UPDATE broadcasts SET status = ?, finished_ts = ? WHERE id = ? AND status = ?",
+            (CANCELLED, self._clock(), broadcast_id, RUNNING)
+        ).rowcount) > 0
+
+    def progress(self, broadcast_id):
+        """O broadcast com a contagem de entregas por estado"""
+        broadcast = self.get(broadcast_id)
+        if broadcast is None:
+            return None
+        counts = dict(self._query(
+            "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? GROUP BY status",
+            (broadcast_id,)
+        ))
+        broadcast['counts'] = {status: counts.get(status, 0)
+                               for status in (PENDING, SENDING, SENT, BLOCKED, FAILED, UNKNOWN)}
+        return broadcast
+
+    # LOTES (Broadcaster)
+
+    def claim(self, owner, lease):
+        """Assume o broadcast em andamento, se for de ``owner`` ou a concessão do dono tiver vencido"""
+        def claim(cursor):
+            now = self._clock()
+            row = cursor.execute(
+                "SELECT id, owner FROM broadcasts WHERE status = ? AND (owner IS NULL OR owner = ? OR lease_until < ?) "
+                "ORDER BY id LIMIT 1",
+                (RUNNING, owner, now)
+            ).fetchone()
+            if row is None:
+                return None
+            broadcast_id, previous = row
+            if previous not in (None, owner):
+                # O lote que o dono anterior tinha em mãos pode ter saído ou não
+                lost = cursor.execute(
+                    "UPDATE broadcast_deliveries SET status = ?, ts = ? WHERE broadcast_id = ? AND status = ?",
+                    (UNKNOWN, now, broadcast_id, SENDING)
+                ).rowcount
+                logger.warning(f"Broadcast #{broadcast_id} assumido de {previous}; {lost} entregas incertas")
+            cursor.execute("UPDATE broadcasts SET owner = ?, lease_until = ? WHERE id = ?",
+                           (owner, now + lease, broadcast_id))
+            return broadcast_id
+        broadcast_id = self._write(claim)
+        return self.get(broadcast_id) if broadcast_id is not None else None
+
+    def take_batch(self, broadcast_id, owner, limit, lease):
+        """Marca até ``limit`` entregas pendentes como ``enviando`` e renova a concessão
+
+        Devolve None se o broadcast não é mais de ``owner`` (cancelado ou assumido).
+        """
+        def take(cursor):
+            now = self._clock()
+            renewed = cursor.execute(
+                "UPDATE broadcasts SET lease_until = ? WHERE id = ? AND owner = ? AND status = ?",
+                (now + lease, broadcast_id, owner, RUNNING)
+            ).rowcount
+            if not renewed:
+                return None
+            user_ids = [row[0] for row in cursor.execute(
+                "SELECT user_id FROM broadcast_deliveries WHERE broadcast_id = ? AND status = ? "
+                "ORDER BY user_id LIMIT ?",
+                (broadcast_id, PENDING, limit)
+            )]
+            cursor.executemany(
+                "UPDATE broadcast_deliveries SET status = ?, ts = ? WHERE broadcast_id = ? AND user_id = ?",
+                ((SENDING, now, broadcast_id, user_id) for user_id in user_ids)
+            )
+            return user_ids
+        return self._write(take)
+
+    def record(self, broadcast_id, results):
+        """Grava os resultados [(user_id, estado, erro)] de um lote; bloqueados viram inalcançáveis"""
+        if not results:
+            return
+        def record(cursor):
+            now = self._clock()
+            cursor.executemany(
+                "UPDATE broadcast_deliveries SET status = ?, error = ?, ts = ? "
+                "WHERE broadcast_id = ? AND user_id = ? AND status IN (?, ?)",
+                ((status, error, now, broadcast_id, user_id, SENDING, UNKNOWN) for user_id, status, error in results)
+            )
+            cursor.executemany(
+                "INSERT OR REPLACE INTO unreachable_users (user_id, reason, since) VALUES (?, ?, ?)",
+                ((user_id, error, now) for user_id, status, error in results if status == BLOCKED)
+            )
+        self._write(record)
+        with self._lock:
+            self._unreachable.update(user_id for user_id, status, _ in results if status == BLOCKED)
+
+    def release(self, broadcast_id, user_ids):
+        """Devolve a ``pendente`` as entregas de um lote que não chegaram a ser tentadas"""
+        if not user_ids:
+            return
+        self._write(lambda cursor: cursor.executemany(
+            "UPDATE broadcast_deliveries SET status = ? WHERE broadcast_id = ? AND user_id = ? AND status = ?",
+            ((PENDING, broadcast_id, user_id, SENDING) for user_id in user_ids)
+        ))
+
+    def finish(self, broadcast_id, owner):
+        """Encerra o broadcast de ``owner`` se não restar entrega pendente"""
+        return self._write(lambda cursor: cursor.execute(
+            "UPDATE broadcasts SET status = ?, finished_ts = ?, owner = NULL WHERE id = ? AND owner = ? "
+            "AND status = ? AND NOT EXISTS (SELECT 1 FROM broadcast_deliveries "
+            "WHERE broadcast_id = ? AND status IN (?, ?))",
+            (DONE, self._clock(), broadcast_id, owner, RUNNING, broadcast_id, PENDING, SENDING)
+        ).rowcount) > 0
+
+    # USUÁRIOS INALCANÇÁVEIS
+
+    def is_unreachable(self, user_id):
+        return user_id in self._unreachable
+
+    def unreachable_count(self):
+        return len(self._unreachable)
+
+    def mark_reachable(self, user_id):
+        """O usuário falou com o bot: volta a receber broadcasts"""
+        if user_id not in self._unreachable:
+            return False
+        self._write(lambda cursor: cursor.execute("DELETE FROM unreachable_users WHERE user_id = ?", (user_id,)))
+        with self._lock:
+            self._unreachable.discard(user_id)
+        return True
+
+class Broadcaster:
+    """Envia o broadcast em andamento, um lote por chamada de ``run_batch``
+
+        broadcaster = Broadcaster(BroadcastStore("data/bot.db"), rate=20)
+
+        def broadcast_job(context):
+            broadcaster.run_batch(context.bot, 1.0, on_done=lambda progress, delay:
+                                  context.job_queue.run_once(broadcast_job, delay))
+
+    ``run_batch`` só reserva o lote e o entrega a ``concurrency`` threads de
+    envio: volta na hora, sem ocupar a thread do JobQueue enquanto o lote
+    sai. Quando o último envio termina, ``on_done(progresso, espera)`` é
+    chamado nessa thread, com a espera que mantém a média de ``rate`` envios
+    por segundo até o próximo lote; quem chama agenda o próximo com ela. Um
+    ``run_repeating`` de fundo pode chamar ``run_batch`` também (para
+    retomar um broadcast): com um lote em andamento a chamada não faz nada.
+
+    ``owner`` identifica o processo (host, pid e um sufixo aleatório), então
+    depois de um reinício o envio é retomado quando a concessão anterior
+    (``lease`` segundos) vence.
+    """
+
+    def __init__(self, store, rate=20.0, lease=60.0, owner=None, concurrency=4):
+        self.store = store
+        self.rate = rate
+        self.lease = lease
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="broadcast")
+        self._lock = threading.Lock()
+        self._in_flight = False
+
+    def run_batch(self, bot, budget, on_done=None):
+        """Começa a enviar um lote de até ``rate * budget`` usuários, sem esperá-lo
+
+        Returns:
+            o progresso do broadcast, ou None sem broadcast em andamento (ou
+            com um lote deste processo ainda saindo). ``on_done`` só é chamado
+            se um lote começou
+        """
+        with self._lock:
+            if self._in_flight:
+                return None
+            self._in_flight = True
+        started = False
+        try:
+            broadcast = self.store.claim(self.owner, self.lease)
+            if broadcast is None:
+                return None
+            broadcast_id = broadcast['id']
+            user_ids = self.store.take_batch(broadcast_id, self.owner, max(1, int(self.rate * budget)), self.lease)
+            if not user_ids:
+                if user_ids is not None and self.store.finish(broadcast_id, self.owner):
+                    logger.info(f"Broadcast #{broadcast_id} concluído")
+                return self.store.progress(broadcast_id)
+
+            batch_started = time.monotonic()
+            futures = []
+            try:
+                for user_id in user_ids:
+                    futures.append((user_id, self._executor.submit(self._send, bot, broadcast, user_id)))
+            except Exception:
+                # Executor encerrado: o que não foi submetido volta a pendente
+                self.store.release(broadcast_id, user_ids[len(futures):])
+                if not futures:
+                    raise
+            remaining = [len(futures)]
+
+            def sent(_):
+                with self._lock:
+                    remaining[0] -= 1
+                    last = not remaining[0]
+                if last:
+                    self._finish_batch(broadcast_id, futures, batch_started, on_done)
+
+            for _, future in futures:
+                future.add_done_callback(sent)
+            started = True
+            return self.store.progress(broadcast_id)
+        finally:
+            if not started:
+                with self._lock:
+                    self._in_flight = False
+
+    def _finish_batch(self, broadcast_id, futures, batch_started, on_done):
+        """Grava os resultados do lote e avisa ``on_done`` (na thread do último envio)"""
+        try:
+            results = []
+            retry = []
+            paused = None
+            for user_id, future in futures:
+                try:
+                    status, error = future.result()
+                except Exception as e:
+                    status, error = FAILED, str(e)
+                if status is None:
+                    retry.append(user_id)
+                    paused = error
+                else:
+                    results.append((user_id, status, error))
+            self.store.record(broadcast_id, results)
+            self.store.release(broadcast_id, retry)
+            if paused:
+                # Sem rede ou limite do Telegram: esses ficam para o próximo lote
+                logger.warning(f"Broadcast #{broadcast_id}: {len(retry)} envios adiados: {paused}")
+            progress = self.store.progress(broadcast_id)
+        except Exception as e:
+            logger.error(f"Erro ao gravar o lote do broadcast #{broadcast_id}: {e}")
+            progress = None
+        finally:
+            with self._lock:
+                self._in_flight = False
+        if on_done is not None and progress is not None:
+            # Ritmo médio de ``rate`` por segundo: o próximo lote começa depois
+            # do tempo que este lote "deveria" ter levado
+            delay = max(0.0, batch_started + len(futures) / self.rate - time.monotonic())
+            try:
+                on_done(progress, delay)
+            except Exception as e:
+                logger.error(f"Erro ao agendar o próximo lote do broadcast #{broadcast_id}: {e}")
+
+    def _send(self, bot, broadcast, user_id):
+        """Devolve (estado, erro); estado None se o envio deve ser tentado de novo depois"""
+        try:
+            # O estado da entrega depende da resposta: esperar o envio, mesmo com 429
+            with as_notification(), until_sent():
+                bot.send_message(chat_id=user_id, text=broadcast['text'], parse_mode=broadcast['parse_mode'],
+                                 disable_web_page_preview=True)
+            return SENT, None
+        except Unauthorized as e:
+            # Bloqueou o bot ou apagou a conta
+            return BLOCKED, str(e)
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return BLOCKED, str(e)
+            return FAILED, str(e)
+        except TimedOut as e:
+            return UNKNOWN, str(e)
+        except (NetworkError, RetryAfter) as e:
+            return None, str(e)
+        except TelegramError as e:
+            return FAILED, str(e)
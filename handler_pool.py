@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Handlers que esperam rede rodando no pool ``run_async`` do dispatcher
+
+O dispatcher do python-telegram-bot processa os updates um por vez numa
+única thread: um handler que espera o Mercado Pago ou a API do Telegram
+segura todos os outros clientes atrás dele. ``HandlerPool.wrap`` manda o
+callback para o pool de workers do dispatcher (``Updater(workers=...)``) e
+devolve a ``Promise`` na hora, o que o ``ConversationHandler`` também aceita
+como próximo estado.
+
+Cada usuário tem no máximo uma chamada de cada callback no pool: dois
+toques seguidos em "Finalizar compra" não podem ler o mesmo carrinho em
+paralelo e gerar dois pedidos. O segundo toque é recusado ainda na thread
+do dispatcher, com um aviso de "já processando", em vez de ocupar um
+worker esperando o primeiro; assim um usuário insistente não prende os
+workers dos outros. Callbacks diferentes do mesmo usuário (conferir o
+pagamento enquanto cancela outro pedido) e usuários diferentes rodam em
+paralelo.
+
+O wrapper ainda mede o pool: quantos callbacks estão rodando, quantos
+esperam um worker livre e quanto tempo esperaram. ``snapshot`` devolve
+esses números (e zera os máximos da janela, se pedido).
+"""
+
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger('bot.pool')
+
+class HandlerPool:
+    """Envia callbacks ao pool do dispatcher e acompanha a saturação
+
+        pool = HandlerPool(workers=8)
+        updater = Updater(TOKEN, use_context=True, workers=pool.workers)
+        dp.add_handler(CallbackQueryHandler(pool.wrap(checkout), pattern=r'^checkout$'))
+
+    Só o que passa por ``wrap`` entra nas contas; outras chamadas a
+    ``dispatcher.run_async`` dividem os mesmos workers sem aparecer aqui.
+    """
+
+    BUSY_TEXT = "⏳ Ainda estou processando sua solicitação anterior. Aguarde um instante."
+
+    def __init__(self, workers, busy_text=BUSY_TEXT):
+        if workers < 1:
+            raise ValueError("O pool precisa de pelo menos um worker")
+        self.workers = workers
+        self.busy_text = busy_text
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.queued = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        # (user_id, callback) na fila ou rodando
+        self._active = set()
+        self._window = self._new_window()
+
+    @staticmethod
+    def _new_window():
+        return {'max_busy': 0, 'max_queued': 0, 'max_wait': 0.0, 'total_wait': 0.0, 'started': 0,
+                'saturated': 0}
+
+    def wrap(self, callback):
+        """Callback de handler que roda ``callback`` num worker do dispatcher"""
+        @functools.wraps(callback)
+        def submit(update, context):
+            user = update.effective_user if update is not None else None
+            # Sem usuário (ex.: updates de canal) não há toque repetido a barrar
+            slot = (user.id, callback) if user is not None else None
+            submitted_at = time.monotonic()
+            with self._lock:
+                rejected = slot in self._active
+                if rejected:
+                    self.rejected += 1
+                else:
+                    if slot is not None:
+                        self._active.add(slot)
+                    self.queued += 1
+                    self.submitted += 1
+                    window = self._window
+                    window['max_queued'] = max(window['max_queued'], self.queued)
+            if rejected:
+                self._reply_busy(update)
+                # None mantém o estado da conversa: o usuário pode tentar de novo
+                return None
+            try:
+                return context.dispatcher.run_async(self._run, callback, submitted_at, slot, update, context,
+                                                    update=update)
+            except Exception:
+                with self._lock:
+                    self.queued -= 1
+                    self._active.discard(slot)
+                raise
+        return submit
+
+    def _reply_busy(self, update):
+        try:
+            if update.callback_query:
+                update.callback_query.answer(self.busy_text)
+            elif update.effective_message:
+                update.effective_message.reply_text(self.busy_text)
+        except Exception as e:
+            logger.warning(f"Não foi possível avisar que a solicitação anterior ainda roda: {e}")
+
+    def _run(self, callback, submitted_at, slot, update, context):
+        wait = time.monotonic() - submitted_at
+        with self._lock:
+            self.queued -= 1
+            self.busy += 1
+            window = self._window
+            window['started'] += 1
+            window['total_wait'] += wait
+            window['max_wait'] = max(window['max_wait'], wait)
+            window['max_busy'] = max(window['max_busy'], self.busy)
+            if self.busy >= self.workers:
+                window['saturated'] += 1
+        failed = True
+        try:
+            result = callback(update, context)
+            failed = False
+            return result
+        finally:
+            with self._lock:
+                self._active.discard(slot)
+                self.busy -= 1
+                self.completed += 1
+                if failed:
+                    self.failed += 1
+
+    def snapshot(self, reset=False):
+        """Ocupação atual do pool e os máximos desde o último ``reset``
+
+        ``saturacao`` é a fração dos workers ocupada agora; ``saturados`` conta
+        os callbacks que, ao começar, ocuparam o último worker livre;
+        ``recusados``, os toques repetidos de quem já tinha o mesmo callback
+        no pool.
+        """
+        with self._lock:
+            window = dict(self._window)
+            if reset:
+                self._window = self._new_window()
+            busy, queued = self.busy, self.queued
+            totals = {'enviados': self.submitted, 'concluidos': self.completed, 'falhas': self.failed,
+                      'recusados': self.rejected}
+        started = window['started']
+        return {
+            'workers': self.workers,
+            'ocupados': busy,
+            'na_fila': queued,
+            'saturacao': round(busy / self.workers, 2),
+            'ocupados_max': window['max_busy'],
+            'na_fila_max': window['max_queued'],
+            'saturados': window['saturated'],
+            'espera_media_ms': round(window['total_wait'] / started * 1000, 1) if started else 0.0,
+            'espera_max_ms': round(window['max_wait'] * 1000, 1),
+            **totals,
+        }
+
+    def log_metrics(self):
+        """Registra a janela atual no log e a zera
+
+        Vira aviso quando o pool chegou a ficar sem worker livre na janela.
+        """
+        stats = self.snapshot(reset=True)
+        if stats['saturados']:
+            logger.warning(f"Pool de handlers saturado: {stats}")
+        elif stats['ocupados_max']:
+            logger.info(f"Pool de handlers: {stats}")
+        return stats
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+"""Manutenção offline dos dados do bot
+
+Opera sobre ``data/`` (arquivos) ou sobre o banco SQLite sem subir o bot.
+Com o backend de arquivos o bot precisa estar parado: o ``DataStore`` trava
+``data_dir/.lock`` e os comandos que gravam falham se ele estiver rodando.
+
+Uso:
+    python maintenance.py verify data            # ou data/bot.db
+    python maintenance.py compact data
+    python maintenance.py reindex data
+    python maintenance.py upgrade data
+    python maintenance.py migrate data data/bot.db [--restart]
+    python maintenance.py migrate data/bot.db data_exportado
+    python maintenance.py export data --status pago --since 2025-01-01 --until 2025-02-01 -o pagos.csv
+
+Os pedidos são lidos em streaming (um por vez do orders.jsonl, uma
+partição do arquivo morto por vez, páginas do SQLite): a memória usada
+cresce com o número de pedidos só pelo índice de offsets, não com o tamanho
+do histórico. Usuários e carrinhos, bem menores, são carregados inteiros.
+A migração de arquivos para o SQLite fica em ``migration.py``: é retomável
+e confere o banco com a origem no fim.
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+from serializers import DEFAULT_SERIALIZER, SERIALIZERS, detect_serializer, find_data_file, get_serializer
+from migration import JsonToSqliteMigrator
+from sqlite_store import SQLiteDataStore
+from storage import ORDER_STATUSES, SCHEMA_VERSION, DataStore, record_created_ts
+
+logger = logging.getLogger('bot.maintenance')
+
+# Exemplos mostrados por tipo de problema (todos são contados)
+MAX_EXAMPLES = 20
+
+def is_sqlite(path):
+    return os.path.isfile(path)
+
+def open_store(path, read_only=False):
+    """DataStore para um diretório de dados, SQLiteDataStore para um arquivo .db
+
+    O journal, se existir, é reaplicado (e, se não for só leitura, gravado).
+    """
+    if is_sqlite(path):
+        return SQLiteDataStore(path)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"{path} não é um diretório de dados nem um banco SQLite")
+    journal = any(os.path.exists(os.path.join(path, name)) for name in ("journal.log", "journal.log.1"))
+    return DataStore(path, journal=journal, read_only=read_only)
+
+def iter_all_orders(store):
+    """Todos os pedidos, ativos e arquivados, um por vez"""
+    if isinstance(store, SQLiteDataStore):
+        yield from store.iter_orders_between()
+        return
+    for order_id in store.orders:
+        yield store.orders[order_id]
+    for order in store.iter_archived_orders():
+        if order.id not in store.orders:
+            yield order
+
+# VERIFY
+
+class Report:
+    """Problemas encontrados, contados por tipo, com alguns exemplos de cada"""
+
+    def __init__(self):
+        self.errors = Counter()
+        self.warnings = Counter()
+        self.examples = {}
+        self.stats = Counter()
+
+    def _add(self, counter, kind, detail):
+        counter[kind] += 1
+        examples = self.examples.setdefault(kind, [])
+        if len(examples) < MAX_EXAMPLES:
+            examples.append(detail)
+
+    def error(self, kind, detail):
+        self._add(self.errors, kind, detail)
+
+    def warning(self, kind, detail):
+        self._add(self.warnings, kind, detail)
+
+    def print(self, out=sys.stdout):
+        for name, value in sorted(self.stats.items()):
+            print(f"{name}: {value}", file=out)
+        for label, counter in (("ERRO", self.errors), ("AVISO", self.warnings)):
+            for kind, count in counter.most_common():
+                print(f"{label} {kind}: {count}", file=out)
+                for detail in self.examples[kind]:
+                    print(f"    {detail}", file=out)
+        if not self.errors and not self.warnings:
+            print("Nenhum problema encontrado", file=out)
+
+def _check_items(report, where, items):
+    if not isinstance(items, list):
+        report.error("itens não são uma lista", where)
+        return
+    for position, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get('name'), str):
+            report.error("item sem nome", f"{where} item {position}")
+        elif not isinstance(item.get('price'), (int, float)) or isinstance(item.get('price'), bool):
+            report.error("item com preço inválido", f"{where} item {position}: {item.get('price')!r}")
+
+def verify_json(data_dir):
+    report = Report()
+
+    user_ids = set()
+    users_file = find_data_file(data_dir, "users")
+    if users_file:
+        for user_id, data in detect_serializer(users_file).iter_items(users_file):
+            try:
+                user_ids.add(int(user_id))
+            except ValueError:
+                report.error("ID de usuário inválido", f"{users_file}: {user_id!r}")
+            if not isinstance(data, dict) or 'nome' not in data or 'telefone' not in data:
+                report.error("usuário incompleto", f"{users_file}: {user_id}")
+    report.stats['usuários'] = len(user_ids)
+
+    # Só o essencial da última versão de cada pedido: (user_id, payment_id, versão do schema)
+    latest = {}
+    orders_file = os.path.join(data_dir, "orders.jsonl")
+    if os.path.exists(orders_file):
+        versions = 0
+        with open(orders_file, 'rb') as f:
+            offset = 0
+            for line in f:
+                where = f"orders.jsonl byte {offset}"
+                offset += len(line)
+                versions += 1
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("linha incompleta")
+                    data = json.loads(line)
+                except ValueError as e:
+                    # Uma última linha cortada é o resultado esperado de uma queda
+                    if offset == os.path.getsize(orders_file):
+                        report.warning("última linha incompleta (descartada na próxima carga)", where)
+                    else:
+                        report.error("linha inválida", f"{where}: {e}")
+                    continue
+                if not isinstance(data, dict) or not isinstance(data.get('id'), str):
+                    report.error("pedido sem id", where)
+                    continue
+                if data.get('deleted'):
+                    latest.pop(data['id'], None)
+                    continue
+                where = f"pedido {data['id']}"
+                if not isinstance(data.get('user_id'), int):
+                    report.error("pedido sem user_id", where)
+                if data.get('status') not in ORDER_STATUSES:
+                    report.error("status desconhecido", f"{where}: {data.get('status')!r}")
+                if not record_created_ts(data):
+                    report.warning("pedido sem data de criação", where)
+                if data.get('v', 0) > SCHEMA_VERSION:
+                    report.error("pedido gravado por uma versão mais nova do bot", f"{where}: v{data['v']}")
+                _check_items(report, where, data.get('items'))
+                latest[data['id']] = (data.get('user_id'), data.get('payment_id'), data.get('v', 0))
+        report.stats['pedidos ativos'] = len(latest)
+        report.stats['versões obsoletas em orders.jsonl'] = versions - len(latest)
+        report.stats['pedidos a atualizar (schema)'] = sum(1 for _, _, version in latest.values()
+                                                         if version < SCHEMA_VERSION)
+    if os.path.exists(os.path.join(data_dir, "orders.json")):
+        report.warning("orders.json antigo ainda presente", "convertido na próxima carga se orders.jsonl não existir")
+
+    payments = {}
+    for order_id, (user_id, payment_id, _) in latest.items():
+        if user_ids and user_id not in user_ids:
+            report.warning("pedido de usuário não cadastrado", f"pedido {order_id}: usuário {user_id}")
+        if payment_id is not None:
+            other = payments.setdefault(str(payment_id), order_id)
+            if other != order_id:
+                report.error("payment_id em mais de um pedido", f"{payment_id}: {other}, {order_id}")
+
+    carts_file = find_data_file(data_dir, "carts")
+    if carts_file:
+        carts = 0
+        for user_id, cart in detect_serializer(carts_file).iter_items(carts_file):
+            carts += 1
+            items = cart if isinstance(cart, list) else cart.get('items') if isinstance(cart, dict) else None
+            _check_items(report, f"carrinho {user_id}", items)
+        report.stats['carrinhos'] = carts
+
+    _verify_archive(report, data_dir, latest)
+    for name in ("journal.log", "journal.log.1"):
+        _verify_journal(report, os.path.join(data_dir, name))
+    return report
+
+def _verify_archive(report, data_dir, active):
+    archive_dir = os.path.join(data_dir, "archive")
+    index_file = os.path.join(archive_dir, "index.json")
+    if not os.path.exists(index_file):
+        return
+    by_month = {}
+    with open(index_file, 'r', encoding='utf-8') as f:
+        for order_id, (month, _) in json.load(f).items():
+            by_month.setdefault(month, set()).add(order_id)
+    archived = 0
+    for month, order_ids in sorted(by_month.items()):
+        path = os.path.join(archive_dir, f"orders-{month}.json.gz")
+        if not os.path.exists(path):
+            report.error("partição do arquivo morto ausente", f"{path} ({len(order_ids)} pedidos)")
+            continue
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            partition = json.load(f)
+        for order_id in order_ids - partition.keys():
+            report.error("pedido indexado fora da partição", f"{order_id} em {month}")
+        for order_id in order_ids & partition.keys():
+            _check_items(report, f"arquivado {order_id}", partition[order_id].get('items'))
+            if order_id in active:
+                report.warning("pedido ativo e arquivado", order_id)
+        archived += len(order_ids)
+    report.stats['pedidos arquivados'] = archived
+
+def _verify_journal(report, path):
+    if not os.path.exists(path):
+        return
+    size = os.path.getsize(path)
+    records = 0
+    with open(path, 'rb') as f:
+        offset = 0
+        for line in f:
+            offset += len(line)
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if record.get('op') not in ('user', 'cart', 'order', 'status', 'delete'):
+                    raise ValueError(f"operação desconhecida {record.get('op')!r}")
+                records += 1
+            except ValueError as e:
+                if offset == size:
+                    report.warning("registro final do journal incompleto", path)
+                else:
+                    report.error("registro do journal inválido", f"{path} byte {offset - len(line)}: {e}")
+    report.stats[f"registros em {os.path.basename(path)}"] = records
+
+def verify_sqlite(path):
+    report = Report()
+    store = SQLiteDataStore(path)
+    try:
+        def query(sql, params=()):
+            return store.conn.execute(sql, params).fetchall()
+
+        for (result,) in query("PRAGMA integrity_check"):
+            if result != "ok":
+                report.error("integrity_check", result)
+        for table, rowid, parent, _ in query("PRAGMA foreign_key_check"):
+            report.error("chave estrangeira quebrada", f"{table} rowid {rowid} -> {parent}")
+        for (order_id,) in query("SELECT id FROM orders o WHERE NOT EXISTS "
+                                 "(SELECT 1 FROM order_items i WHERE i.order_id = o.id)"):
+            report.warning("pedido sem itens", order_id)
+        placeholders = ",".join("?" * len(ORDER_STATUSES))
+        for order_id, status in query(f"SELECT id, status FROM orders WHERE status NOT IN ({placeholders})",
+                                      ORDER_STATUSES):
+            report.error("status desconhecido", f"pedido {order_id}: {status!r}")
+        for payment_id, count in query("SELECT payment_id, COUNT(*) FROM orders WHERE payment_id IS NOT NULL "
+                                       "GROUP BY payment_id HAVING COUNT(*) > 1"):
+            report.error("payment_id em mais de um pedido", f"{payment_id}: {count} pedidos")
+        for (order_id,) in query("SELECT id FROM orders WHERE created_ts = 0"):
+            report.warning("pedido sem data de criação", order_id)
+        for (order_id, user_id) in query("SELECT id, user_id FROM orders o WHERE NOT EXISTS "
+                                         "(SELECT 1 FROM users u WHERE u.id = o.user_id)"):
+            report.warning("pedido de usuário não cadastrado", f"pedido {order_id}: usuário {user_id}")
+        for table, label in (("users", "usuários"), ("orders", "pedidos"), ("carts", "carrinhos")):
+            report.stats[label] = query(f"SELECT COUNT(*) FROM {table}")[0][0]
+        report.stats['pedidos a atualizar (schema)'] = query("SELECT COUNT(*) FROM orders WHERE schema_version < ?",
+                                                             (SCHEMA_VERSION,))[0][0]
+    finally:
+        store.close()
+    return report
+
+# COMPACT / REINDEX / UPGRADE
+
+def compact(path):
+    store = open_store(path)
+    try:
+        return store.compact()
+    finally:
+        store.close()
+
+def reindex(path):
+    """Refaz o índice do arquivo morto (arquivos) ou os índices do banco (SQLite)"""
+    if is_sqlite(path):
+        store = SQLiteDataStore(path)
+        try:
+            store.conn.execute("REINDEX")
+            store.conn.execute("ANALYZE")
+        finally:
+            store.close()
+        return None
+    store = open_store(path)
+    try:
+        return store.rebuild_archive_index()
+    finally:
+        store.close()
+
+def upgrade(path, batch_size=10000):
+    """Regrava no formato atual todos os pedidos de versões antigas do schema
+
+    O bot faz o mesmo aos poucos em segundo plano; isto é para fazê-lo de uma vez.
+
+    Returns:
+        int: quantidade de pedidos regravados
+    """
+    store = open_store(path)
+    try:
+        upgraded = 0
+        while True:
+            count = store.upgrade_records(batch_size)
+            if not count:
+                return upgraded
+            upgraded += count
+    finally:
+        store.close()
+
+# MIGRATE
+
+def migrate_sqlite_to_json(sqlite_path, data_dir, serializer=DEFAULT_SERIALIZER):
+    """Grava o conteúdo do banco num diretório de dados novo
+
+    Returns:
+        dict: quantidade copiada por coleção
+    """
+    serializer = get_serializer(serializer)
+    orders_file = os.path.join(data_dir, "orders.jsonl")
+    if os.path.exists(orders_file):
+        raise FileExistsError(f"{orders_file} já existe; use um diretório vazio")
+    os.makedirs(data_dir, exist_ok=True)
+    source = SQLiteDataStore(sqlite_path)
+    try:
+        users = {str(user.id): user.to_dict() for user in source.iter_users()}
+        serializer.dump(os.path.join(data_dir, "users" + serializer.extension), users, fsync=True)
+        carts = {str(user_id): {'items': [item.to_dict() for item in items], 'touched': touched}
+                 for user_id, items, touched in source.iter_carts()}
+        serializer.dump(os.path.join(data_dir, "carts" + serializer.extension), carts, fsync=True)
+        orders = 0
+        tmp_path = orders_file + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for order in source.iter_orders_between():
+                f.write(json.dumps(order.to_dict(), ensure_ascii=False, separators=(',', ':')) + "\n")
+                orders += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, orders_file)
+    finally:
+        source.close()
+    return {'usuários': len(users), 'carrinhos': len(carts), 'pedidos': orders}
+
+# EXPORT
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").timestamp() if value else None
+
+def iter_export(store, statuses=None, user_id=None, start_ts=None, end_ts=None, include_archived=False):
+    """Pedidos que passam pelos filtros, um por vez"""
+    if user_id is not None:
+        candidates = iter(store.get_user_orders(user_id))
+    elif include_archived and isinstance(store, DataStore):
+        # Partição por partição, e não o período inteiro ordenado em memória
+        candidates = iter_all_orders(store)
+    else:
+        candidates = store.iter_orders_between(start_ts, end_ts)
+    for order in candidates:
+        if statuses and order.status not in statuses:
+            continue
+        if start_ts is not None and order.created_ts < start_ts:
+            continue
+        if end_ts is not None and order.created_ts >= end_ts:
+            continue
+        yield order
+
+CSV_FIELDS = ("id", "user_id", "status", "payment_id", "created_at", "itens", "total")
+
+def export_orders(orders, out, output_format="jsonl"):
+    """Escreve os pedidos em ``out`` como JSON lines ou CSV
+
+    Returns:
+        int: quantidade de pedidos exportados
+    """
+    count = 0
+    if output_format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(CSV_FIELDS)
+        for order in orders:
+            writer.writerow((order.id, order.user_id, order.status, order.payment_id or "", order.created_at,
+                             len(order.items), f"{sum(item.price for item in order.items):.2f}"))
+            count += 1
+    else:
+        for order in orders:
+            out.write(json.dumps(order.to_dict(), ensure_ascii=False, separators=(',', ':')) + "\n")
+            count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Manutenção offline dos dados do bot")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    verify_parser = subparsers.add_parser("verify", help="confere a integridade dos dados (não altera nada)")
+    verify_parser.add_argument("path", nargs="?", default="data", help="diretório de dados ou banco SQLite")
+
+    compact_parser = subparsers.add_parser("compact", help="descarta o journal e versões antigas de pedidos")
+    compact_parser.add_argument("path", nargs="?", default="data")
+
+    reindex_parser = subparsers.add_parser("reindex", help="refaz o índice do arquivo morto (ou do banco)")
+    reindex_parser.add_argument("path", nargs="?", default="data")
+
+    upgrade_parser = subparsers.add_parser("upgrade", help="regrava os pedidos de versões antigas do schema")
+    upgrade_parser.add_argument("path", nargs="?", default="data")
+
+    migrate_parser = subparsers.add_parser("migrate", help="copia os dados entre os backends de arquivos e SQLite")
+    migrate_parser.add_argument("source", help="diretório de dados ou banco SQLite de origem")
+    migrate_parser.add_argument("target", help="banco SQLite (origem diretório) ou diretório novo (origem banco)")
+    migrate_parser.add_argument("--batch-size", type=int, default=10000)
+    migrate_parser.add_argument("--restart", action="store_true",
+                                help="ignora os checkpoints de uma migração interrompida")
+    migrate_parser.add_argument("--format", default=DEFAULT_SERIALIZER, choices=list(SERIALIZERS),
+                                help="formato de users/carts ao gravar um diretório")
+
+    export_parser = subparsers.add_parser("export", help="exporta um subconjunto dos pedidos")
+    export_parser.add_argument("path", nargs="?", default="data")
+    export_parser.add_argument("--status", action="append", choices=ORDER_STATUSES, help="pode repetir")
+    export_parser.add_argument("--user", type=int)
+    export_parser.add_argument("--since", help="AAAA-MM-DD (inclusivo)")
+    export_parser.add_argument("--until", help="AAAA-MM-DD (exclusivo)")
+    export_parser.add_argument("--include-archived", action="store_true")
+    export_parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    export_parser.add_argument("-o", "--output", help="arquivo de saída (padrão: stdout)")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    existing = args.source if args.command == "migrate" else args.path
+    if not os.path.exists(existing):
+        parser.error(f"{existing} não existe")
+
+    if args.command == "verify":
+        report = verify_sqlite(args.path) if is_sqlite(args.path) else verify_json(args.path)
+        report.print()
+        sys.exit(1 if report.errors else 0)
+    elif args.command == "compact":
+        print(f"{compact(args.path) / 1024:.0f} KB liberados")
+    elif args.command == "reindex":
+        indexed = reindex(args.path)
+        print("Índices do banco refeitos" if indexed is None else f"{indexed} pedidos no índice do arquivo morto")
+    elif args.command == "upgrade":
+        print(f"{upgrade(args.path)} pedidos atualizados para a versão {SCHEMA_VERSION} do schema")
+    elif args.command == "migrate":
+        if is_sqlite(args.source):
+            counts = migrate_sqlite_to_json(args.source, args.target, args.format)
+            print(", ".join(f"{count} {name}" for name, count in counts.items()))
+            return
+        started = time.perf_counter()
+
+        # Num terminal a linha da fase é reescrita a cada lote; fora dele, uma linha por lote
+        interactive = sys.stderr.isatty()
+        current = [None]
+
+        def progress(phase, count):
+            line = f"{phase}: {count} registros ({time.perf_counter() - started:.0f}s)"
+            if not interactive:
+                print(line, file=sys.stderr)
+                return
+            if current[0] not in (None, phase):
+                print(file=sys.stderr)
+            current[0] = phase
+            print(f"\r{line}", end="", file=sys.stderr, flush=True)
+        migrator = JsonToSqliteMigrator(args.source, args.target, args.batch_size, progress)
+        try:
+            counts = migrator.run(restart=args.restart)
+        finally:
+            if interactive and current[0] is not None:
+                print(file=sys.stderr)
+        print(", ".join(f"{count} {name}" for name, count in counts.items()) or "nada a migrar",
+              f"em {time.perf_counter() - started:.1f}s")
+        mismatches = migrator.verify()
+        for name, expected, actual in mismatches:
+            print(f"DIVERGÊNCIA {name}: origem {expected}, banco {actual}")
+        if mismatches:
+            sys.exit(1)
+        print("Contagens e totais conferem com a origem")
+    elif args.command == "export":
+        store = open_store(args.path, read_only=True)
+        out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+        try:
+            orders = iter_export(store, set(args.status or ()), args.user, _parse_date(args.since),
+                                 _parse_date(args.until), args.include_archived)
+            count = export_orders(orders, out, args.format)
+        finally:
+            if args.output:
+                out.close()
+            store.close()
+        print(f"{count} pedidos exportados", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+"""Migração em streaming dos arquivos de dados para o SQLite
+
+Lê users, carts, orders.jsonl (ou o antigo orders.json), o arquivo morto e
+o journal registro a registro e os grava no banco em transações de
+``batch_size`` registros. Cada transação também grava até onde a origem
+foi lida (tabela ``migration_checkpoints``), então uma migração
+interrompida continua exatamente de onde parou quando executada de novo.
+No fim, contagens e totais do banco são conferidos com os da origem.
+
+    python maintenance.py migrate data data/bot.db [--batch-size 10000] [--restart]
+
+Durante a carga os índices secundários são removidos e recriados no fim,
+e o banco fica em ``synchronous=NORMAL`` (WAL sem fsync por transação):
+uma queda de energia pode perder os últimos lotes, nunca corromper o banco
+nem adiantar o checkpoint em relação aos dados.
+"""
+
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter
+from datetime import datetime
+
+from serializers import detect_serializer, find_data_file, iter_json_object
+from sqlite_store import INDEXES, SQLiteDataStore
+from storage import DATE_FORMAT, ORDER_STATUSES, SCHEMA_VERSION, lock_data_dir, upgrade_order
+
+logger = logging.getLogger('bot.migration')
+
+CHECKPOINTS = """
+CREATE TABLE IF NOT EXISTS migration_checkpoints (
+    phase TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    position TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Recriados por INDEXES depois da carga
+SECONDARY_INDEXES = ("idx_orders_user_ts", "idx_orders_status_ts", "idx_orders_payment",
+                     "idx_orders_created", "idx_carts_touched")
+
+JOURNAL_FILES = ("journal.log.1", "journal.log")
+
+# Mesmo formato de _dump_details do sqlite_store, sem refazer o encoder a cada item
+_encode_details = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+MIGRATED_SUFFIX = ".migrated"
+
+def _source_id(path):
+    """Identifica a versão de um arquivo: regravá-lo (tmp + rename) troca o inode"""
+    name = os.path.basename(path)
+    if name.endswith(MIGRATED_SUFFIX):
+        # Só renomeado pelo SQLiteDataStore: o conteúdo é o mesmo
+        name = name[:-len(MIGRATED_SUFFIX)]
+    return f"{name}:{os.stat(path).st_ino}"
+
+def _carts_file(data_dir):
+    """carts em qualquer formato, inclusive o carts.json que o SQLiteDataStore já renomeou"""
+    path = find_data_file(data_dir, "carts")
+    migrated = os.path.join(data_dir, "carts.json" + MIGRATED_SUFFIX)
+    if path is None and os.path.exists(migrated):
+        return migrated
+    return path
+
+def _carts_serializer(path):
+    if path.endswith(MIGRATED_SUFFIX):
+        path = path[:-len(MIGRATED_SUFFIX)]
+    return detect_serializer(path)
+
+def _order_row(data):
+    created_ts = data['created_ts'] or 0.0
+    payment_id = data.get('payment_id')
+    return (data['id'], data['user_id'], data.get('status', 'pendente'),
+            None if payment_id is None else str(payment_id),
+            data.get('created_at') or datetime.fromtimestamp(created_ts).strftime(DATE_FORMAT), created_ts,
+            SCHEMA_VERSION)
+
+def _item_rows(data):
+    return [(data['id'], position, item['name'], item['price'],
+             _encode_details(item.get('details') or {}))
+            for position, item in enumerate(data['items'])]
+
+def _apply_orders(cursor, batch):
+    """Grava um lote de (order_id, dados ou None para remoção) na ordem da origem
+
+    Em orders.jsonl a remoção também marca um pedido que foi para o arquivo
+    morto; ele volta na fase do arquivo.
+
+    Returns:
+        int: quantos pedidos o banco ganhou (versões repetidas e remoções não contam)
+    """
+    # Só a última versão de cada pedido do lote importa
+    latest = {}
+    for order_id, data in batch:
+        latest[order_id] = data
+    ids = list(latest)
+    existing = 0
+    for offset in range(0, len(ids), 500):
+        chunk = ids[offset:offset + 500]
+        existing += cursor.execute(f"SELECT COUNT(*) FROM orders WHERE id IN ({','.join('?' * len(chunk))})",
+                                   chunk).fetchone()[0]
+    deleted = [(order_id,) for order_id, data in latest.items() if data is None]
+    if deleted:
+        cursor.executemany("DELETE FROM orders WHERE id = ?", deleted)
+    # Já no formato atual: o banco recebe schema_version = SCHEMA_VERSION
+    orders = [upgrade_order(data) for data in latest.values() if data is not None]
+    # Os itens da versão anterior saem pelo ON DELETE CASCADE do REPLACE
+    cursor.executemany("INSERT OR REPLACE INTO orders "
+                       "(id, user_id, status, payment_id, created_at, created_ts, schema_version) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)", [_order_row(data) for data in orders])
+    cursor.executemany("INSERT INTO order_items (order_id, position, name, price, details) VALUES (?, ?, ?, ?, ?)",
+                       [row for data in orders for row in _item_rows(data)])
+    return len(orders) - existing
+
+def _apply_archived_orders(cursor, batch):
+    """Grava pedidos arquivados que não estejam entre os ativos: a cópia ativa prevalece"""
+    conn = cursor.connection
+    archived = [(order_id, data) for order_id, data in batch
+                if conn.execute("SELECT 1 FROM orders WHERE id = ?", (order_id,)).fetchone() is None]
+    return _apply_orders(cursor, archived)
+
+def _cart_row(user_id, cart, now):
+    if isinstance(cart, list):
+        # Formato antigo: só a lista de itens
+        cart = {'items': cart}
+    return int(user_id), json.dumps(cart['items'], ensure_ascii=False), cart.get('touched', now)
+
+class JsonToSqliteMigrator:
+    """Copia um diretório de dados do ``DataStore`` para um banco do ``SQLiteDataStore``
+
+    ``progress(fase, registros)`` é chamado a cada lote gravado. Nas fases
+    de pedidos, registros são os pedidos que o banco ganhou, não as linhas
+    lidas (versões antigas e remoções em orders.jsonl não contam).
+    """
+
+    def __init__(self, data_dir, sqlite_path, batch_size=10000, progress=None):
+        self.data_dir = data_dir
+        self.sqlite_path = sqlite_path
+        self.batch_size = batch_size
+        self.progress = progress or (lambda phase, count: None)
+        self.counts = Counter()
+        self.conn = None
+
+    def run(self, restart=False):
+        """Executa (ou retoma) a migração
+
+        Returns:
+            Counter: registros lidos da origem por fase nesta execução
+        """
+        # O bot não pode alterar os arquivos durante a migração
+        lock = lock_data_dir(self.data_dir)
+        try:
+            SQLiteDataStore(self.sqlite_path).close()
+            self.conn = sqlite3.connect(self.sqlite_path, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("PRAGMA foreign_keys=ON")
+            self.conn.execute("PRAGMA cache_size=-65536")
+            self.conn.executescript(CHECKPOINTS)
+            if restart:
+                self.conn.execute("DELETE FROM migration_checkpoints")
+            self._check_target()
+            for index in SECONDARY_INDEXES:
+                self.conn.execute(f"DROP INDEX IF EXISTS {index}")
+
+            self._migrate_users()
+            self._migrate_carts()
+            self._migrate_orders()
+            self._migrate_archive()
+            for name in JOURNAL_FILES:
+                self._migrate_journal(name)
+
+            started = time.perf_counter()
+            self.conn.executescript(INDEXES)
+            self.conn.execute("ANALYZE")
+            logger.info(f"Índices recriados em {time.perf_counter() - started:.1f}s")
+        finally:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            lock.close()
+        return self.counts
+
+    def _check_target(self):
+        started = self.conn.execute("SELECT COUNT(*) FROM migration_checkpoints").fetchone()[0]
+        if started:
+            logger.info("Retomando migração a partir dos checkpoints")
+            return
+        for table in ("users", "orders"):
+            if self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                raise RuntimeError(f"{self.sqlite_path} já tem dados em {table}; migre para um banco novo")
+
+    # CHECKPOINTS
+
+    def _start(self, phase, source, initial):
+        """Posição de onde ``phase`` deve ler a origem, ou None se já concluída"""
+        row = self.conn.execute("SELECT source, position, done FROM migration_checkpoints WHERE phase = ?",
+                                (phase,)).fetchone()
+        if row is None:
+            return initial
+        saved_source, position, done = row
+        if saved_source != source:
+            # Gravar de novo a fase inteira é seguro: tudo é INSERT OR REPLACE
+            logger.warning(f"{phase}: a origem mudou desde o checkpoint; a fase recomeça do início")
+            return initial
+        return None if done else json.loads(position)
+
+    def _commit(self, phase, source, position, apply=None, done=False):
+        """Aplica um lote e avança o checkpoint na mesma transação; devolve o que ``apply`` devolver"""
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            result = apply(cursor) if apply is not None else None
+            cursor.execute("INSERT OR REPLACE INTO migration_checkpoints (phase, source, position, done) "
+                           "VALUES (?, ?, ?, ?)", (phase, source, json.dumps(position), int(done)))
+            cursor.execute("COMMIT")
+            return result
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def _load(self, phase, source, start, records, apply):
+        """Grava ``records`` — pares (posição após o registro, registro) — em lotes
+
+        Se ``apply`` devolver um número, é ele que entra na contagem da fase
+        em vez do tamanho do lote.
+        """
+        batch = []
+        position = start
+        for position, record in records:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                added = self._commit(phase, source, position, lambda cursor: apply(cursor, batch))
+                self.counts[phase] += added if isinstance(added, int) else len(batch)
+                self.progress(phase, self.counts[phase])
+                batch = []
+        added = self._commit(phase, source, position, (lambda cursor: apply(cursor, batch)) if batch else None,
+                             done=True)
+        self.counts[phase] += added if isinstance(added, int) else len(batch)
+        self.progress(phase, self.counts[phase])
+
+    # FASES
+
+    def _migrate_users(self):
+        path = find_data_file(self.data_dir, "users")
+        if path is None:
+            return
+        source = _source_id(path)
+        start = self._start("users", source, 0)
+        if start is None:
+            return
+
+        def records():
+            for index, (user_id, data) in enumerate(detect_serializer(path).iter_items(path)):
+                if index >= start:
+                    yield index + 1, (int(user_id), data['nome'], data['telefone'])
+        self._load("users", source, start, records(), lambda cursor, batch: cursor.executemany(
+            "INSERT OR REPLACE INTO users (id, nome, telefone) VALUES (?, ?, ?)", batch))
+
+    def _migrate_carts(self):
+        path = _carts_file(self.data_dir)
+        if path is None:
+            return
+        source = _source_id(path)
+        start = self._start("carts", source, 0)
+        if start is None:
+            return
+        serializer = _carts_serializer(path)
+        now = time.time()
+
+        def records():
+            for index, (user_id, cart) in enumerate(serializer.iter_items(path)):
+                if index >= start:
+                    yield index + 1, _cart_row(user_id, cart, now)
+        self._load("carts", source, start, records(), lambda cursor, batch: cursor.executemany(
+            "INSERT OR REPLACE INTO carts (user_id, items, touched) VALUES (?, ?, ?)",
+            [row for row in batch if row[1] != "[]"]))
+
+    def _archived_ids_by_month(self):
+        index_file = os.path.join(self.data_dir, "archive", "index.json")
+        if not os.path.exists(index_file):
+            return index_file, {}
+        by_month = {}
+        with open(index_file, 'r', encoding='utf-8') as f:
+            for order_id, (month, _) in json.load(f).items():
+                by_month.setdefault(month, set()).add(order_id)
+        return index_file, by_month
+
+    def _read_partition(self, month):
+        with gzip.open(os.path.join(self.data_dir, "archive", f"orders-{month}.json.gz"), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _migrate_archive(self):
+        """Partições do arquivo morto, uma por vez"""
+        index_file, by_month = self._archived_ids_by_month()
+        if not by_month:
+            return
+        source = _source_id(index_file)
+        done_months = self._start("archive", source, [])
+        if done_months is None:
+            return
+        for month in sorted(by_month):
+            if month in done_months:
+                continue
+            # Só os pedidos que o índice ainda aponta para esta partição
+            partition = self._read_partition(month)
+            orders = [(order_id, partition[order_id]) for order_id in sorted(by_month[month]) if order_id in partition]
+            del partition
+            for offset in range(0, len(orders), self.batch_size):
+                batch = orders[offset:offset + self.batch_size]
+                # O mês só entra no checkpoint no último lote; repetir os outros é inofensivo
+                last = offset + self.batch_size >= len(orders)
+                self.counts["archive"] += self._commit("archive", source,
+                                                       done_months + [month] if last else done_months,
+                                                       lambda cursor: _apply_archived_orders(cursor, batch))
+                self.progress("archive", self.counts["archive"])
+            done_months = done_months + [month]
+        self._commit("archive", source, done_months, done=True)
+
+    def _migrate_orders(self):
+        path = os.path.join(self.data_dir, "orders.jsonl")
+        legacy_path = os.path.join(self.data_dir, "orders.json")
+        if os.path.exists(path):
+            source = _source_id(path)
+            start = self._start("orders", source, 0)
+            if start is not None:
+                self._load("orders", source, start, self._iter_jsonl(path, start), _apply_orders)
+        elif os.path.exists(legacy_path):
+            source = _source_id(legacy_path)
+            start = self._start("orders", source, 0)
+            if start is not None:
+                records = ((index + 1, (order_id, data))
+                           for index, (order_id, data) in enumerate(iter_json_object(legacy_path))
+                           if index >= start)
+                self._load("orders", source, start, records, _apply_orders)
+
+    @staticmethod
+    def _iter_jsonl(path, start):
+        """(offset após a linha, (order_id, dados ou None)) a partir do byte ``start``"""
+        with open(path, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if not line.endswith(b"\n"):
+                    logger.warning(f"{path}: ignorando a linha incompleta no byte {offset}")
+                    return
+                offset += len(line)
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    data = None
+                if not isinstance(data, dict) or 'id' not in data or \
+                        not (data.get('deleted') or 'user_id' in data):
+                    # Linha corrompida no meio do arquivo, que o bot também ignora
+                    logger.warning(f"{path}: ignorando a linha corrompida no byte {offset - len(line)}")
+                    continue
+                yield offset, (data['id'], None if data.get('deleted') else data)
+
+    def _migrate_journal(self, name):
+        """Reaplica um journal que não chegou a virar snapshot (o bot caiu)"""
+        path = os.path.join(self.data_dir, name)
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return
+        phase = f"journal:{name}"
+        source = _source_id(path)
+        start = self._start(phase, source, 0)
+        if start is None:
+            return
+
+        def records():
+            with open(path, 'rb') as f:
+                f.seek(start)
+                offset = start
+                for line in f:
+                    offset += len(line)
+                    try:
+                        yield offset, json.loads(line)
+                    except ValueError:
+                        # Última linha cortada pela queda
+                        logger.warning(f"{path}: registro inválido no byte {offset - len(line)} ignorado")
+        self._load(phase, source, start, records(), self._apply_journal)
+
+    @staticmethod
+    def _apply_journal(cursor, batch):
+        # Na ordem: um status pode depender do pedido criado no registro anterior
+        now = time.time()
+        for record in batch:
+            op = record['op']
+            if op == 'user':
+                user = record['user']
+                cursor.execute("INSERT OR REPLACE INTO users (id, nome, telefone) VALUES (?, ?, ?)",
+                               (int(user['id']), user['nome'], user['telefone']))
+            elif op == 'cart':
+                if record['items']:
+                    cursor.execute("INSERT OR REPLACE INTO carts (user_id, items, touched) VALUES (?, ?, ?)",
+                                   _cart_row(record['user_id'], record['items'], now))
+                else:
+                    cursor.execute("DELETE FROM carts WHERE user_id = ?", (int(record['user_id']),))
+            elif op == 'order':
+                _apply_orders(cursor, [(record['order']['id'], record['order'])])
+            elif op == 'status':
+                payment_id = record.get('payment_id')
+                cursor.execute("UPDATE orders SET status = ?, payment_id = COALESCE(?, payment_id) WHERE id = ?",
+                               (record['status'], None if payment_id is None else str(payment_id), record['id']))
+            elif op == 'delete':
+                cursor.execute("DELETE FROM orders WHERE id = ?", (record['id'],))
+
+    # VERIFICAÇÃO
+
+    def expected_totals(self):
+        """Contagens e totais que o banco deve ter, calculados relendo a origem
+
+        Guarda (status, total, itens) de cada pedido para que versões
+        repetidas e remoções contem uma vez só: a memória cresce com o
+        número de pedidos, não com o tamanho dos arquivos.
+        """
+        users = set()
+        path = find_data_file(self.data_dir, "users")
+        if path:
+            users.update(int(user_id) for user_id, _ in detect_serializer(path).iter_items(path))
+
+        carts = {}
+        path = _carts_file(self.data_dir)
+        if path:
+            for user_id, cart in _carts_serializer(path).iter_items(path):
+                carts[int(user_id)] = bool(cart if isinstance(cart, list) else cart['items'])
+
+        orders = {}
+
+        def summary(data):
+            return (data.get('status', 'pendente'), sum(item['price'] for item in data['items']), len(data['items']))
+
+        path = os.path.join(self.data_dir, "orders.jsonl")
+        if os.path.exists(path):
+            for _, (order_id, data) in self._iter_jsonl(path, 0):
+                if data is None:
+                    orders.pop(order_id, None)
+                else:
+                    orders[order_id] = summary(data)
+        elif os.path.exists(os.path.join(self.data_dir, "orders.json")):
+            for order_id, data in iter_json_object(os.path.join(self.data_dir, "orders.json")):
+                orders[order_id] = summary(data)
+        _, by_month = self._archived_ids_by_month()
+        for month, order_ids in sorted(by_month.items()):
+            partition = self._read_partition(month)
+            for order_id in order_ids:
+                if order_id in partition and order_id not in orders:
+                    orders[order_id] = summary(partition[order_id])
+        for name in JOURNAL_FILES:
+            path = os.path.join(self.data_dir, name)
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record['op'] == 'user':
+                        users.add(int(record['user']['id']))
+                    elif record['op'] == 'cart':
+                        carts[int(record['user_id'])] = bool(record['items'])
+                    elif record['op'] == 'order':
+                        orders[record['order']['id']] = summary(record['order'])
+                    elif record['op'] == 'status' and record['id'] in orders:
+                        orders[record['id']] = (record['status'],) + orders[record['id']][1:]
+                    elif record['op'] == 'delete':
+                        orders.pop(record['id'], None)
+
+        totals = {
+            'usuários': len(users),
+            'carrinhos': sum(carts.values()),
+            'pedidos': len(orders),
+            'itens': sum(items for _, _, items in orders.values()),
+            'total (R$)': round(sum(total for _, total, _ in orders.values()), 2),
+        }
+        by_status = Counter(status for status, _, _ in orders.values())
+        for status in ORDER_STATUSES:
+            totals[f'pedidos {status}'] = by_status[status]
+        return totals
+
+    def actual_totals(self):
+        """As mesmas contagens e totais, lidos do banco"""
+        conn = sqlite3.connect(self.sqlite_path)
+        try:
+            def scalar(sql):
+                return conn.execute(sql).fetchone()[0]
+            totals = {
+                'usuários': scalar("SELECT COUNT(*) FROM users"),
+                'carrinhos': scalar("SELECT COUNT(*) FROM carts"),
+                'pedidos': scalar("SELECT COUNT(*) FROM orders"),
+                'itens': scalar("SELECT COUNT(*) FROM order_items"),
+                'total (R$)': round(scalar("SELECT COALESCE(SUM(price), 0) FROM order_items"), 2),
+            }
+            by_status = dict(conn.execute("SELECT status, COUNT(*) FROM orders GROUP BY status").fetchall())
+        finally:
+            conn.close()
+        for status in ORDER_STATUSES:
+            totals[f'pedidos {status}'] = by_status.get(status, 0)
+        return totals
+
+    def verify(self):
+        """Confere o banco com a origem
+
+        Returns:
+            list: tuplas (métrica, esperado, no banco) das que divergem
+        """
+        expected = self.expected_totals()
+        actual = self.actual_totals()
+        return [(name, value, actual[name]) for name, value in expected.items() if actual[name] != value]
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""Fila de saída das chamadas à Bot API, dentro dos limites do Telegram
+
+O Telegram recusa com 429 (``RetryAfter``) quem passa de cerca de 30
+mensagens por segundo no total, de uma por segundo no mesmo chat privado
+ou de 20 por minuto no mesmo grupo. ``OutboxRequest`` substitui o
+``Request`` do bot e põe toda chamada com ``chat_id`` (sendMessage,
+editMessageText...) na fila do ``Outbox``, que threads próprias esvaziam:
+
+- cada chat tem sua fila, enviada em ordem e uma chamada por vez, com um
+  balde de tokens por chat (privado ou grupo) e um global;
+- entre os chats prontos, respostas interativas passam na frente de
+  notificações (o que roda dentro de ``as_notification()``);
+- um 429 bloqueia o chat pelo ``retry_after`` informado e a chamada volta
+  para o início da fila dele, até ``max_retries`` vezes.
+
+O ritmo e as novas tentativas ficam todos nas threads da fila. Quem chama
+espera a resposta por até ``caller_wait`` segundos (nada, se o chat está
+bloqueado por um 429) e recebe a ``Message`` como antes; passado esse
+tempo a chamada devolve ``True`` e a mensagem segue na fila. Assim a
+thread do dispatcher nunca fica parada esperando um chat limitado. Quem
+precisa do resultado de qualquer jeito (o broadcast) usa ``until_sent()``;
+métodos cuja resposta o ``Bot`` não dispensa (sendMediaGroup,
+copyMessage...) também esperam. Chamadas sem ``chat_id``
+(answerCallbackQuery, getUpdates...) e as de leitura (getChat...) não
+passam pela fila.
+
+    outbox = Outbox(global_rate=30).start()
+    bot = ExtBot(TOKEN, request=OutboxRequest(outbox, con_pool_size=outbox.senders + 12))
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+try:
+    from telegram.error import RetryAfter
+    from telegram.utils.request import Request
+except ImportError:
+    # Sem o python-telegram-bot só o Outbox em si pode ser usado
+    class RetryAfter(Exception):
+        retry_after = 0.0
+    Request = object
+
+logger = logging.getLogger('bot.outbox')
+
+INTERACTIVE = 0
+NOTIFICATION = 1
+
+# Devolvido por ``Outbox.send`` quando a chamada ainda está na fila
+QUEUED = object()
+
+# Métodos em que o ``Bot`` aceita ``True`` no lugar da resposta (os que passam
+# por ``Bot._message`` e os que já devolvem só True). Os demais com chat_id
+# esperam o envio; os de leitura (get*) não passam pela fila
+RETURNS_EARLY = frozenset((
+    'sendMessage', 'sendPhoto', 'sendAudio', 'sendDocument', 'sendVideo', 'sendAnimation', 'sendVoice',
+    'sendVideoNote', 'sendLocation', 'sendVenue', 'sendContact', 'sendDice', 'sendGame', 'sendInvoice',
+    'sendPoll', 'sendSticker', 'forwardMessage', 'editMessageText', 'editMessageCaption', 'editMessageMedia',
+    'editMessageReplyMarkup', 'editMessageLiveLocation', 'stopMessageLiveLocation', 'setGameScore',
+    'deleteMessage', 'sendChatAction', 'pinChatMessage', 'unpinChatMessage',
+))
+
+_local = threading.local()
+
+@contextmanager
+def as_notification():
+    """Marca as chamadas feitas nesta thread como notificação (prioridade baixa)"""
+    previous = getattr(_local, 'priority', INTERACTIVE)
+    _local.priority = NOTIFICATION
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+@contextmanager
+def until_sent():
+    """Nesta thread, as chamadas esperam o resultado do envio, sem limite de tempo"""
+    previous = getattr(_local, 'until_sent', False)
+    _local.until_sent = True
+    try:
+        yield
+    finally:
+        _local.until_sent = previous
+
+class _Bucket:
+    """Balde de tokens: ``rate`` por segundo, acumulando até ``burst``"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'blocked_until')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+        self.blocked_until = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now):
+        """Segundos até haver um token (e o bloqueio por 429 acabar)"""
+        missing = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(missing, self.blocked_until - now)
+
+    def idle(self, now):
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+class _Chat:
+    """Fila de um chat; só a primeira chamada dela disputa os envios"""
+
+    __slots__ = ('bucket', 'jobs', 'scheduled', 'sending')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.jobs = deque()
+        self.scheduled = False
+        self.sending = False
+
+class _Job:
+    __slots__ = ('chat_id', 'call', 'priority', 'seq', 'enqueued', 'attempts', 'done', 'wake', 'finished',
+                 'abandoned', 'result', 'error')
+
+    def __init__(self, chat_id, call, priority, seq, now):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.seq = seq
+        self.enqueued = now
+        self.attempts = 0
+        self.done = threading.Event()
+        # Também acordado por um 429: quem espera com prazo desiste na hora
+        self.wake = threading.Event()
+        self.finished = False
+        self.abandoned = False
+        self.result = None
+        self.error = None
+
+class Outbox:
+    """Fila com limites por chat e global para as chamadas à Bot API, com prioridade
+
+    ``send(chat_id, call)`` põe ``call()`` na fila; ``senders`` threads a
+    executam quando o chat e o limite global permitem. Num ``RetryAfter``
+    o chat fica bloqueado pelo tempo pedido e a chamada é repetida.
+    """
+
+    # Acima disso os baldes de chats ociosos são descartados
+    PRUNE_AT = 1000
+
+    def __init__(self, global_rate=30.0, chat_rate=1.0, chat_burst=3, group_per_minute=20, max_retries=3,
+                 senders=8, caller_wait=1.0):
+        if senders < 1:
+            raise ValueError("A fila precisa de pelo menos uma thread de envio")
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60.0
+        self.max_retries = max_retries
+        self.senders = senders
+        self.caller_wait = caller_wait
+        self._cond = threading.Condition()
+        self._global = _Bucket(global_rate, max(1.0, global_rate), time.monotonic())
+        self._chats = {}
+        self._prune_at = self.PRUNE_AT
+        # Chats com a primeira chamada liberada: (prioridade, ordem de chegada, chat)
+        self._ready = []
+        # Chats esperando o próprio balde ou o fim de um 429: (quando, ordem de chegada, chat)
+        self._delayed = []
+        self._pending = 0
+        self._tickets = itertools.count()
+        self._threads = []
+        self._closed = False
+        self.stats = Counter()
+        self._max_wait = [0.0, 0.0]
+
+    def start(self):
+        """Sobe as threads de envio"""
+        with self._cond:
+            self._closed = False
+            while len(self._threads) < self.senders:
+                thread = threading.Thread(target=self._sender, name=f"outbox-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        return self
+
+    def close(self, timeout=10.0):
+        """Para de aceitar chamadas e espera a fila esvaziar por até ``timeout`` segundos"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        with self._cond:
+            if self._pending:
+                logger.warning(f"Fila de envio encerrada com {self._pending} chamadas não enviadas")
+
+    def send(self, chat_id, call, can_return_early=True):
+        """Põe ``call()`` na fila do chat e espera o resultado
+
+        A espera é de até ``caller_wait`` segundos, ou até o fim com
+        ``can_return_early=False`` ou dentro de ``until_sent()``.
+
+        Returns:
+            o que ``call()`` devolver (suas exceções são repassadas), ou
+            ``QUEUED`` se a chamada continua na fila depois da espera
+        """
+        # 123 e "123" são o mesmo chat
+        chat_id = str(chat_id)
+        priority = getattr(_local, 'priority', INTERACTIVE)
+        wait = self.caller_wait if can_return_early and not getattr(_local, 'until_sent', False) else None
+        with self._cond:
+            if self._closed or not self._threads:
+                raise RuntimeError("A fila de envio não está rodando")
+            now = time.monotonic()
+            job = _Job(chat_id, call, priority, next(self._tickets), now)
+            chat = self._chat(chat_id, now)
+            chat.jobs.append(job)
+            self._pending += 1
+            if not chat.scheduled and not chat.sending:
+                self._schedule(chat_id, chat, now)
+            if wait is not None:
+                # Previsão de quando a chamada sai, pelo balde e pela fila do
+                # chat; se passa do prazo (ex.: 429 em curso) nem adianta esperar
+                chat.bucket.refill(now)
+                missing = len(chat.jobs) - chat.bucket.tokens
+                eta = max(missing / chat.bucket.rate if missing > 0 else 0.0, chat.bucket.blocked_until - now)
+                if eta >= wait:
+                    wait = 0.0
+        if wait is None:
+            job.done.wait()
+        else:
+            job.wake.wait(wait)
+        with self._cond:
+            if not job.finished:
+                job.abandoned = True
+                self.stats['sem_espera'] += 1
+                return QUEUED
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _chat(self, chat_id, now):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= self._prune_at:
+                self._prune(now)
+            # Grupos e canais têm ids negativos ou @nome
+            group = chat_id.startswith(('-', '@'))
+            chat = _Chat(_Bucket(self.group_rate if group else self.chat_rate, self.chat_burst, now))
+            self._chats[chat_id] = chat
+        return chat
+
+    def _prune(self, now):
+        for chat_id, chat in list(self._chats.items()):
+            chat.bucket.refill(now)
+            if not chat.jobs and not chat.sending and chat.bucket.idle(now):
+                del self._chats[chat_id]
+        self._prune_at = max(self.PRUNE_AT, 2 * len(self._chats))
+
+    def _schedule(self, chat_id, chat, now):
+        """Põe o chat na disputa pelo próximo envio (com _cond)"""
+        chat.bucket.refill(now)
+        delay = chat.bucket.wait_time(now)
+        head = chat.jobs[0]
+        if delay <= 0:
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        else:
+            heapq.heappush(self._delayed, (now + delay, head.seq, chat_id))
+        chat.scheduled = True
+        self._cond.notify()
+
+    def _next_job(self):
+        """Espera a próxima chamada liberada pelos limites; None ao encerrar (com _cond)"""
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, seq, chat_id = heapq.heappop(self._delayed)
+                chat = self._chats[chat_id]
+                heapq.heappush(self._ready, (chat.jobs[0].priority, seq, chat_id))
+            timeout = None
+            if self._ready:
+                self._global.refill(now)
+                timeout = self._global.wait_time(now)
+                if timeout <= 0:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    chat = self._chats[chat_id]
+                    chat.scheduled = False
+                    chat.sending = True
+                    chat.bucket.refill(now)
+                    chat.bucket.tokens -= 1
+                    self._global.tokens -= 1
+                    return chat.jobs.popleft()
+            elif self._closed and not self._pending:
+                return None
+            if self._delayed:
+                delay = self._delayed[0][0] - now
+                timeout = delay if timeout is None else min(timeout, delay)
+            self._cond.wait(timeout)
+
+    def _sender(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                if job is None:
+                    self._cond.notify_all()
+                    return
+                waited = time.monotonic() - job.enqueued
+                kind = 'notificacoes' if job.priority == NOTIFICATION else 'interativas'
+                self.stats[kind] += 1
+                self.stats[f'espera_{kind}_ms'] += int(waited * 1000)
+                self._max_wait[job.priority] = max(self._max_wait[job.priority], waited)
+            retry_after = None
+            abandoned = False
+            try:
+                job.result = job.call()
+            except RetryAfter as e:
+                job.attempts += 1
+                if job.attempts > self.max_retries:
+                    job.error = e
+                else:
+                    retry_after = e.retry_after
+                    logger.info(f"Chat {job.chat_id}: limite do Telegram, nova tentativa em {e.retry_after:.0f}s")
+                with self._cond:
+                    self.stats['limitados_429'] += 1
+                    now = time.monotonic()
+                    self._chats[job.chat_id].bucket.blocked_until = now + e.retry_after
+                    if job.error is not None:
+                        self.stats['desistencias'] += 1
+                if job.error is not None:
+                    logger.warning(f"Chat {job.chat_id}: limite do Telegram excedido {job.attempts} vezes, desistindo")
+            except Exception as e:
+                job.error = e
+            with self._cond:
+                chat = self._chats[job.chat_id]
+                chat.sending = False
+                if retry_after is not None:
+                    # Volta para o início da fila do chat, para não passar à frente das seguintes
+                    chat.jobs.appendleft(job)
+                    job.wake.set()
+                else:
+                    self._pending -= 1
+                    job.finished = True
+                    abandoned = job.abandoned
+                    job.done.set()
+                    job.wake.set()
+                if chat.jobs:
+                    self._schedule(job.chat_id, chat, time.monotonic())
+                self._cond.notify_all()
+            if retry_after is None and abandoned and job.error is not None:
+                # Quem chamou já seguiu em frente: o erro só aparece aqui
+                logger.error(f"Chat {job.chat_id}: falha no envio feito pela fila: {job.error}")
+
+    def snapshot(self, reset=False):
+        """Contadores de envios, esperas e 429 desde o último ``reset``"""
+        with self._cond:
+            stats = dict(self.stats)
+            stats['espera_max_interativas_ms'] = round(self._max_wait[INTERACTIVE] * 1000, 1)
+            stats['espera_max_notificacoes_ms'] = round(self._max_wait[NOTIFICATION] * 1000, 1)
+            stats['na_fila'] = self._pending
+            stats['chats'] = len(self._chats)
+            if reset:
+                self.stats.clear()
+                self._max_wait = [0.0, 0.0]
+        return stats
+
+    def log_metrics(self):
+        """Registra a janela atual no log e a zera; 429 viram aviso"""
+        stats = self.snapshot(reset=True)
+        if stats.get('limitados_429'):
+            logger.warning(f"Fila de envio: limites do Telegram atingidos: {stats}")
+        elif stats.get('interativas') or stats.get('notificacoes'):
+            logger.info(f"Fila de envio: {stats}")
+        return stats
+
+class OutboxRequest(Request):
+    """``Request`` do python-telegram-bot que passa as chamadas com ``chat_id`` pelo ``Outbox``
+
+    Contrato com quem chama: nos métodos de ``RETURNS_EARLY``, uma chamada
+    que ainda está na fila depois de ``caller_wait`` devolve ``True`` no
+    lugar da resposta, e o ``Bot`` repassa esse ``True`` (``send_message``
+    devolve ``True`` em vez da ``Message``). Quem precisa da ``Message``
+    (para editá-la depois, por exemplo) chama dentro de ``until_sent()``.
+    """
+
+    __slots__ = ('outbox',)
+
+    def __init__(self, outbox, **kwargs):
+        super().__init__(**kwargs)
+        self.outbox = outbox
+
+    def post(self, url, data, timeout=None):
+        chat_id = data.get('chat_id') if data else None
+        method = url.rsplit('/', 1)[-1]
+        if chat_id is None or method.startswith('get'):
+            return super().post(url, data, timeout)
+        result = self.outbox.send(chat_id, lambda: super(OutboxRequest, self).post(url, data, timeout),
+                                  can_return_early=method in RETURNS_EARLY)
+        # Ainda na fila: nesses métodos o Bot devolve o True a quem chamou
+        return True if result is QUEUED else result
@@ -0,0 +1,630 @@
+# -*- coding: utf-8 -*-
+"""Carrinhos e sessões num servidor Redis (ou compatível)
+
+Para rodar várias réplicas do bot, o estado que antes ficava na memória do
+processo vai para o Redis:
+
+- ``RedisCartStore``: carrinhos, um hash por usuário (``bot:cart:<id>``)
+  com um campo por item e TTL renovado a cada acesso. Substitui o
+  ``CartStore`` do ``DataStore`` e a tabela carts do ``SQLiteDataStore``;
+- ``RedisPersistence``: persistência do python-telegram-bot para
+  ``context.user_data`` (``bot:session:<id>``) e para o estado das
+  ConversationHandler (``bot:conv:<nome>``), relidos a cada update para
+  que qualquer réplica continue a conversa de onde outra parou.
+
+O cliente fala o protocolo RESP diretamente, sem dependências.
+``FakeRedisServer`` implementa os comandos usados aqui num servidor em
+processo, para desenvolvimento e benchmarks sem um Redis de verdade.
+"""
+
+import fnmatch
+import json
+import logging
+import secrets
+import socket
+import socketserver
+import ssl
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import unquote, urlparse
+
+from storage import CartItem
+
+try:
+    from telegram.ext import BasePersistence, ConversationHandler
+    CONVERSATION_END = ConversationHandler.END
+except ImportError:
+    # Ferramentas offline (benchmark, manutenção) usam só os carrinhos
+    BasePersistence = object
+    CONVERSATION_END = -1
+
+logger = logging.getLogger('bot.storage')
+
+class RedisError(Exception):
+    """Erro devolvido pelo servidor (resposta ``-ERR ...``)"""
+
+# PROTOCOLO RESP
+
+def _encode_command(args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, str):
+            data = arg.encode('utf-8')
+        else:
+            data = str(arg).encode('utf-8')
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+def _read_reply(reader):
+    """Lê uma resposta; erros voltam como ``RedisError`` (não levantados)"""
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Conexão com o Redis encerrada")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode('utf-8')
+    if kind == b"-":
+        return RedisError(payload.decode('utf-8'))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("Conexão com o Redis encerrada")
+        return data[:-2].decode('utf-8')
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [_read_reply(reader) for _ in range(length)]
+    raise RedisError(f"Resposta RESP inválida: {line!r}")
+
+class _Connection:
+    def __init__(self, host, port, timeout, use_ssl):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        if use_ssl:
+            self.sock = ssl.create_default_context().wrap_socket(self.sock, server_hostname=host)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def execute_many(self, commands):
+        self.sock.sendall(b"".join(_encode_command(command) for command in commands))
+        return [_read_reply(self.reader) for _ in commands]
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+class RedisClient:
+    """Cliente Redis mínimo e thread-safe, com um pool de conexões
+
+    ``url`` no formato ``redis://[:senha@]host[:porta][/db]`` (``rediss://``
+    para TLS).
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", timeout=5.0, pool_size=8):
+        parsed = urlparse(url)
+        if parsed.scheme not in ("redis", "rediss"):
+            raise ValueError(f"URL do Redis inválida: {url}")
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.use_ssl = parsed.scheme == "rediss"
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._pool = []
+        self._pool_lock = threading.Lock()
+
+    def _connect(self):
+        connection = _Connection(self.host, self.port, self.timeout, self.use_ssl)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        for reply in connection.execute_many(setup) if setup else ():
+            if isinstance(reply, RedisError):
+                connection.close()
+                raise reply
+        return connection
+
+    def _execute_many(self, commands):
+        with self._pool_lock:
+            connection = self._pool.pop() if self._pool else None
+        # Uma conexão parada no pool pode ter sido fechada pelo servidor:
+        # nesse caso tenta uma vez com uma conexão nova
+        for attempt in (0, 1):
+            if connection is None:
+                connection = self._connect()
+            try:
+                replies = connection.execute_many(commands)
+                break
+            except (OSError, ConnectionError):
+                connection.close()
+                connection = None
+                if attempt:
+                    raise
+        with self._pool_lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(connection)
+                connection = None
+        if connection is not None:
+            connection.close()
+        return replies
+
+    def execute(self, *args):
+        """Executa um comando e devolve a resposta (erros são levantados)"""
+        reply = self._execute_many([args])[0]
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    def pipeline(self, commands, transaction=False):
+        """Envia vários comandos numa única ida ao servidor
+
+        Com ``transaction=True`` eles vão entre MULTI/EXEC e são aplicados
+        atomicamente. Returns:
+            list: a resposta de cada comando
+        """
+        commands = list(commands)
+        if transaction:
+            replies = self._execute_many([("MULTI",)] + commands + [("EXEC",)])
+            replies = replies[-1]
+            if replies is None:
+                raise RedisError("Transação abortada")
+        else:
+            replies = self._execute_many(commands)
+        for reply in replies if isinstance(replies, list) else (replies,):
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def scan_iter(self, match, count=1000):
+        cursor = "0"
+        while True:
+            cursor, keys = self.execute("SCAN", cursor, "MATCH", match, "COUNT", count)
+            yield from keys
+            if cursor == "0":
+                return
+
+    def close(self):
+        with self._pool_lock:
+            connections, self._pool = self._pool, []
+        for connection in connections:
+            connection.close()
+
+# CARRINHOS
+
+def _ttl_ms(ttl):
+    return None if ttl is None or ttl == float("inf") else max(1, int(ttl * 1000))
+
+class RedisCartStore:
+    """Carrinhos em hashes do Redis, com a interface de ``storage.CartStore``
+
+    Cada item é um campo do hash ``<prefix>cart:<user_id>``, nomeado pelo
+    instante em nanossegundos para manter a ordem de inserção. Toda leitura
+    ou escrita renova o TTL da chave, e quem expira os carrinhos parados é o
+    próprio Redis (``sweep`` não tem o que fazer). Adicionar um item não lê o
+    carrinho antes: HSET + PEXPIRE + HGETALL vão numa única transação.
+    """
+
+    def __init__(self, client, ttl=24 * 60 * 60, prefix="bot:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f"{self.prefix}cart:{user_id}"
+
+    def _touch(self, key):
+        ttl_ms = _ttl_ms(self.ttl)
+        return ("PERSIST", key) if ttl_ms is None else ("PEXPIRE", key, ttl_ms)
+
+    @staticmethod
+    def _items(fields):
+        # HGETALL devolve [campo, valor, campo, valor, ...]
+        pairs = sorted(zip(fields[::2], fields[1::2]))
+        return [CartItem.from_dict(json.loads(value)) for _, value in pairs]
+
+    @staticmethod
+    def _field():
+        return f"{time.time_ns():016x}{secrets.token_hex(2)}"
+
+    def load(self):
+        """Nada a carregar: os carrinhos já estão no servidor"""
+
+    def save(self):
+        return True
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(self._key("*")))
+
+    def get(self, user_id):
+        key = self._key(user_id)
+        fields, _ = self.client.pipeline([("HGETALL", key), self._touch(key)])
+        return self._items(fields)
+
+    def add(self, user_id, item):
+        key = self._key(user_id)
+        item = json.dumps(item.to_dict(), ensure_ascii=False)
+        _, _, fields = self.client.pipeline([("HSET", key, self._field(), item), self._touch(key),
+                                             ("HGETALL", key)], transaction=True)
+        return self._items(fields)
+
+    def replace(self, user_id, items):
+        """Substitui os itens de um carrinho (vazio remove o carrinho)"""
+        key = self._key(user_id)
+        commands = [("DEL", key)]
+        if items:
+            values = []
+            for position, item in enumerate(items):
+                # Mesmo prefixo de tempo para todos: a posição decide a ordem
+                values += [f"{time.time_ns():016x}{position:08x}", json.dumps(item.to_dict(), ensure_ascii=False)]
+            commands += [("HSET", key, *values), self._touch(key)]
+        self.client.pipeline(commands, transaction=True)
+
+    def clear(self, user_id):
+        self.client.execute("DEL", self._key(user_id))
+
+    def sweep(self):
+        """O Redis expira os carrinhos sozinho"""
+        return 0
+
+# SESSÕES (python-telegram-bot)
+
+def _conversation_field(key):
+    return json.dumps(list(key))
+
+class RedisConversations(dict):
+    """Estados de uma ConversationHandler, lidos do Redis a cada consulta
+
+    A ConversationHandler guarda este dict ao ser registrada e o consulta a
+    cada update; como cada consulta vai ao servidor, uma réplica enxerga o
+    estado gravado por outra. As gravações chegam por
+    ``RedisPersistence.update_conversation``; localmente só ficam os estados
+    pendentes de handlers assíncronos (tuplas com uma Promise), até a
+    Promise terminar e o estado final ir para o Redis.
+    """
+
+    def __init__(self, persistence, name):
+        super().__init__()
+        self.persistence = persistence
+        self.name = name
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        local = dict.get(self, key)
+        if isinstance(local, tuple):
+            return local
+        state = self.persistence.load_conversation(self.name, key)
+        return default if state is None else state
+
+    def __getitem__(self, key):
+        state = self.get(key)
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key, state):
+        if not isinstance(state, tuple):
+            # O estado vai para o Redis por update_conversation; nada fica aqui
+            with self._lock:
+                dict.pop(self, key, None)
+            return
+        with self._lock:
+            dict.__setitem__(self, key, state)
+        promise = state[1]
+        if hasattr(promise, 'add_done_callback'):
+            promise.add_done_callback(lambda _: self._settle(key, state))
+
+    def _settle(self, key, state):
+        """Grava o resultado de um handler assíncrono e tira a tupla da memória
+
+        Mesma regra de ``ConversationHandler._resolve_promise``: sem resultado
+        (ou com erro) fica o estado anterior; sem nenhum dos dois, a conversa
+        termina. Sem isso a tupla ficaria aqui até o próximo update do
+        usuário, que pode nunca chegar.
+        """
+        old_state, promise = state
+        with self._lock:
+            if dict.get(self, key) is not state:
+                # A ConversationHandler já resolveu ou trocou o estado
+                return
+            try:
+                new_state = promise.result(0)
+            except Exception:
+                new_state = None
+            if new_state is None:
+                new_state = old_state
+            if new_state == CONVERSATION_END:
+                new_state = None
+            self.persistence.update_conversation(self.name, key, new_state)
+            dict.pop(self, key, None)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __delitem__(self, key):
+        with self._lock:
+            dict.pop(self, key, None)
+
+class RedisPersistence(BasePersistence):
+    """``context.user_data`` e ConversationHandlers persistentes no Redis
+
+    user_data de cada usuário é um JSON em ``<prefix>session:<id>`` que
+    expira após ``session_ttl`` segundos sem uso; é relido antes de cada
+    update (``refresh_user_data``) e gravado depois dele. Cada
+    ConversationHandler persistente (``persistent=True`` e ``name``) fica num
+    hash ``<prefix>conv:<nome>``. chat_data e bot_data não são usados pelo bot.
+    """
+
+    def __init__(self, client, prefix="bot:", session_ttl=7 * 24 * 60 * 60):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.client = client
+        self.prefix = prefix
+        self.session_ttl = session_ttl
+
+    def _session_key(self, user_id):
+        return f"{self.prefix}session:{user_id}"
+
+    def _conversation_key(self, name):
+        return f"{self.prefix}conv:{name}"
+
+    def get_user_data(self):
+        # Vazio: cada usuário é carregado sob demanda em refresh_user_data
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return RedisConversations(self, name)
+
+    def load_conversation(self, name, key):
+        raw = self.client.execute("HGET", self._conversation_key(name), _conversation_field(key))
+        return None if raw is None else json.loads(raw)
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple):
+            # Handler assíncrono ainda rodando; o estado final chega depois
+            return
+        field = _conversation_field(key)
+        if new_state is None:
+            self.client.execute("HDEL", self._conversation_key(name), field)
+        else:
+            self.client.execute("HSET", self._conversation_key(name), field, json.dumps(new_state))
+
+    def refresh_user_data(self, user_id, user_data):
+        raw = self.client.execute("GET", self._session_key(user_id))
+        user_data.clear()
+        if raw is not None:
+            user_data.update(json.loads(raw))
+
+    def update_user_data(self, user_id, data):
+        key = self._session_key(user_id)
+        if not data:
+            self.client.execute("DEL", key)
+            return
+        raw = json.dumps(data, ensure_ascii=False)
+        ttl_ms = _ttl_ms(self.session_ttl)
+        if ttl_ms is None:
+            self.client.execute("SET", key, raw)
+        else:
+            self.client.execute("SET", key, raw, "PX", ttl_ms)
+
+    def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    def refresh_bot_data(self, bot_data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self):
+        # Cada atualização já foi enviada ao servidor
+        pass
+
+# SERVIDOR EM PROCESSO
+
+class FakeRedisServer:
+    """Servidor RESP em memória com os comandos usados por este módulo
+
+    Sobe numa porta livre de 127.0.0.1 e atende cada conexão numa thread.
+    Suporta strings, hashes, expiração, SCAN e MULTI/EXEC; não é um Redis
+    completo e não persiste nada.
+
+        server = FakeRedisServer().start()
+        client = RedisClient(server.url)
+
+    ``clock`` (epoch em segundos) decide a expiração; testes podem passar um
+    relógio próprio e avançá-lo em vez de esperar o TTL.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, clock=time.time):
+        self._data = {}  # chave -> str ou dict
+        self._expires = {}  # chave -> epoch em ms
+        self._clock = clock
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                queued = None
+                while True:
+                    try:
+                        command = _read_reply(self.rfile)
+                    except (ConnectionError, OSError):
+                        return
+                    name = command[0].upper()
+                    if name == "MULTI":
+                        queued = []
+                        reply = "OK"
+                    elif name == "EXEC":
+                        if queued is None:
+                            reply = RedisError("ERR EXEC without MULTI")
+                        else:
+                            with server._lock:
+                                reply = [server._dispatch(queued_command) for queued_command in queued]
+                            queued = None
+                    elif name == "DISCARD":
+                        queued = None
+                        reply = "OK"
+                    elif queued is not None:
+                        queued.append(command)
+                        reply = "QUEUED"
+                    else:
+                        with server._lock:
+                            reply = server._dispatch(command)
+                    self.wfile.write(_encode_reply(reply))
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        self._server.daemon_threads = True
+        self._server.allow_reuse_address = True
+        self._server.server_bind()
+        self._server.server_activate()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-redis", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _alive(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= self._clock() * 1000:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _hash(self, key):
+        value = self._data.get(key) if self._alive(key) else None
+        if value is not None and not isinstance(value, dict):
+            raise RedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _dispatch(self, command):
+        try:
+            return self._run(command[0].upper(), command[1:])
+        except RedisError as e:
+            return e
+        except (IndexError, ValueError):
+            return RedisError(f"ERR wrong arguments for '{command[0].lower()}' command")
+
+    def _run(self, name, args):
+        if name == "PING":
+            return "PONG"
+        if name in ("AUTH", "SELECT"):
+            return "OK"
+        if name == "FLUSHDB":
+            self._data.clear()
+            self._expires.clear()
+            return "OK"
+        if name == "GET":
+            value = self._data.get(args[0]) if self._alive(args[0]) else None
+            if isinstance(value, dict):
+                raise RedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+            return value
+        if name == "SET":
+            self._data[args[0]] = args[1]
+            self._expires.pop(args[0], None)
+            options = [option.upper() for option in args[2::2]]
+            for option, value in zip(options, args[3::2]):
+                if option in ("EX", "PX"):
+                    self._expires[args[0]] = self._clock() * 1000 + int(value) * (1000 if option == "EX" else 1)
+            return "OK"
+        if name == "DEL":
+            removed = 0
+            for key in args:
+                if self._alive(key):
+                    del self._data[key]
+                    self._expires.pop(key, None)
+                    removed += 1
+            return removed
+        if name == "EXISTS":
+            return sum(1 for key in args if self._alive(key))
+        if name in ("EXPIRE", "PEXPIRE"):
+            if not self._alive(args[0]):
+                return 0
+            self._expires[args[0]] = self._clock() * 1000 + int(args[1]) * (1000 if name == "EXPIRE" else 1)
+            return 1
+        if name == "PERSIST":
+            return 1 if self._alive(args[0]) and self._expires.pop(args[0], None) is not None else 0
+        if name == "PTTL":
+            if not self._alive(args[0]):
+                return -2
+            expires = self._expires.get(args[0])
+            return -1 if expires is None else int(expires - self._clock() * 1000)
+        if name == "HSET":
+            if len(args) < 3 or len(args) % 2 == 0:
+                raise ValueError(name)
+            value = self._hash(args[0])
+            if value is None:
+                value = self._data[args[0]] = {}
+            added = sum(1 for field in args[1::2] if field not in value)
+            value.update(zip(args[1::2], args[2::2]))
+            return added
+        if name == "HGET":
+            return (self._hash(args[0]) or {}).get(args[1])
+        if name == "HGETALL":
+            return [part for pair in (self._hash(args[0]) or {}).items() for part in pair]
+        if name == "HLEN":
+            return len(self._hash(args[0]) or {})
+        if name == "HDEL":
+            value = self._hash(args[0])
+            if value is None:
+                return 0
+            removed = sum(1 for field in args[1:] if value.pop(field, None) is not None)
+            if not value:
+                del self._data[args[0]]
+                self._expires.pop(args[0], None)
+            return removed
+        if name == "SCAN":
+            # Um cursor só: devolve tudo de uma vez
+            options = dict(zip((option.upper() for option in args[1::2]), args[2::2]))
+            pattern = options.get("MATCH", "*")
+            return ["0", [key for key in list(self._data) if self._alive(key) and fnmatch.fnmatchcase(key, pattern)]]
+        raise RedisError(f"ERR unknown command '{name.lower()}'")
+
+def _encode_reply(reply):
+    if isinstance(reply, RedisError):
+        return b"-%s\r\n" % str(reply).encode('utf-8')
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, bool):
+        reply = int(reply)
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(_encode_reply(item) for item in reply)
+    if reply in ("OK", "QUEUED", "PONG"):
+        return b"+%s\r\n" % reply.encode('utf-8')
+    data = reply.encode('utf-8')
+    return b"$%d\r\n%s\r\n" % (len(data), data)
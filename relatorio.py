@@ -1,25 +1,43 @@
-import json
 import pandas as pd
-from datetime import datetime
 import os
 
-def gerar_relatorio_mensal(caminho_arquivo="data/orders.json", saida_csv="data/relatorio_mensal.csv"):
-    if not os.path.exists(caminho_arquivo):
+from storage import DataStore
+
+JOURNAL_FILES = ("journal.log", "journal.log.1")
+
+def gerar_relatorio_mensal(caminho_arquivo="data", saida_csv="data/relatorio_mensal.csv", inicio=None, fim=None,
+                           diretorio_dados=None):
+    """Gera o CSV mensal dos pedidos pagos criados entre ``inicio`` e ``fim`` (datetime, opcionais)
+
+    ``caminho_arquivo`` pode ser o diretório de dados ou, como antes, o
+    caminho de um arquivo de pedidos dentro dele (ex.: data/orders.json).
+    """
+    if diretorio_dados is None:
+        diretorio_dados = (caminho_arquivo if os.path.isdir(caminho_arquivo)
+                           else os.path.dirname(caminho_arquivo) or ".")
+    # O journal, se existir, tem os pedidos que ainda não chegaram ao arquivo
+    journal = any(os.path.exists(os.path.join(diretorio_dados, nome)) for nome in JOURNAL_FILES)
+    if not journal and not os.path.exists(os.path.join(diretorio_dados, "orders.jsonl")):
         print("Arquivo de pedidos não encontrado.")
         return
 
-    with open(caminho_arquivo, "r", encoding="utf-8") as f:
-        pedidos = json.load(f)
+    # Somente leitura: o bot pode estar rodando sobre o mesmo diretório
+    db = DataStore(diretorio_dados, journal=journal, read_only=True)
+    inicio_ts = inicio.timestamp() if inicio else None
+    fim_ts = fim.timestamp() if fim else None
 
     dados = []
-    for pedido in pedidos.values():
-        if pedido.get("status") != "pago":
-            continue
-        data = datetime.strptime(pedido["created_at"], "%Y-%m-%d %H:%M:%S")
-        mes = data.strftime("%Y-%m")
-        total = sum(item["price"] for item in pedido["items"])
-        quantidade = len(pedido["items"])
-        dados.append({"mes": mes, "total": total, "quantidade": quantidade})
+    try:
+        # Só os pedidos do período são lidos, já em ordem de criação
+        for pedido in db.iter_orders_between(inicio_ts, fim_ts):
+            if pedido.status != "pago":
+                continue
+            mes = pedido.created_at[:7]
+            total = sum(item.price for item in pedido.items)
+            quantidade = len(pedido.items)
+            dados.append({"mes": mes, "total": total, "quantidade": quantidade})
+    finally:
+        db.close()
 
     if not dados:
         print("Nenhum pedido pago encontrado.")
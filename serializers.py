@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""Formatos de serialização dos arquivos de dados
+
+Cada ``Serializer`` converte entre objetos Python (dicts, listas, números,
+strings) e bytes, e sabe gravar um arquivo de forma atômica. Os formatos:
+
+- ``json``: JSON indentado, legível e bom para diffs (o padrão);
+- ``json-compact``: JSON sem espaços;
+- ``msgpack``: binário MessagePack, com a biblioteca ``msgpack`` quando
+  instalada e um codificador próprio em Python puro quando não;
+- ``json-compact+gz`` e ``msgpack+gz``: os anteriores comprimidos com gzip.
+
+Conversor de arquivos existentes:
+    python serializers.py convert data --to msgpack
+"""
+
+import abc
+import argparse
+import gzip
+import json
+import logging
+import os
+import shutil
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger('bot.storage')
+
+# UTILITÁRIOS DE ARQUIVO
+
+def fsync_directory(path):
+    """Garante no disco a entrada de diretório de ``path`` (após um rename)"""
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:  # Windows não abre diretórios
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+_WHITESPACE = " \t\n\r"
+_VALUE_END = _WHITESPACE + ",:}]"
+
+def iter_json_object(path, chunk_size=64 * 1024):
+    """Percorre os pares (chave, valor) do objeto JSON de nível superior em ``path``
+
+    Lê o arquivo em blocos de ``chunk_size`` caracteres e decodifica um
+    valor por vez, então o pico de memória é um bloco mais o maior valor, e
+    não o texto inteiro mais todos os dicts.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ""
+        position = 0
+        eof = False
+
+        def fill():
+            # Descarta o que já foi consumido e lê mais um bloco
+            nonlocal buffer, position, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        def next_char():
+            # Próximo caractere que não é espaço (sem consumir), ou "" no fim
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in _WHITESPACE:
+                    position += 1
+                if position < len(buffer) or eof:
+                    return buffer[position:position + 1]
+                fill()
+
+        def decode():
+            # Decodifica um valor completo, lendo mais blocos se ele estiver cortado
+            nonlocal position
+            next_char()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+                    continue
+                # Um número cortado no fim do bloco ("-2.5e") decodifica só o
+                # começo; depois de um valor completo vem um separador
+                if not eof and (end == len(buffer) or buffer[end] not in _VALUE_END):
+                    fill()
+                    continue
+                position = end
+                return value
+
+        if next_char() != "{":
+            raise ValueError(f"{path}: esperado um objeto JSON")
+        position += 1
+        if next_char() == "}":
+            return
+        while True:
+            key = decode()
+            if next_char() != ":":
+                raise ValueError(f"{path}: esperado ':' após a chave {key!r}")
+            position += 1
+            yield key, decode()
+            separator = next_char()
+            position += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"{path}: esperado ',' ou '}}' após a chave {key!r}")
+
+class Serializer(abc.ABC):
+    """Interface comum dos formatos"""
+
+    name = None
+    extension = None
+
+    @abc.abstractmethod
+    def dumps(self, data):
+        """Objeto Python -> bytes"""
+
+    @abc.abstractmethod
+    def loads(self, raw):
+        """bytes -> objeto Python"""
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            return self.loads(f.read())
+
+    def iter_items(self, path):
+        """Pares (chave, valor) do dict gravado em ``path``"""
+        return iter(self.load(path).items())
+
+    def dump(self, path, data, fsync=False):
+        """Grava em arquivo temporário e o renomeia sobre o destino"""
+        raw = self.dumps(data)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(raw)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if fsync:
+            fsync_directory(path)
+
+class JsonSerializer(Serializer):
+    name = "json"
+    extension = ".json"
+
+    def __init__(self, indent=2):
+        self.indent = indent
+
+    def dumps(self, data):
+        return json.dumps(data, ensure_ascii=False, indent=self.indent).encode('utf-8')
+
+    def loads(self, raw):
+        return json.loads(raw)
+
+    def iter_items(self, path):
+        # Um registro por vez, sem manter o texto inteiro em memória
+        return iter_json_object(path)
+
+class CompactJsonSerializer(JsonSerializer):
+    name = "json-compact"
+
+    def __init__(self):
+        super().__init__(indent=None)
+
+    def dumps(self, data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# MessagePack em Python puro (subconjunto usado pelos dados do bot:
+# nil, bool, int, float, str, bin, array e map)
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(b"\xc0")
+    elif obj is True:
+        out.append(b"\xc3")
+    elif obj is False:
+        out.append(b"\xc2")
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(struct.pack("B", obj))
+        elif -32 <= obj < 0:
+            out.append(struct.pack("b", obj))
+        elif 0 <= obj <= 0xff:
+            out.append(struct.pack(">BB", 0xcc, obj))
+        elif 0 <= obj <= 0xffff:
+            out.append(struct.pack(">BH", 0xcd, obj))
+        elif 0 <= obj <= 0xffffffff:
+            out.append(struct.pack(">BI", 0xce, obj))
+        elif 0 <= obj <= 0xffffffffffffffff:
+            out.append(struct.pack(">BQ", 0xcf, obj))
+        elif -0x80 <= obj < 0:
+            out.append(struct.pack(">Bb", 0xd0, obj))
+        elif -0x8000 <= obj < 0:
+            out.append(struct.pack(">Bh", 0xd1, obj))
+        elif -0x80000000 <= obj < 0:
+            out.append(struct.pack(">Bi", 0xd2, obj))
+        elif -0x8000000000000000 <= obj < 0:
+            out.append(struct.pack(">Bq", 0xd3, obj))
+        else:
+            raise ValueError(f"inteiro fora do alcance do msgpack: {obj}")
+    elif isinstance(obj, float):
+        out.append(struct.pack(">Bd", 0xcb, obj))
+    elif isinstance(obj, str):
+        raw = obj.encode('utf-8')
+        size = len(raw)
+        if size < 32:
+            out.append(struct.pack("B", 0xa0 | size))
+        elif size <= 0xff:
+            out.append(struct.pack(">BB", 0xd9, size))
+        elif size <= 0xffff:
+            out.append(struct.pack(">BH", 0xda, size))
+        else:
+            out.append(struct.pack(">BI", 0xdb, size))
+        out.append(raw)
+    elif isinstance(obj, (bytes, bytearray)):
+        size = len(obj)
+        if size <= 0xff:
+            out.append(struct.pack(">BB", 0xc4, size))
+        elif size <= 0xffff:
+            out.append(struct.pack(">BH", 0xc5, size))
+        else:
+            out.append(struct.pack(">BI", 0xc6, size))
+        out.append(bytes(obj))
+    elif isinstance(obj, (list, tuple)):
+        size = len(obj)
+        if size < 16:
+            out.append(struct.pack("B", 0x90 | size))
+        elif size <= 0xffff:
+            out.append(struct.pack(">BH", 0xdc, size))
+        else:
+            out.append(struct.pack(">BI", 0xdd, size))
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        size = len(obj)
+        if size < 16:
+            out.append(struct.pack("B", 0x80 | size))
+        elif size <= 0xffff:
+            out.append(struct.pack(">BH", 0xde, size))
+        else:
+            out.append(struct.pack(">BI", 0xdf, size))
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError(f"tipo não serializável em msgpack: {type(obj).__name__}")
+
+# Código -> (formato struct do tamanho/valor, bytes lidos)
+_FIXED = {
+    0xcc: (">B", 1), 0xcd: (">H", 2), 0xce: (">I", 4), 0xcf: (">Q", 8),
+    0xd0: (">b", 1), 0xd1: (">h", 2), 0xd2: (">i", 4), 0xd3: (">q", 8),
+    0xca: (">f", 4), 0xcb: (">d", 8),
+}
+_STR_SIZE = {0xd9: (">B", 1), 0xda: (">H", 2), 0xdb: (">I", 4)}
+_BIN_SIZE = {0xc4: (">B", 1), 0xc5: (">H", 2), 0xc6: (">I", 4)}
+_ARRAY_SIZE = {0xdc: (">H", 2), 0xdd: (">I", 4)}
+_MAP_SIZE = {0xde: (">H", 2), 0xdf: (">I", 4)}
+
+def _unpack(raw, position):
+    code = raw[position]
+    position += 1
+    if code < 0x80:
+        return code, position
+    if code >= 0xe0:
+        return code - 0x100, position
+    if 0xa0 <= code <= 0xbf:
+        end = position + (code & 0x1f)
+        return raw[position:end].decode('utf-8'), end
+    if 0x90 <= code <= 0x9f:
+        return _unpack_array(raw, position, code & 0x0f)
+    if 0x80 <= code <= 0x8f:
+        return _unpack_map(raw, position, code & 0x0f)
+    if code == 0xc0:
+        return None, position
+    if code == 0xc2:
+        return False, position
+    if code == 0xc3:
+        return True, position
+    if code in _FIXED:
+        fmt, size = _FIXED[code]
+        return struct.unpack_from(fmt, raw, position)[0], position + size
+    for sizes, kind in ((_STR_SIZE, 'str'), (_BIN_SIZE, 'bin'), (_ARRAY_SIZE, 'array'), (_MAP_SIZE, 'map')):
+        if code in sizes:
+            fmt, size = sizes[code]
+            length = struct.unpack_from(fmt, raw, position)[0]
+            position += size
+            if kind == 'str':
+                return raw[position:position + length].decode('utf-8'), position + length
+            if kind == 'bin':
+                return bytes(raw[position:position + length]), position + length
+            if kind == 'array':
+                return _unpack_array(raw, position, length)
+            return _unpack_map(raw, position, length)
+    raise ValueError(f"código msgpack não suportado: 0x{code:02x}")
+
+def _unpack_array(raw, position, length):
+    items = []
+    for _ in range(length):
+        item, position = _unpack(raw, position)
+        items.append(item)
+    return items, position
+
+def _unpack_map(raw, position, length):
+    result = {}
+    for _ in range(length):
+        key, position = _unpack(raw, position)
+        value, position = _unpack(raw, position)
+        result[key] = value
+    return result, position
+
+class MsgpackSerializer(Serializer):
+    name = "msgpack"
+    extension = ".msgpack"
+
+    def dumps(self, data):
+        if msgpack is not None:
+            return msgpack.packb(data, use_bin_type=True)
+        out = []
+        _pack(data, out)
+        return b"".join(out)
+
+    def loads(self, raw):
+        if msgpack is not None:
+            return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        value, end = _unpack(raw, 0)
+        if end != len(raw):
+            raise ValueError(f"{len(raw) - end} bytes sobrando após o valor msgpack")
+        return value
+
+class GzipSerializer(Serializer):
+    """Comprime com gzip a saída de outro formato"""
+
+    def __init__(self, inner, level=6):
+        self.inner = inner
+        self.level = level
+        self.name = f"{inner.name}+gz"
+        self.extension = f"{inner.extension}.gz"
+
+    def dumps(self, data):
+        # mtime fixo: o mesmo conteúdo gera os mesmos bytes
+        return gzip.compress(self.inner.dumps(data), compresslevel=self.level, mtime=0)
+
+    def loads(self, raw):
+        return self.inner.loads(gzip.decompress(raw))
+
+DEFAULT_SERIALIZER = "json"
+
+SERIALIZERS = {serializer.name: serializer for serializer in (
+    JsonSerializer(),
+    CompactJsonSerializer(),
+    MsgpackSerializer(),
+    GzipSerializer(CompactJsonSerializer()),
+    GzipSerializer(MsgpackSerializer()),
+)}
+
+def get_serializer(name):
+    """Serializer registrado com esse nome"""
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(f"Formato de serialização desconhecido: {name} "
+                         f"(disponíveis: {', '.join(SERIALIZERS)})")
+
+def detect_serializer(path):
+    """Formato de um arquivo existente, pela extensão (o JSON indentado para .json)"""
+    best = None
+    for serializer in SERIALIZERS.values():
+        if path.endswith(serializer.extension) and (best is None or len(serializer.extension) > len(best.extension)):
+            best = serializer
+    return best
+
+def find_data_file(directory, stem):
+    """Arquivo ``stem`` existente em ``directory`` em qualquer formato, ou None"""
+    for serializer in SERIALIZERS.values():
+        path = os.path.join(directory, stem + serializer.extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+# Arquivos de dados convertidos pelo conversor (os demais já têm formato próprio)
+DATA_FILES = ("users", "carts", "catalog")
+
+def convert_directory(directory, target, keep_backup=True):
+    """Converte os arquivos de dados de ``directory`` para o formato ``target``
+
+    Returns:
+        list: tuplas (origem, destino) convertidas
+    """
+    serializer = get_serializer(target)
+    converted = []
+    for stem in DATA_FILES:
+        source = find_data_file(directory, stem)
+        if source is None:
+            continue
+        destination = os.path.join(directory, stem + serializer.extension)
+        source_serializer = detect_serializer(source)
+        if source == destination and source_serializer.name == serializer.name:
+            continue
+        data = source_serializer.load(source)
+        if source == destination and keep_backup:
+            shutil.copy2(source, source + ".bak")
+        # O destino é gravado (e sincronizado) antes de a origem sair do lugar
+        serializer.dump(destination, data, fsync=True)
+        if source != destination:
+            if keep_backup:
+                os.replace(source, source + ".bak")
+            else:
+                os.remove(source)
+        converted.append((source, destination))
+        logger.info(f"{source} convertido para {destination}")
+    return converted
+
+def main():
+    parser = argparse.ArgumentParser(description="Ferramentas de formato dos arquivos de dados")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="converte users/carts/catalog para outro formato")
+    convert_parser.add_argument("directory", nargs="?", default="data")
+    convert_parser.add_argument("--to", required=True, choices=list(SERIALIZERS))
+    convert_parser.add_argument("--no-backup", action="store_true", help="apaga os originais em vez de *.bak")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    converted = convert_directory(args.directory, args.to, keep_backup=not args.no_backup)
+    print(f"{len(converted)} arquivos convertidos")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1775 @@
+# -*- coding: utf-8 -*-
+"""Modelos e armazenamento persistente do bot (usuários, carrinhos e pedidos).
+
+Este módulo não depende do Telegram nem do Mercado Pago, de modo que pode
+ser importado por scripts auxiliares sem iniciar o bot.
+"""
+
+import bisect
+import gzip
+import heapq
+import json
+import logging
+import mmap
+import os
+import secrets
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import MutableMapping
+from datetime import datetime
+
+from serializers import (DEFAULT_SERIALIZER, detect_serializer, find_data_file, fsync_directory, get_serializer,
+                         iter_json_object)
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos
+    fcntl = None
+
+logger = logging.getLogger('bot.storage')
+
+# CLASSES DE MODELO
+#
+# Os modelos usam __slots__ (sem __dict__ por instância) e internam os textos
+# que se repetem entre milhares de pedidos (nomes de produto, status e chaves
+# de ``details``), para que cada cópia carregada do disco aponte para a mesma
+# string em vez de guardar a sua.
+
+def _intern_details(details):
+    """Recria ``details`` com as chaves (e as de ``fields``) internadas"""
+    interned = {}
+    for key, value in details.items():
+        if key == 'fields' and isinstance(value, dict):
+            value = {sys.intern(field): field_value for field, field_value in value.items()}
+        elif key == 'kind' and isinstance(value, str):
+            value = sys.intern(value)
+        interned[sys.intern(key)] = value
+    return interned
+
+class User:
+    __slots__ = ('id', 'nome', 'telefone')
+
+    def __init__(self, id, nome, telefone):
+        self.id = id
+        self.nome = nome
+        self.telefone = telefone
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'nome': self.nome,
+            'telefone': self.telefone
+        }
+
+class CartItem:
+    __slots__ = ('name', 'price', 'details')
+
+    def __init__(self, name, price, details=None):
+        self.name = sys.intern(name) if type(name) is str else name
+        self.price = price
+        self.details = _intern_details(details) if details else {}
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'price': self.price,
+            'details': self.details
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            name=data['name'],
+            price=data['price'],
+            # Itens soltos (carrinhos) não têm versão: a atualização é idempotente
+            details=upgrade_details(data.get('details'))
+        )
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def parse_created_at(value):
+    """Converte a data textual dos registros antigos para epoch (segundos)"""
+    try:
+        return datetime.strptime(value, DATE_FORMAT).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def record_created_ts(data):
+    """Momento de criação de um pedido serializado (epoch), ou None se ausente"""
+    created_ts = data.get('created_ts')
+    if created_ts is None:
+        # Registros anteriores ao created_ts só têm a data formatada
+        created_ts = parse_created_at(data.get('created_at'))
+    return created_ts
+
+# VERSÕES DOS REGISTROS
+#
+# Pedidos e carrinhos gravados levam "v", a versão do formato em que foram
+# escritos (sem "v" = versão 0). Registros antigos são atualizados em memória
+# ao serem lidos e só saem no formato novo quando são regravados: por uma
+# mutação ou pela passada de fundo ``upgrade_records``. Mudar o formato não
+# custa uma regravação dos arquivos no boot.
+#
+#   1: created_ts (epoch) ao lado do created_at textual
+#   2: ``details`` dos itens identificado por "kind" (credits, app ou fixed)
+
+SCHEMA_VERSION = 2
+
+def upgrade_details(details):
+    """``details`` de um item no formato atual, com "kind"
+
+    Formatos antigos, pela origem do item:
+        {"credits": 20, "discount": true, "original_price": 13.5}  créditos
+        {"fields": {"MAC": "..."}}                                 app com campos do cliente
+        {"tipo": "preço fixo", "discount": false}                  preço fixo
+    """
+    if not details or 'kind' in details:
+        return details or {}
+    if 'credits' in details:
+        kind = 'credits'
+    elif 'fields' in details:
+        kind = 'app'
+    elif details.get('tipo') == "preço fixo":
+        kind = 'fixed'
+    else:
+        return details
+    upgraded = {'kind': kind}
+    upgraded.update((key, value) for key, value in details.items() if key != 'tipo')
+    return upgraded
+
+def upgrade_order(data):
+    """Atualiza um pedido serializado para SCHEMA_VERSION (altera e retorna o próprio dict)"""
+    version = data.get('v', 0)
+    if version >= SCHEMA_VERSION:
+        return data
+    if version < 1:
+        data['created_ts'] = record_created_ts(data)
+    if version < 2:
+        data['items'] = [dict(item, details=upgrade_details(item.get('details'))) for item in data['items']]
+    data['v'] = SCHEMA_VERSION
+    return data
+
+class Order:
+    __slots__ = ('id', 'user_id', 'items', 'status', 'payment_id', 'created_ts')
+
+    def __init__(self, id, user_id, items, status="pendente", payment_id=None, created_ts=None):
+        self.id = id
+        self.user_id = user_id
+        self.items = [CartItem.from_dict(item) if isinstance(item, dict) else item for item in items]
+        self.status = sys.intern(status) if type(status) is str else status
+        self.payment_id = payment_id
+        # Epoch em segundos: ordena como número e sobrevive a reinícios
+        self.created_ts = created_ts if created_ts is not None else time.time()
+
+    @property
+    def created_at(self):
+        """Data de criação formatada para exibição"""
+        return datetime.fromtimestamp(self.created_ts).strftime(DATE_FORMAT)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'items': [item.to_dict() for item in self.items],
+            'status': self.status,
+            'payment_id': self.payment_id,
+            'created_ts': self.created_ts,
+            'created_at': self.created_at,
+            'v': SCHEMA_VERSION
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        data = upgrade_order(data)
+        return cls(
+            id=data['id'],
+            user_id=data['user_id'],
+            items=data['items'],
+            status=data.get('status', 'pendente'),
+            payment_id=data.get('payment_id'),
+            created_ts=data['created_ts']
+        )
+
+# Alfabeto base 36 em ordem ASCII, para que os IDs ordenem como texto
+_ID_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def _base36(value, width):
+    digits = []
+    for _ in range(width):
+        value, remainder = divmod(value, 36)
+        digits.append(_ID_ALPHABET[remainder])
+    return "".join(reversed(digits))
+
+def generate_order_id():
+    """Gera um ID de pedido ordenável pelo momento de criação
+
+    Nove dígitos base 36 com os milissegundos desde a epoch seguidos de
+    quatro aleatórios. Sem "_", pois os IDs vão em callback_data separado
+    por "_". Quem grava deve conferir colisões com os pedidos existentes.
+    """
+    return _base36(int(time.time() * 1000), 9) + _base36(secrets.randbelow(36 ** 4), 4)
+
+# UTILITÁRIOS DE ARQUIVO
+
+def write_json_atomic(path, data, indent=2, fsync=False):
+    """Grava JSON em arquivo temporário e o renomeia sobre o destino
+
+    Assim um leitor (ou uma queda do processo no meio da escrita) nunca vê um
+    arquivo truncado. Com ``fsync`` o conteúdo e o rename chegam ao disco
+    antes do retorno, sobrevivendo também a uma queda de energia.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if fsync:
+        fsync_directory(path)
+
+def read_orders_jsonl(path):
+    """Lê um arquivo orders.jsonl para um dict order_id -> dados (última versão vence)"""
+    orders = {}
+    if not os.path.exists(path):
+        return orders
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if data.get('deleted'):
+                orders.pop(data['id'], None)
+            else:
+                orders[data['id']] = data
+    return orders
+
+class LazyOrderMap(MutableMapping):
+    """Pedidos em orders.jsonl, hidratados sob demanda
+
+    Cada linha do arquivo é a versão completa de um pedido (ou uma marca de
+    remoção). Em memória fica apenas order_id -> (offset, tamanho) da última
+    versão; o objeto ``Order`` só é montado quando o pedido é acessado.
+    Pedidos novos ou alterados ficam presos em memória até serem gravados,
+    e os já gravados ficam num cache LRU de ``cache_size`` entradas.
+
+    Gravar significa acrescentar as linhas dos pedidos alterados; quando as
+    versões obsoletas passam a ocupar mais espaço que as válidas o arquivo é
+    compactado copiando só as linhas válidas, sem desserializá-las.
+    """
+
+    # Não compactar arquivos pequenos
+    COMPACT_MIN_BYTES = 1024 * 1024
+
+    def __init__(self, path, use_mmap=False, cache_size=1024, read_only=False):
+        self.path = path
+        self.use_mmap = use_mmap
+        self.read_only = read_only
+        self.cache_size = cache_size
+        self._lock = threading.RLock()
+        self._locations = {}  # order_id -> (offset, tamanho) ou None se ainda não gravado
+        self._pinned = {}  # order_id -> Order novo/alterado, ainda não gravado
+        self._dirty = {}  # order_id -> None (gravar) ou True (remover)
+        self._cache = OrderedDict()  # order_id -> Order hidratado e limpo
+        self._live_bytes = 0
+        self._garbage_bytes = 0
+        self._file = None
+        self._mmap = None
+        # De onde ``stale_ids`` continua procurando versões antigas (None: não há)
+        self._upgrade_offset = None
+        self._compactions = 0
+
+    def load(self):
+        """Percorre o arquivo montando o índice de offsets
+
+        Returns:
+            iterável de tuplas (order_id, user_id, status, payment_id,
+            created_ts) dos pedidos válidos, para os índices do DataStore
+        """
+        entries = {}
+        if os.path.exists(self.path):
+            offset = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Só a última linha pode não ter o fim: cortada por uma
+                        # queda. Descartá-la para que o próximo append não a continue
+                        logger.warning(f"{self.path}: descartando a linha incompleta no byte {offset}")
+                        break
+                    try:
+                        data = json.loads(line)
+                        if not isinstance(data, dict) or 'id' not in data or \
+                                not (data.get('deleted') or 'user_id' in data):
+                            raise ValueError("registro sem id ou user_id")
+                    except ValueError as e:
+                        # Linha corrompida no meio do arquivo (ex.: disco cheio
+                        # e appends depois): pular sem perder as seguintes. A
+                        # próxima compactação a remove
+                        logger.warning(f"{self.path}: ignorando a linha corrompida no byte {offset}: {e}")
+                        self._garbage_bytes += len(line)
+                        offset += len(line)
+                        continue
+                    previous = self._locations.pop(data['id'], None)
+                    if previous:
+                        self._live_bytes -= previous[1]
+                        self._garbage_bytes += previous[1]
+                    if data.get('deleted'):
+                        self._garbage_bytes += len(line)
+                        entries.pop(data['id'], None)
+                    else:
+                        self._locations[data['id']] = (offset, len(line))
+                        self._live_bytes += len(line)
+                        if self._upgrade_offset is None and data.get('v', 0) < SCHEMA_VERSION:
+                            self._upgrade_offset = offset
+                        entries[data['id']] = (data['id'], data['user_id'],
+                                               data.get('status', 'pendente'), data.get('payment_id'),
+                                               record_created_ts(data) or 0.0)
+                    offset += len(line)
+            # Somente leitura: a linha "incompleta" pode ser um append em andamento
+            if offset != os.path.getsize(self.path) and not self.read_only:
+                with open(self.path, 'r+b') as f:
+                    f.truncate(offset)
+        self._open()
+        return entries.values()
+
+    def _open(self):
+        """(Re)abre o arquivo para leitura das linhas (com _lock)"""
+        self._close_handles()
+        if not os.path.exists(self.path):
+            if self.read_only:
+                # Sem arquivo não há linhas a ler, e somente leitura não cria nada
+                return
+            open(self.path, 'ab').close()
+        self._file = open(self.path, 'rb')
+
+    def _close_handles(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close_handles()
+
+    def _read_line(self, offset, length):
+        """Lê os bytes de uma versão gravada (com _lock)"""
+        if self.use_mmap:
+            if self._mmap is None or self._mmap.size() < offset + length:
+                if self._mmap is not None:
+                    self._mmap.close()
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._mmap[offset:offset + length]
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def raw_line(self, order_id):
+        """Bytes da versão gravada de um pedido, sem hidratá-lo"""
+        with self._lock:
+            location = self._locations.get(order_id)
+            return self._read_line(*location) if location else None
+
+    def __getitem__(self, order_id):
+        with self._lock:
+            order = self._pinned.get(order_id)
+            if order is not None:
+                return order
+            order = self._cache.get(order_id)
+            if order is not None:
+                self._cache.move_to_end(order_id)
+                return order
+            location = self._locations.get(order_id)
+            if location is None:
+                raise KeyError(order_id)
+            data = json.loads(self._read_line(*location))
+            order = Order.from_dict(data)
+            self._cache[order_id] = order
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return order
+
+    def __setitem__(self, order_id, order):
+        with self._lock:
+            self._cache.pop(order_id, None)
+            self._pinned[order_id] = order
+            self._locations.setdefault(order_id, None)
+            self._dirty[order_id] = None
+
+    def __delitem__(self, order_id):
+        with self._lock:
+            if order_id not in self._locations:
+                raise KeyError(order_id)
+            self._cache.pop(order_id, None)
+            self._pinned.pop(order_id, None)
+            if self._locations.pop(order_id) is None:
+                # Nunca foi gravado: nada a remover do arquivo
+                self._dirty.pop(order_id, None)
+            else:
+                self._dirty[order_id] = True
+
+    def __contains__(self, order_id):
+        return order_id in self._locations
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._locations))
+
+    def __len__(self):
+        return len(self._locations)
+
+    def mark_dirty(self, order_id):
+        """Marca um pedido já existente como alterado (prendendo-o em memória)"""
+        self[order_id] = self[order_id]
+
+    def stale_ids(self, limit):
+        """Até ``limit`` pedidos cuja versão gravada é anterior a SCHEMA_VERSION
+
+        Lê o arquivo a partir de onde a chamada anterior parou, sem segurar o
+        lock durante a leitura. Pedidos regravados vão para o fim do arquivo
+        já na versão atual e são pulados quando a leitura chega neles.
+        """
+        with self._lock:
+            start = self._upgrade_offset
+            compactions = self._compactions
+        if start is None:
+            return []
+        order_ids = []
+        offset = start
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Append em andamento
+                    break
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # Linha corrompida, já ignorada por load
+                    data = None
+                if isinstance(data, dict) and not data.get('deleted') and data.get('v', 0) < SCHEMA_VERSION:
+                    with self._lock:
+                        # Só a versão vigente do pedido interessa
+                        if self._locations.get(data.get('id')) == (offset, len(line)):
+                            order_ids.append(data['id'])
+                offset += len(line)
+                if len(order_ids) >= limit:
+                    break
+            at_end = len(order_ids) < limit and offset >= os.fstat(f.fileno()).st_size
+        with self._lock:
+            # Uma compactação no meio invalida os offsets; ela já recomeçou a busca
+            if self._compactions == compactions:
+                self._upgrade_offset = None if at_end else offset
+        return order_ids
+
+    def take_changes(self):
+        """Serializa os pedidos alterados para gravação (chamar com o lock do DataStore)
+
+        Returns:
+            list: tuplas (order_id, linha em bytes)
+        """
+        with self._lock:
+            changes = []
+            for order_id, deleted in self._dirty.items():
+                if deleted:
+                    record = {'id': order_id, 'deleted': True}
+                else:
+                    record = self._pinned[order_id].to_dict()
+                changes.append((order_id, (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n").encode('utf-8')))
+            self._dirty = {}
+            return changes
+
+    def write_changes(self, changes, fsync=False):
+        """Acrescenta as linhas ao arquivo e atualiza os offsets"""
+        if not changes:
+            return
+        try:
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write(b"".join(line for _, line in changes))
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception:
+            with self._lock:
+                for order_id, line in changes:
+                    self._dirty.setdefault(order_id, None if order_id in self._pinned else True)
+            raise
+
+        with self._lock:
+            for order_id, line in changes:
+                previous = self._locations.get(order_id)
+                if previous:
+                    self._live_bytes -= previous[1]
+                    self._garbage_bytes += previous[1]
+                if order_id in self._locations:
+                    self._locations[order_id] = (offset, len(line))
+                    self._live_bytes += len(line)
+                    # Gravado: pode sair da memória, salvo se mudou de novo
+                    if order_id not in self._dirty:
+                        order = self._pinned.pop(order_id, None)
+                        if order is not None:
+                            self._cache[order_id] = order
+                else:
+                    self._garbage_bytes += len(line)
+                offset += len(line)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        if self._garbage_bytes > max(self._live_bytes, self.COMPACT_MIN_BYTES):
+            self.compact(fsync=fsync)
+
+    def compact(self, fsync=False):
+        """Regrava o arquivo só com a última versão gravada de cada pedido"""
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            new_locations = {}
+            offset = 0
+            with open(tmp_path, 'wb') as out:
+                for order_id, location in self._locations.items():
+                    if location is None:
+                        new_locations[order_id] = None
+                        continue
+                    line = self._read_line(*location)
+                    out.write(line)
+                    new_locations[order_id] = (offset, len(line))
+                    offset += len(line)
+                if fsync:
+                    out.flush()
+                    os.fsync(out.fileno())
+            self._close_handles()
+            os.replace(tmp_path, self.path)
+            if fsync:
+                fsync_directory(self.path)
+            self._locations = new_locations
+            self._live_bytes = offset
+            self._garbage_bytes = 0
+            self._compactions += 1
+            if self._upgrade_offset is not None:
+                self._upgrade_offset = 0
+            self._open()
+            logger.info(f"{self.path} compactado ({offset} bytes)")
+
+def _existing_data_file(path, serializer):
+    """Arquivo a carregar no lugar de ``path`` e seu formato
+
+    Se ``path`` (no formato configurado) não existe mas o mesmo arquivo
+    existe em outro formato, ele é lido e a próxima gravação já sai no
+    formato novo; o antigo fica para trás e pode ser apagado (ou use
+    ``python serializers.py convert``).
+    """
+    if os.path.exists(path):
+        return path, serializer
+    stem = os.path.basename(path)[:-len(serializer.extension)]
+    other = find_data_file(os.path.dirname(path), stem)
+    if other is None:
+        return None, None
+    logger.warning(f"{path} não existe; carregando {other} (formato diferente do configurado)")
+    return other, detect_serializer(other)
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+def lock_data_dir(data_dir):
+    """Trava ``data_dir`` para este processo até o arquivo retornado ser fechado
+
+    Raises:
+        RuntimeError: outro processo (o bot ou uma ferramenta) já o travou
+    """
+    handle = open(os.path.join(data_dir, ".lock"), 'a')
+    if fcntl is None:
+        return handle
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        raise RuntimeError(
+            f"{data_dir} já está em uso por outro processo; "
+            f"para várias réplicas use o backend SQLite"
+        )
+    return handle
+
+ORDER_STATUSES = ("pendente", "pago", "entregue", "cancelado")
+# Pedidos nesses status não mudam mais e podem ir para o arquivo morto
+FINISHED_STATUSES = ("entregue", "cancelado")
+
+class CartStore:
+    """Carrinhos em memória, com expiração por inatividade
+
+    Carrinho é estado descartável: as mutações não passam pelo journal nem
+    pelo flush dos pedidos. Cada carrinho guarda o momento do último acesso
+    e some depois de ``ttl`` segundos parado (``get`` já o trata como vazio;
+    ``sweep`` o remove de fato). ``save`` regrava o arquivo apenas se algo
+    mudou, e quem usa decide quando chamá-lo (periodicamente e ao fechar).
+    """
+
+    def __init__(self, path, ttl=24 * 60 * 60, serializer=DEFAULT_SERIALIZER):
+        self.path = path
+        self.ttl = ttl
+        self.serializer = get_serializer(serializer)
+        self._lock = threading.Lock()
+        self._carts = {}  # user_id -> [CartItem]
+        self._touched = {}  # user_id -> epoch do último acesso
+        self._dirty = False
+
+    def load(self):
+        """Carrega carts.json, aceitando o formato antigo (só a lista de itens)
+
+        Os itens são atualizados por ``CartItem.from_dict``; o arquivo inteiro
+        sai na versão atual na próxima gravação.
+        """
+        path, serializer = _existing_data_file(self.path, self.serializer)
+        if path is None:
+            return
+        now = time.time()
+        with self._lock:
+            for user_id, cart in serializer.iter_items(path):
+                if isinstance(cart, list):
+                    cart = {'items': cart, 'touched': now}
+                if not cart['items']:
+                    continue
+                self._carts[int(user_id)] = [CartItem.from_dict(item) for item in cart['items']]
+                self._touched[int(user_id)] = cart.get('touched', now)
+        logger.info(f"Carregados {len(self._carts)} carrinhos do arquivo")
+
+    def __len__(self):
+        return len(self._carts)
+
+    def _expired(self, user_id, now):
+        return now - self._touched.get(user_id, now) > self.ttl
+
+    def get(self, user_id):
+        with self._lock:
+            now = time.time()
+            if user_id not in self._carts or self._expired(user_id, now):
+                return []
+            self._touched[user_id] = now
+            return self._carts[user_id]
+
+    def add(self, user_id, item):
+        with self._lock:
+            now = time.time()
+            if user_id not in self._carts or self._expired(user_id, now):
+                self._carts[user_id] = []
+            self._carts[user_id].append(item)
+            self._touched[user_id] = now
+            self._dirty = True
+            return self._carts[user_id]
+
+    def replace(self, user_id, items):
+        """Substitui os itens de um carrinho (vazio remove o carrinho)"""
+        with self._lock:
+            if items:
+                self._carts[user_id] = list(items)
+                self._touched[user_id] = time.time()
+            else:
+                self._carts.pop(user_id, None)
+                self._touched.pop(user_id, None)
+            self._dirty = True
+
+    def clear(self, user_id):
+        self.replace(user_id, [])
+
+    def iter_carts(self):
+        """Carrinhos não expirados como tuplas (user_id, [CartItem], touched)"""
+        with self._lock:
+            now = time.time()
+            carts = [(user_id, list(items), self._touched[user_id])
+                     for user_id, items in self._carts.items() if not self._expired(user_id, now)]
+        return iter(carts)
+
+    def sweep(self):
+        """Remove os carrinhos parados há mais de ``ttl`` segundos
+
+        Returns:
+            int: quantidade de carrinhos removidos
+        """
+        with self._lock:
+            now = time.time()
+            expired = [user_id for user_id in self._carts if self._expired(user_id, now)]
+            for user_id in expired:
+                del self._carts[user_id]
+                del self._touched[user_id]
+            if expired:
+                self._dirty = True
+        return len(expired)
+
+    def save(self):
+        """Grava carts.json se houve mudanças desde a última gravação"""
+        with self._lock:
+            if not self._dirty:
+                return True
+            data = {str(user_id): {'items': [item.to_dict() for item in items],
+                                   'touched': self._touched[user_id], 'v': SCHEMA_VERSION}
+                    for user_id, items in self._carts.items()}
+            self._dirty = False
+        try:
+            self.serializer.dump(self.path, data)
+            return True
+        except Exception as e:
+            logger.error(f"Erro ao salvar carrinhos: {e}")
+            with self._lock:
+                self._dirty = True
+            return False
+
+# Políticas de gravação dos arquivos de dados
+FLUSH_IMMEDIATE = "immediate"  # grava na própria thread da mutação
+FLUSH_INTERVAL = "interval"  # grava numa thread de fundo, agrupando rajadas
+FLUSH_ON_SHUTDOWN = "shutdown"  # grava apenas em close()
+FLUSH_POLICIES = (FLUSH_IMMEDIATE, FLUSH_INTERVAL, FLUSH_ON_SHUTDOWN)
+
+# Durabilidade das gravações (quando há fsync)
+DURABILITY_ALWAYS = "always"  # cada mutação espera o próprio fsync
+DURABILITY_BATCH = "batch"  # mutações próximas dividem um fsync (group commit)
+DURABILITY_OS = "os"  # sem fsync: o sistema operacional decide quando gravar
+DURABILITY_MODES = (DURABILITY_ALWAYS, DURABILITY_BATCH, DURABILITY_OS)
+
+# Quantidade de locks por usuário (user_id é distribuído entre eles)
+LOCK_STRIPES = 64
+# No modo batch, threads na fila a partir das quais vale esperar group_commit_ms
+COMMIT_SIBLINGS = 5
+
+class DataStore:
+    """Handle in-memory data persistence for users, carts, and orders with file backup
+
+    Cada coleção (users, orders) é marcada como suja ao ser alterada e
+    só os arquivos sujos são regravados. ``flush_policy`` decide quando:
+
+    - ``immediate``: a chamada que alterou os dados espera a gravação;
+    - ``interval``: a gravação acontece ``flush_interval`` segundos após a
+      primeira alteração, agrupando a rajada num único flush;
+    - ``shutdown``: somente em ``close()``.
+
+    Quem grava é sempre uma única thread (``datastore-writer``); ``flush()``
+    só pede a gravação e espera. Pedidos simultâneos de várias threads do
+    dispatcher são atendidos pela mesma passada de gravação.
+
+    ``durability`` decide o que "gravado" garante:
+
+    - ``os``: arquivo temporário + rename, sem fsync (sobrevive a uma queda
+      do processo, não necessariamente a uma queda de energia);
+    - ``always``: cada gravação (ou registro do journal) termina com fsync
+      antes de a mutação retornar;
+    - ``batch``: como ``always``, mas sob carga a gravação espera
+      ``group_commit_ms`` para que as mutações que chegarem nesse intervalo
+      dividam o mesmo rename/append e o mesmo fsync (group commit). A espera
+      só acontece quando já há ao menos ``commit_siblings`` outras threads
+      na fila, e nunca passa da metade da duração do último fsync; sem
+      concorrência o fsync é imediato e quem chegar durante ele divide o
+      próximo.
+
+    Concorrência: ``user_lock(user_id)`` devolve o lock (um de
+    ``lock_stripes``) que serializa as mutações de carrinho e pedidos daquele
+    usuário; handlers podem segurá-lo para operações compostas (ler e
+    alterar). ``_lock`` protege as estruturas compartilhadas (índices,
+    journal) e é sempre adquirido depois do lock do usuário, nunca antes.
+
+    Com ``journal=True`` cada mutação acrescenta um único registro compacto a
+    ``journal.log``; o journal é reaplicado sobre os arquivos na inicialização
+    e, a cada ``snapshot_every`` registros, as coleções sujas são regravadas
+    (seguindo a mesma política) e o journal é descartado.
+
+    Os registros do journal são idempotentes (gravam o estado final da
+    entidade), então reaplicá-los sobre um snapshot mais novo é seguro.
+
+    ``serializer`` é o formato de users e carts (ver ``serializers``); o
+    journal e ``orders.jsonl`` continuam em JSON, uma linha por registro.
+
+    Os pedidos ficam em ``orders.jsonl`` (ver ``LazyOrderMap``): na carga só
+    o índice de offsets e os índices secundários são montados, e gravar um
+    pedido alterado é acrescentar uma linha em vez de regravar o arquivo.
+
+    Os carrinhos ficam num ``CartStore`` à parte, com expiração de
+    ``cart_ttl`` segundos: não entram no journal nem no flush, e só são
+    gravados por ``sweep_carts`` e ``close``. ``cart_store`` troca esse
+    armazenamento por outro com a mesma interface (ex.: o Redis).
+
+    Um único processo pode abrir um mesmo ``data_dir``: a inicialização
+    trava ``data_dir/.lock`` e falha se outra instância já o tiver travado
+    (senão cada réplica sobrescreveria os arquivos da outra). Para várias
+    réplicas, use ``sqlite_store.SQLiteDataStore``. Com ``read_only=True``
+    (relatórios, ferramentas) a trava não é pedida e nada é gravado: mutações
+    ficam só em memória.
+
+    Pedidos finalizados podem ser movidos por ``archive_finished_orders`` para
+    partições mensais comprimidas em ``archive/``. Elas só são lidas quando
+    um pedido antigo é consultado, e as ``archive_cache_size`` partições mais
+    recentes ficam em cache.
+    """
+
+    def __init__(self, data_dir="data", journal=False, snapshot_every=1000,
+                 flush_policy=FLUSH_IMMEDIATE, flush_interval=1.0, archive_cache_size=4,
+                 orders_mmap=False, cart_ttl=24 * 60 * 60, lock_stripes=LOCK_STRIPES,
+                 read_only=False, durability=DURABILITY_OS, group_commit_ms=5,
+                 commit_siblings=COMMIT_SIBLINGS,
+                 serializer=DEFAULT_SERIALIZER, cart_store=None):
+        if flush_policy not in FLUSH_POLICIES:
+            raise ValueError(f"Política de gravação inválida: {flush_policy}")
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Modo de durabilidade inválido: {durability}")
+
+        self.users = {}  # user_id -> User
+        self.orders = None  # order_id -> Order (LazyOrderMap, criado em _load_data)
+        # Índices secundários de pedidos, mantidos a cada mutação. Os dicts com
+        # valor None funcionam como conjuntos que preservam a ordem de criação.
+        self._orders_by_user = {}  # user_id -> {order_id: None}
+        self._orders_by_status = {}  # status -> {order_id: None}
+        self._orders_by_payment = {}  # str(payment_id) -> order_id
+        # (created_ts, order_id) dos pedidos ativos, ordenado para consultas por período
+        self._orders_by_time = []
+        self.data_dir = data_dir
+        self.serializer = get_serializer(serializer)
+        self.users_file = os.path.join(data_dir, "users" + self.serializer.extension)
+        self.orders_file = os.path.join(data_dir, "orders.jsonl")
+        # Formato antigo (um único objeto JSON), convertido na primeira carga
+        self.legacy_orders_file = os.path.join(data_dir, "orders.json")
+        self.orders_mmap = orders_mmap
+        self.read_only = read_only
+        self.carts_file = os.path.join(data_dir, "carts" + self.serializer.extension)
+        # Outro armazenamento com a mesma interface (ex.: redis_store.RedisCartStore)
+        self.carts = cart_store or CartStore(self.carts_file, ttl=cart_ttl, serializer=serializer)
+        self.journal_file = os.path.join(data_dir, "journal.log")
+        self.archive_dir = os.path.join(data_dir, "archive")
+        self.archive_index_file = os.path.join(self.archive_dir, "index.json")
+        self.archive_cache_size = archive_cache_size
+        self._archive_index = {}  # order_id -> mês da partição (AAAA-MM)
+        self._archived_by_user = {}  # user_id -> [order_id]
+        self._archive_cache = OrderedDict()  # mês -> {order_id: dict}
+        # Journal já coberto por um snapshot em andamento (ou que falhou)
+        self.rotated_journal_file = self.journal_file + ".1"
+        self.journal = journal
+        self.snapshot_every = snapshot_every
+        self.flush_policy = flush_policy
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.group_commit_ms = group_commit_ms
+        self.commit_siblings = commit_siblings
+        self._journal_handle = None
+        self._journal_records = 0
+
+        # _lock protege as coleções em memória; _flush_lock garante que só um
+        # flush grava por vez (senão um snapshot antigo poderia sobrescrever
+        # um mais novo)
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._user_locks = [threading.RLock() for _ in range(lock_stripes)]
+        self._dirty = set()
+        # Pedidos de gravação para a thread de escrita: cada flush() pega um
+        # número e espera até _flush_done alcançá-lo
+        self._writer_cond = threading.Condition()
+        self._flush_requested = 0
+        self._flush_done = 0
+        self._flush_result = True
+        self._flush_waiters = 0
+        self._stop = False
+        self._writer = None
+        # Group commit do journal: registros escritos x registros com fsync
+        self._sync_cond = threading.Condition()
+        self._journal_written = 0
+        self._journal_synced = 0
+        self._journal_syncing = False
+        self._commit_waiters = 0
+        # Duração do último fsync do journal / da última gravação (limita a espera do batch)
+        self._last_sync_seconds = 0.0
+        self._last_write_seconds = 0.0
+
+        # Garantir que o diretório de dados existe
+        os.makedirs(data_dir, exist_ok=True)
+        self._process_lock = None if read_only else lock_data_dir(data_dir)
+
+        # Carregar dados salvos anteriormente, se existirem
+        self._load_data()
+        self._load_archive_index()
+
+        if self.journal:
+            self._replay_journal(self.rotated_journal_file)
+            self._replay_journal(self.journal_file)
+            if self._journal_records:
+                # O que veio do journal ainda não está nos arquivos
+                self._dirty.update(('users', 'orders'))
+            if not read_only:
+                self._journal_handle = open(self.journal_file, 'a', encoding='utf-8')
+                if self._journal_handle.tell() and not _ends_with_newline(self.journal_file):
+                    # Linha final incompleta: o próximo registro começa numa linha nova
+                    self._journal_handle.write("\n")
+                    self._journal_handle.flush()
+
+        if not read_only:
+            self._writer = threading.Thread(target=self._writer_loop, name="datastore-writer", daemon=True)
+            self._writer.start()
+
+    def user_lock(self, user_id):
+        """Lock das mutações de carrinho e pedidos de ``user_id`` (reentrante)"""
+        return self._user_locks[hash(user_id) % len(self._user_locks)]
+
+    def _load_data(self):
+        """Carrega dados dos arquivos JSON
+
+        Usuários, carrinhos e pedidos não dependem uns dos outros e são
+        carregados em paralelo, cada um registro a registro (sem manter o
+        arquivo inteiro em memória). A falha de um não impede os outros.
+        """
+        self.orders = LazyOrderMap(self.orders_file, use_mmap=self.orders_mmap, read_only=self.read_only)
+        loaders = {'usuários': self._load_users, 'carrinhos': self.carts.load, 'pedidos': self._load_orders}
+        with ThreadPoolExecutor(max_workers=len(loaders), thread_name_prefix="datastore-load") as executor:
+            futures = {name: executor.submit(loader) for name, loader in loaders.items()}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Erro ao carregar {name}: {e}")
+
+    def _load_users(self):
+        path, serializer = _existing_data_file(self.users_file, self.serializer)
+        if path is None:
+            return
+        for user_id, user_data in serializer.iter_items(path):
+            self.users[int(user_id)] = User(
+                int(user_id),
+                user_data['nome'],
+                user_data['telefone']
+            )
+        logger.info(f"Carregados {len(self.users)} usuários do arquivo")
+
+    def _load_orders(self):
+        # Só o índice de offsets, os objetos são montados sob demanda
+        if (not self.read_only and os.path.exists(self.legacy_orders_file)
+                and not os.path.exists(self.orders_file)):
+            self._migrate_legacy_orders()
+        by_time = []
+        for order_id, user_id, status, payment_id, created_ts in self.orders.load():
+            self._add_to_indexes(order_id, user_id, status, payment_id)
+            by_time.append((created_ts, order_id))
+        # Uma ordenação só, em vez de inserir pedido a pedido
+        by_time.sort()
+        self._orders_by_time = by_time
+        logger.info(f"Indexados {len(self.orders)} pedidos do arquivo")
+
+    def _migrate_legacy_orders(self):
+        """Converte o antigo orders.json em orders.jsonl (uma linha por pedido)"""
+        tmp_path = self.orders_file + ".tmp"
+        count = 0
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for _, order_data in iter_json_object(self.legacy_orders_file):
+                f.write(json.dumps(order_data, ensure_ascii=False, separators=(',', ':')) + "\n")
+                count += 1
+        os.replace(tmp_path, self.orders_file)
+        os.replace(self.legacy_orders_file, self.legacy_orders_file + ".migrated")
+        logger.info(f"{count} pedidos convertidos de orders.json para orders.jsonl")
+
+    def _serialize_users(self):
+        """Converte os usuários para o formato de users.json (com _lock)"""
+        return {str(user_id): user.to_dict() for user_id, user in self.users.items()}
+
+    def _save_data(self, collections=('users', 'orders')):
+        """Salva as coleções indicadas em arquivos JSON"""
+        try:
+            with self._lock:
+                users = self._serialize_users() if 'users' in collections else None
+                # Pedidos: só as linhas dos alterados são acrescentadas
+                order_changes = self.orders.take_changes() if 'orders' in collections else []
+
+            fsync = self.durability != DURABILITY_OS
+            if users is not None:
+                self.serializer.dump(self.users_file, users, fsync=fsync)
+            self.orders.write_changes(order_changes, fsync=fsync)
+
+            logger.info(f"Dados salvos em arquivos com sucesso ({', '.join(sorted(collections))})")
+            return True
+
+        except Exception as e:
+            logger.error(f"Erro ao salvar dados: {e}")
+            return False
+
+    # GRAVAÇÃO
+
+    def _mark_dirty(self, collection, record):
+        """Registra uma mutação já aplicada em memória (chamar com _lock)"""
+        self._dirty.add(collection)
+        if self._journal_handle is None:
+            return
+
+        try:
+            self._journal_handle.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+            self._journal_handle.flush()
+            self._journal_records += 1
+            self._journal_written += 1
+        except Exception as e:
+            logger.error(f"Erro ao gravar no journal: {e}")
+
+    def _commit_journal(self):
+        """Espera o fsync do journal até o último registro escrito (group commit)
+
+        A primeira thread a chegar vira líder: faz um único fsync e libera
+        todas as que escreveram antes dele; as que chegarem durante o fsync
+        esperam e dividem o próximo. No modo ``batch``, se ao menos
+        ``commit_siblings`` threads já estão na fila, o líder antes espera
+        (ver ``_group_commit_delay``) para juntar mais registros.
+        """
+        with self._lock:
+            ticket = self._journal_written
+        with self._sync_cond:
+            while self._journal_synced < ticket:
+                if self._journal_syncing:
+                    self._commit_waiters += 1
+                    try:
+                        self._sync_cond.wait()
+                    finally:
+                        self._commit_waiters -= 1
+                    continue
+                self._journal_syncing = True
+                break
+            else:
+                return
+            delay = 0
+            if self.durability == DURABILITY_BATCH and self._commit_waiters >= self.commit_siblings:
+                delay = self._group_commit_delay(self._last_sync_seconds)
+
+        try:
+            if delay:
+                time.sleep(delay)
+            with self._lock:
+                target = self._journal_written
+                # Cópia do descritor: uma rotação pode fechar o handle durante o fsync
+                fd = os.dup(self._journal_handle.fileno())
+            started = time.monotonic()
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._last_sync_seconds = time.monotonic() - started
+        except Exception as e:
+            target = None
+            logger.error(f"Erro no fsync do journal: {e}")
+        finally:
+            with self._sync_cond:
+                if target is not None:
+                    self._journal_synced = max(self._journal_synced, target)
+                self._journal_syncing = False
+                self._sync_cond.notify_all()
+
+    def _request_flush(self):
+        """Aciona a gravação das coleções sujas de acordo com a política"""
+        if self.journal and self.durability != DURABILITY_OS and not self.read_only:
+            self._commit_journal()
+
+        if self.journal and self._journal_records < self.snapshot_every:
+            return
+
+        if self.flush_policy == FLUSH_IMMEDIATE:
+            self.flush()
+        elif self.flush_policy == FLUSH_INTERVAL:
+            with self._writer_cond:
+                self._flush_requested += 1
+                self._writer_cond.notify_all()
+
+    def _writer_loop(self):
+        """Thread única de gravação: atende os pedidos de flush em ordem"""
+        while True:
+            with self._writer_cond:
+                while self._flush_done == self._flush_requested and not self._stop:
+                    self._writer_cond.wait()
+                if self._stop:
+                    return
+                if self.flush_policy == FLUSH_INTERVAL and not self._flush_waiters:
+                    # Janela de agrupamento: mutações que chegarem agora entram
+                    # no mesmo flush (a menos que alguém esteja esperando)
+                    self._wait_window(self.flush_interval)
+                elif self.durability == DURABILITY_BATCH and self._flush_waiters > self.commit_siblings:
+                    # Group commit sob carga: quem chegar na janela divide o
+                    # mesmo fsync. Sem fila, gravar já
+                    self._wait_window(self._group_commit_delay(self._last_write_seconds))
+                if self._stop:
+                    return
+                target = self._flush_requested
+            started = time.monotonic()
+            result = self._write_dirty()
+            self._last_write_seconds = time.monotonic() - started
+            with self._writer_cond:
+                self._flush_done = target
+                self._flush_result = result
+                self._writer_cond.notify_all()
+
+    def _group_commit_delay(self, last_seconds):
+        """Espera do group commit: ``group_commit_ms``, no máximo metade da última gravação
+
+        Esperar mais do que o próprio fsync custa só atrasa todo mundo; em
+        disco rápido a espera praticamente some.
+        """
+        return min(self.group_commit_ms / 1000, last_seconds / 2)
+
+    def _wait_window(self, seconds):
+        """Espera ``seconds`` com _writer_cond, sem encurtar a cada notify (chamar com ele)"""
+        deadline = time.monotonic() + seconds
+        remaining = seconds
+        while remaining > 0 and not self._stop:
+            self._writer_cond.wait(remaining)
+            remaining = deadline - time.monotonic()
+
+    def flush(self):
+        """Grava as coleções sujas (e, no modo journal, descarta o journal coberto)
+
+        Returns:
+            bool: False se a gravação falhou (as coleções continuam sujas)
+        """
+        with self._writer_cond:
+            if self._writer is not None and not self._stop and threading.current_thread() is not self._writer:
+                self._flush_requested += 1
+                ticket = self._flush_requested
+                self._flush_waiters += 1
+                self._writer_cond.notify_all()
+                while self._flush_done < ticket and not self._stop:
+                    self._writer_cond.wait()
+                self._flush_waiters -= 1
+                if self._flush_done >= ticket:
+                    return self._flush_result
+        # Sem thread de escrita (inicialização ou close): grava aqui mesmo
+        return self._write_dirty()
+
+    def _write_dirty(self):
+        """Grava as coleções sujas; só a thread de escrita (ou close) chama"""
+        if self.read_only:
+            return True
+        with self._flush_lock:
+            with self._lock:
+                dirty = self._dirty
+                self._dirty = set()
+                if not dirty:
+                    return True
+                if self.journal:
+                    self._rotate_journal()
+
+            if not self._save_data(tuple(dirty)):
+                with self._lock:
+                    self._dirty.update(dirty)
+                return False
+
+            if self.journal and os.path.exists(self.rotated_journal_file):
+                os.remove(self.rotated_journal_file)
+                logger.info("Snapshot gravado e journal descartado")
+            return True
+
+    # JOURNAL
+
+    def _replay_journal(self, path):
+        """Reaplica os registros de um journal sobre os dados carregados dos arquivos"""
+        if not os.path.exists(path):
+            return
+
+        applied = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._apply_record(json.loads(line))
+                    applied += 1
+                except Exception as e:
+                    # Uma linha final incompleta é esperada após uma queda do processo
+                    logger.warning(f"Registro {line_number} de {path} ignorado: {e}")
+
+        self._journal_records += applied
+        logger.info(f"Reaplicados {applied} registros de {path}")
+
+    def _apply_record(self, record):
+        """Aplica um registro do journal ao estado em memória"""
+        op = record['op']
+        if op == 'user':
+            data = record['user']
+            self.users[int(data['id'])] = User(int(data['id']), data['nome'], data['telefone'])
+        elif op == 'cart':
+            # Journals antigos ainda trazem carrinhos
+            self.carts.replace(int(record['user_id']), [CartItem.from_dict(item) for item in record['items']])
+        elif op == 'order':
+            order = Order.from_dict(record['order'])
+            previous = self.orders.get(order.id)
+            if previous:
+                self._unindex_order(previous)
+            self.orders[order.id] = order
+            self._index_order(order)
+        elif op == 'status':
+            order = self.orders.get(record['id'])
+            if order:
+                old_status, old_payment_id = order.status, order.payment_id
+                order.status = sys.intern(record['status'])
+                if record.get('payment_id'):
+                    order.payment_id = record['payment_id']
+                self.orders[order.id] = order
+                self._index_order(order, old_status, old_payment_id)
+        elif op == 'delete':
+            order = self.orders.get(record['id'])
+            if order:
+                self._unindex_order(order)
+                del self.orders[order.id]
+        else:
+            raise ValueError(f"operação desconhecida: {op}")
+
+    def _rotate_journal(self):
+        """Move o journal atual para journal.log.1 antes de um snapshot (com _lock)
+
+        Se um snapshot anterior falhou, journal.log.1 ainda existe e o journal
+        atual é acrescentado a ele em vez de sobrescrevê-lo.
+        """
+        fsync = self.durability != DURABILITY_OS
+        if fsync:
+            os.fsync(self._journal_handle.fileno())
+        self._journal_handle.close()
+        if os.path.exists(self.rotated_journal_file):
+            with open(self.journal_file, 'r', encoding='utf-8') as src, \
+                    open(self.rotated_journal_file, 'a', encoding='utf-8') as dst:
+                shutil.copyfileobj(src, dst)
+                if fsync:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            os.remove(self.journal_file)
+        else:
+            os.replace(self.journal_file, self.rotated_journal_file)
+        self._journal_handle = open(self.journal_file, 'a', encoding='utf-8')
+        self._journal_records = 0
+        if fsync:
+            # Tudo o que foi escrito até aqui já está no disco
+            with self._sync_cond:
+                self._journal_synced = max(self._journal_synced, self._journal_written)
+                self._sync_cond.notify_all()
+
+    # ARQUIVO MORTO
+
+    def _load_archive_index(self):
+        """Carrega o índice order_id -> partição do arquivo morto"""
+        if not os.path.exists(self.archive_index_file):
+            return
+        try:
+            with open(self.archive_index_file, 'r', encoding='utf-8') as f:
+                for order_id, (month, user_id) in json.load(f).items():
+                    self._archive_index[order_id] = month
+                    self._archived_by_user.setdefault(user_id, []).append(order_id)
+            logger.info(f"Índice do arquivo morto com {len(self._archive_index)} pedidos")
+        except Exception as e:
+            logger.error(f"Erro ao carregar índice do arquivo morto: {e}")
+
+    def _save_archive_index(self):
+        """Grava o índice do arquivo morto (chamar com _lock)"""
+        data = {}
+        for user_id, order_ids in self._archived_by_user.items():
+            for order_id in order_ids:
+                data[order_id] = [self._archive_index[order_id], user_id]
+        write_json_atomic(self.archive_index_file, data, indent=None, fsync=self.durability != DURABILITY_OS)
+
+    def _partition_file(self, month):
+        return os.path.join(self.archive_dir, f"orders-{month}.json.gz")
+
+    def _read_partition(self, month):
+        """Lê uma partição do disco (sem cache)"""
+        path = self._partition_file(month)
+        if not os.path.exists(path):
+            return {}
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _load_partition(self, month):
+        """Retorna uma partição, usando o cache LRU"""
+        with self._lock:
+            if month in self._archive_cache:
+                self._archive_cache.move_to_end(month)
+                return self._archive_cache[month]
+
+        partition = self._read_partition(month)
+
+        with self._lock:
+            self._archive_cache[month] = partition
+            while len(self._archive_cache) > self.archive_cache_size:
+                self._archive_cache.popitem(last=False)
+        return partition
+
+    def _get_archived_order(self, order_id):
+        month = self._archive_index.get(order_id)
+        if not month:
+            return None
+        data = self._load_partition(month).get(order_id)
+        if not data:
+            return None
+        return Order.from_dict(data)
+
+    def iter_archived_orders(self, months=None):
+        """Percorre os pedidos arquivados, partição por partição (para relatórios)
+
+        Args:
+            months: meses (AAAA-MM) a ler; todos os arquivados se None
+        """
+        if months is None:
+            with self._lock:
+                months = sorted(set(self._archive_index.values()))
+        for month in months:
+            for order_id, data in self._read_partition(month).items():
+                # Pedidos reativados voltaram para os ativos e não contam mais aqui
+                if self._archive_index.get(order_id) != month:
+                    continue
+                yield Order.from_dict(data)
+
+    def archive_finished_orders(self, older_than_days=7):
+        """Move pedidos finalizados para as partições mensais do arquivo morto
+
+        Args:
+            older_than_days: só arquiva pedidos criados há mais dias que isso
+
+        Returns:
+            int: quantidade de pedidos arquivados
+        """
+        cutoff = time.time() - older_than_days * 24 * 60 * 60
+        with self._lock:
+            candidates = [self.orders[order_id]
+                          for status in FINISHED_STATUSES
+                          for order_id in self._orders_by_status.get(status, ())
+                          if self.orders[order_id].created_ts < cutoff]
+            by_month = {}
+            for order in candidates:
+                by_month.setdefault(order.created_at[:7], {})[order.id] = order.to_dict()
+
+        if not candidates:
+            return 0
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        for month, orders_data in by_month.items():
+            partition = dict(self._read_partition(month))
+            partition.update(orders_data)
+            tmp_path = self._partition_file(month) + ".tmp"
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                json.dump(partition, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self._partition_file(month))
+
+        archived = 0
+        with self._lock:
+            for month in by_month:
+                self._archive_cache.pop(month, None)
+            for order in candidates:
+                # Pode ter sido reaberto enquanto as partições eram gravadas
+                if order.id not in self.orders or self.orders[order.id].status not in FINISHED_STATUSES:
+                    continue
+                self._unindex_order(order)
+                del self.orders[order.id]
+                if order.id not in self._archive_index:
+                    self._archived_by_user.setdefault(order.user_id, []).append(order.id)
+                self._archive_index[order.id] = order.created_at[:7]
+                archived += 1
+            self._save_archive_index()
+            self._dirty.add('orders')
+
+        # O snapshot grava as remoções em orders.jsonl (e descarta o journal)
+        self.snapshot()
+        logger.info(f"{archived} pedidos finalizados movidos para o arquivo morto")
+        return archived
+
+    def rebuild_archive_index(self):
+        """Refaz o índice do arquivo morto a partir das partições em disco
+
+        Para quando ``archive/index.json`` se perdeu ou diverge das partições
+        (ex.: queda no meio de um arquivamento). Pedidos que também estão
+        entre os ativos ficam de fora: a cópia ativa prevalece.
+
+        Returns:
+            int: quantidade de pedidos indexados
+        """
+        if not os.path.isdir(self.archive_dir):
+            return 0
+        months = sorted(name[len("orders-"):-len(".json.gz")] for name in os.listdir(self.archive_dir)
+                        if name.startswith("orders-") and name.endswith(".json.gz"))
+        index = {}
+        by_user = {}
+        # Uma partição por vez em memória
+        for month in months:
+            for order_id, data in self._read_partition(month).items():
+                if order_id in self.orders or order_id in index:
+                    continue
+                index[order_id] = month
+                by_user.setdefault(data['user_id'], []).append(order_id)
+        with self._lock:
+            self._archive_index = index
+            self._archived_by_user = by_user
+            self._archive_cache.clear()
+            if not self.read_only:
+                self._save_archive_index()
+        logger.info(f"Índice do arquivo morto refeito com {len(index)} pedidos de {len(months)} partições")
+        return len(index)
+
+    def _restore_archived_order(self, order_id):
+        """Traz um pedido arquivado de volta para os ativos (chamar com _lock)"""
+        order = self._get_archived_order(order_id)
+        if not order:
+            return None
+        del self._archive_index[order_id]
+        user_orders = self._archived_by_user.get(order.user_id, [])
+        if order_id in user_orders:
+            user_orders.remove(order_id)
+        self._save_archive_index()
+        self.orders[order_id] = order
+        self._index_order(order)
+        return order
+
+    # RETENÇÃO
+
+    def expire_pending_orders(self, older_than_seconds):
+        """Cancela pedidos pendentes criados há mais de ``older_than_seconds``
+
+        São os PIX abandonados ou que nem chegaram a ser gerados. O pedido
+        vira "cancelado" em vez de sumir: um pagamento que chegue depois ainda
+        é reconhecido (a verificação aceita cancelado -> pago), e o
+        arquivamento o tira dos ativos mais tarde.
+
+        Returns:
+            int: quantidade de pedidos cancelados
+        """
+        cutoff = time.time() - older_than_seconds
+        with self._lock:
+            candidates = [(order_id, self.orders[order_id].user_id)
+                          for order_id in self._orders_by_status.get("pendente", ())
+                          if self.orders[order_id].created_ts < cutoff]
+
+        expired = 0
+        for order_id, user_id in candidates:
+            with self.user_lock(user_id), self._lock:
+                order = self.orders.get(order_id)
+                # Pode ter sido pago enquanto a lista era montada
+                if order is None or order.status != "pendente":
+                    continue
+                order.status = "cancelado"
+                self.orders[order_id] = order
+                self._index_order(order, "pendente")
+                self._mark_dirty('orders', {'op': 'status', 'id': order_id, 'status': order.status,
+                                            'payment_id': order.payment_id})
+                expired += 1
+        if expired:
+            self._request_flush()
+            logger.info(f"{expired} pedidos pendentes expirados")
+        return expired
+
+    def delete_orphan_orders(self, older_than_seconds):
+        """Apaga pedidos cancelados sem pagamento criados há mais de ``older_than_seconds``
+
+        Sem ``payment_id`` o PIX nunca foi gerado, então não há pagamento a
+        conciliar e o pedido não precisa ir para o arquivo morto.
+
+        Returns:
+            int: quantidade de pedidos apagados
+        """
+        cutoff = time.time() - older_than_seconds
+        with self._lock:
+            candidates = [(order_id, self.orders[order_id].user_id)
+                          for order_id in self._orders_by_status.get("cancelado", ())
+                          if self.orders[order_id].payment_id is None
+                          and self.orders[order_id].created_ts < cutoff]
+
+        deleted = 0
+        for order_id, user_id in candidates:
+            with self.user_lock(user_id), self._lock:
+                order = self.orders.get(order_id)
+                if order is None or order.status != "cancelado" or order.payment_id is not None:
+                    continue
+                self._unindex_order(order)
+                del self.orders[order_id]
+                self._mark_dirty('orders', {'op': 'delete', 'id': order_id})
+                deleted += 1
+        if deleted:
+            self._request_flush()
+            logger.info(f"{deleted} pedidos sem pagamento apagados")
+        return deleted
+
+    def _disk_usage(self):
+        paths = (self.orders_file, self.journal_file, self.rotated_journal_file)
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    def compact(self):
+        """Grava um snapshot (descartando o journal) e regrava orders.jsonl sem versões antigas
+
+        Returns:
+            int: bytes liberados em disco
+        """
+        if self.read_only:
+            return 0
+        before = self._disk_usage()
+        if not self.snapshot():
+            return 0
+        # _flush_lock: nenhuma gravação acrescenta linhas durante a troca do arquivo
+        with self._flush_lock:
+            self.orders.compact(fsync=self.durability != DURABILITY_OS)
+        reclaimed = max(0, before - self._disk_usage())
+        logger.info(f"Compactação liberou {reclaimed} bytes")
+        return reclaimed
+
+    # VERSÕES
+
+    def upgrade_records(self, limit=1000):
+        """Regrava no formato atual até ``limit`` pedidos gravados em versões antigas
+
+        Complementa a atualização na leitura: chamada repetidamente, em
+        segundo plano, até retornar 0. O arquivo morto não é regravado; seus
+        pedidos são atualizados quando lidos.
+
+        Returns:
+            int: quantidade de pedidos regravados
+        """
+        if self.read_only:
+            return 0
+        order_ids = self.orders.stale_ids(limit)
+        if not order_ids:
+            return 0
+        with self._lock:
+            for order_id in order_ids:
+                # Pode ter sido arquivado ou apagado desde a leitura
+                if order_id in self.orders:
+                    self.orders.mark_dirty(order_id)
+            self._dirty.add('orders')
+        # Gravar já, e não no próximo snapshot: os pedidos marcados ficam presos em memória
+        self.flush()
+        return len(order_ids)
+
+    # ÍNDICES
+
+    def _index_order(self, order, old_status=None, old_payment_id=None):
+        """Atualiza os índices secundários de um pedido (chamar com _lock)
+
+        ``old_status`` e ``old_payment_id`` são os valores antes da mutação,
+        para que o pedido seja removido dos baldes antigos.
+        """
+        if old_status is not None and old_status != order.status:
+            bucket = self._orders_by_status.get(old_status)
+            if bucket is not None:
+                bucket.pop(order.id, None)
+
+        if old_payment_id is not None and str(old_payment_id) != str(order.payment_id):
+            if self._orders_by_payment.get(str(old_payment_id)) == order.id:
+                del self._orders_by_payment[str(old_payment_id)]
+
+        self._add_to_indexes(order.id, order.user_id, order.status, order.payment_id)
+
+        # created_ts não muda, então só entra no índice se ainda não estiver lá
+        key = (order.created_ts, order.id)
+        position = bisect.bisect_left(self._orders_by_time, key)
+        if position == len(self._orders_by_time) or self._orders_by_time[position] != key:
+            self._orders_by_time.insert(position, key)
+
+    def _add_to_indexes(self, order_id, user_id, status, payment_id):
+        self._orders_by_user.setdefault(user_id, {})[order_id] = None
+        self._orders_by_status.setdefault(status, {})[order_id] = None
+        if payment_id is not None:
+            self._orders_by_payment[str(payment_id)] = order_id
+
+    def _unindex_order(self, order):
+        """Remove um pedido de todos os índices secundários (chamar com _lock)"""
+        self._orders_by_user.get(order.user_id, {}).pop(order.id, None)
+        self._orders_by_status.get(order.status, {}).pop(order.id, None)
+        if order.payment_id is not None and self._orders_by_payment.get(str(order.payment_id)) == order.id:
+            del self._orders_by_payment[str(order.payment_id)]
+        key = (order.created_ts, order.id)
+        position = bisect.bisect_left(self._orders_by_time, key)
+        if position < len(self._orders_by_time) and self._orders_by_time[position] == key:
+            del self._orders_by_time[position]
+
+    def snapshot(self):
+        """Grava todos os arquivos e descarta o journal"""
+        with self._lock:
+            self._dirty.update(('users', 'orders'))
+        return self.flush()
+
+    def close(self):
+        """Para a thread de escrita, grava o que estiver pendente e libera o journal"""
+        with self._writer_cond:
+            self._stop = True
+            self._writer_cond.notify_all()
+        if self._writer:
+            self._writer.join()
+            self._writer = None
+        self.flush()
+        if not self.read_only:
+            self.carts.save()
+        if self._journal_handle:
+            self._journal_handle.close()
+            self._journal_handle = None
+        self.orders.close()
+        if self._process_lock:
+            # Fechar o arquivo libera a trava de processo
+            self._process_lock.close()
+
+    def save_user(self, user_id, name, phone):
+        """Save user information"""
+        with self.user_lock(user_id), self._lock:
+            user = User(user_id, name, phone)
+            self.users[user_id] = user
+            self._mark_dirty('users', {'op': 'user', 'user': user.to_dict()})
+        self._request_flush()
+        return user
+
+    def get_user(self, user_id):
+        """Get user by ID"""
+        return self.users.get(user_id)
+
+    def iter_users(self):
+        """Percorre todos os usuários, em ordem de ID (ver ``SQLiteDataStore.iter_users``)"""
+        with self._lock:
+            users = sorted(self.users.values(), key=lambda user: user.id)
+        return iter(users)
+
+    def add_to_cart(self, user_id, item):
+        """Add item to user's cart"""
+        # Convert dict to CartItem if needed
+        if isinstance(item, dict):
+            item = CartItem.from_dict(item)
+
+        # Cópias: a lista interna pode mudar enquanto o handler a percorre
+        with self.user_lock(user_id):
+            return list(self.carts.add(user_id, item))
+
+    def get_cart(self, user_id):
+        """Get user's cart"""
+        with self.user_lock(user_id):
+            return list(self.carts.get(user_id))
+
+    def clear_cart(self, user_id):
+        """Clear user's cart"""
+        with self.user_lock(user_id):
+            self.carts.clear(user_id)
+
+    def sweep_carts(self):
+        """Descarta carrinhos expirados e grava carts.json se algo mudou
+
+        Returns:
+            int: quantidade de carrinhos descartados
+        """
+        expired = self.carts.sweep()
+        self.carts.save()
+        return expired
+
+    def create_order(self, user_id, cart_items, payment_id=None):
+        """Create a new order"""
+        with self.user_lock(user_id), self._lock:
+            order_id = generate_order_id()
+            while order_id in self.orders or order_id in self._archive_index:
+                order_id = generate_order_id()
+            order = Order(order_id, user_id, cart_items, payment_id=payment_id)
+            self.orders[order_id] = order
+            self._index_order(order)
+            self._mark_dirty('orders', {'op': 'order', 'order': order.to_dict()})
+        self._request_flush()
+        return order
+
+    def get_order(self, order_id):
+        """Get order by ID"""
+        order = self.orders.get(order_id)
+        if order is None and order_id in self._archive_index:
+            order = self._get_archived_order(order_id)
+        return order
+
+    def update_order_status(self, order_id, status, payment_id=None):
+        """Update order status and optionally payment_id"""
+        current = self.get_order(order_id)
+        if not current:
+            return None
+        with self.user_lock(current.user_id), self._lock:
+            order = self.orders.get(order_id)
+            restored = False
+            if not order and order_id in self._archive_index:
+                order = self._restore_archived_order(order_id)
+                restored = True
+            if not order:
+                return None
+            old_status, old_payment_id = order.status, order.payment_id
+            order.status = sys.intern(status) if type(status) is str else status
+            if payment_id:
+                order.payment_id = payment_id
+            self.orders[order_id] = order
+            self._index_order(order, old_status, old_payment_id)
+            if restored:
+                # O journal precisa do pedido inteiro: ele não está mais em orders.jsonl
+                self._mark_dirty('orders', {'op': 'order', 'order': order.to_dict()})
+            else:
+                self._mark_dirty('orders', {'op': 'status', 'id': order_id, 'status': status,
+                                            'payment_id': order.payment_id})
+        self._request_flush()
+        return order
+
+    def transition_order_status(self, order_id, status, from_statuses):
+        """Muda o status só se o atual estiver em ``from_statuses`` (checagem e troca atômicas)
+
+        Returns:
+            Order: o pedido atualizado, ou None se o status não era o esperado
+        """
+        current = self.get_order(order_id)
+        if not current:
+            return None
+        with self.user_lock(current.user_id):
+            # Pode ter sido removido entre a primeira leitura e o lock
+            order = self.get_order(order_id)
+            if order is None or order.status not in from_statuses:
+                return None
+            return self.update_order_status(order_id, status)
+
+    def get_user_orders(self, user_id):
+        """Get all orders for a user, including archived ones"""
+        with self._lock:
+            orders = [self.orders[order_id] for order_id in self._orders_by_user.get(user_id, ())]
+            # Um pedido pode estar nos dois lugares se o processo caiu no meio do
+            # arquivamento; a cópia ativa prevalece
+            archived_ids = [order_id for order_id in self._archived_by_user.get(user_id, ())
+                            if order_id not in self.orders]
+        archived = [self._get_archived_order(order_id) for order_id in archived_ids]
+        return [order for order in archived if order] + orders
+
+    def list_orders_by_status(self, *statuses):
+        """Get all orders whose status is one of ``statuses``"""
+        with self._lock:
+            return [self.orders[order_id]
+                    for status in statuses
+                    for order_id in self._orders_by_status.get(status, ())]
+
+    def get_order_by_payment(self, payment_id):
+        """Get the order linked to a Mercado Pago payment ID (active orders only)"""
+        with self._lock:
+            order_id = self._orders_by_payment.get(str(payment_id))
+            return self.orders.get(order_id) if order_id else None
+
+    def iter_orders_between(self, start_ts=None, end_ts=None, include_archived=False):
+        """Percorre, em ordem de criação, os pedidos criados em [start_ts, end_ts)
+
+        Os pedidos ativos saem do índice ordenado por bisect, custando
+        O(log n + k). Com ``include_archived`` também são lidas as partições
+        dos meses do período.
+
+        Args:
+            start_ts: início (epoch, inclusivo); sem limite se None
+            end_ts: fim (epoch, exclusivo); sem limite se None
+            include_archived: incluir pedidos do arquivo morto
+        """
+        with self._lock:
+            low = 0 if start_ts is None else bisect.bisect_left(self._orders_by_time, (start_ts,))
+            high = (len(self._orders_by_time) if end_ts is None
+                    else bisect.bisect_left(self._orders_by_time, (end_ts,)))
+            # Cópia do trecho: o índice pode mudar enquanto o chamador itera
+            keys = self._orders_by_time[low:high]
+            months = self._archive_months_between(start_ts, end_ts) if include_archived else []
+
+        active = (order for order in (self.orders.get(order_id) for _, order_id in keys) if order)
+        if not months:
+            return active
+        archived = sorted(
+            (order for order in self.iter_archived_orders(months)
+             if order.id not in self.orders
+             and (start_ts is None or order.created_ts >= start_ts)
+             and (end_ts is None or order.created_ts < end_ts)),
+            key=lambda order: (order.created_ts, order.id)
+        )
+        return heapq.merge(archived, active, key=lambda order: (order.created_ts, order.id))
+
+    def _archive_months_between(self, start_ts, end_ts):
+        """Meses (AAAA-MM) com partições que podem ter pedidos do período (chamar com _lock)"""
+        first = None if start_ts is None else datetime.fromtimestamp(start_ts).strftime("%Y-%m")
+        last = None if end_ts is None else datetime.fromtimestamp(end_ts).strftime("%Y-%m")
+        return [month for month in sorted(set(self._archive_index.values()))
+                if (first is None or month >= first) and (last is None or month <= last)]
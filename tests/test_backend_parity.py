@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""A mesma sequência de operações contra DataStore e SQLiteDataStore deve dar o mesmo resultado"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlite_store import SQLiteDataStore
+from storage import CartItem, DataStore
+
+def describe(order, ids):
+    """Pedido sem o ID gerado nem o horário, que mudam a cada execução"""
+    if order is None:
+        return None
+    return (ids.index(order.id), order.user_id, order.status, order.payment_id,
+            [(item.name, item.price, item.details) for item in order.items])
+
+def describe_all(store):
+    orders = list(store.iter_orders_between())
+    ids = [order.id for order in orders]
+    return [(describe(order, ids), type(order.payment_id)) for order in orders]
+
+def run_sequence(store):
+    orders = [
+        store.create_order(1, [CartItem("Netflix", 19.9, {"plano": "mensal"})], payment_id=1001),
+        store.create_order(1, [CartItem("Spotify", 9.9), CartItem("Deezer", 14.9)]),
+        store.create_order(2, [CartItem("Disney+", 27.9)]),
+        store.create_order(2, [CartItem("HBO Max", 29.9)], payment_id="pix-abc"),
+    ]
+    ids = [order.id for order in orders]
+    results = {
+        'update': describe(store.update_order_status(ids[1], "pago", payment_id=2002), ids),
+        'update_missing': store.update_order_status("nao-existe", "pago"),
+        'transition': describe(store.transition_order_status(ids[0], "pago", ("pendente",)), ids),
+        'transition_refused': store.transition_order_status(ids[0], "cancelado", ("pendente",)),
+        'transition_missing': store.transition_order_status("nao-existe", "pago", ("pendente",)),
+    }
+    store.update_order_status(ids[2], "cancelado")
+
+    def snapshot():
+        return {
+            'user_1': [describe(order, ids) for order in store.get_user_orders(1)],
+            'user_2': [describe(order, ids) for order in store.get_user_orders(2)],
+            'user_3': store.get_user_orders(3),
+            'payment_int': describe(store.get_order_by_payment(1001), ids),
+            'payment_str': describe(store.get_order_by_payment("2002"), ids),
+            'payment_pix': describe(store.get_order_by_payment("pix-abc"), ids),
+            'payment_missing': store.get_order_by_payment(9999),
+            'pago': sorted(ids.index(order.id) for order in store.list_orders_by_status("pago")),
+            'all': [ids.index(order.id) for order in store.iter_orders_between()],
+            'between': [ids.index(order.id) for order in
+                        store.iter_orders_between(orders[1].created_ts, orders[3].created_ts)],
+            'from': [ids.index(order.id) for order in store.iter_orders_between(orders[2].created_ts)],
+        }
+
+    return ids, results, snapshot
+
+class BackendParityTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_mesmos_resultados_nos_dois_backends(self):
+        json_dir = os.path.join(self.tmp, "data")
+        sqlite_path = os.path.join(self.tmp, "bot.db")
+        backends = {
+            'json': lambda: DataStore(json_dir),
+            'journal': lambda: DataStore(os.path.join(self.tmp, "journal"), journal=True),
+            'sqlite': lambda: SQLiteDataStore(sqlite_path),
+        }
+        results = {}
+        reopened = {}
+        for name, open_store in backends.items():
+            store = open_store()
+            try:
+                _, results[name], snapshot = run_sequence(store)
+                results[name]['snapshot'] = snapshot()
+            finally:
+                store.close()
+            store = open_store()
+            try:
+                # Depois de reabrir o estado (e os tipos) continuam iguais
+                reopened[name] = describe_all(store)
+            finally:
+                store.close()
+
+        self.assertEqual(results['json'], results['sqlite'])
+        self.assertEqual(results['journal'], results['sqlite'])
+        self.assertEqual(reopened['json'], reopened['sqlite'])
+        self.assertEqual(reopened['journal'], reopened['sqlite'])
+
+        snapshot = results['sqlite']['snapshot']
+        self.assertEqual(snapshot['payment_int'][3], 1001)
+        self.assertIsInstance(snapshot['payment_str'][3], int)
+        self.assertEqual(snapshot['payment_pix'][3], "pix-abc")
+        self.assertEqual(snapshot['between'], [1, 2])
+        self.assertEqual(snapshot['from'], [2, 3])
+        self.assertIsNone(results['sqlite']['transition_refused'])
+
+if __name__ == "__main__":
+    unittest.main()
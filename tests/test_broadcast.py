@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Testes do broadcast: lotes, retomada depois de um reinício e concessão vencida"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from broadcast import BLOCKED, DONE, RUNNING, SENDING, SENT, UNKNOWN, Broadcaster, BroadcastStore
+
+try:
+    from telegram.error import Unauthorized
+except ImportError:
+    Unauthorized = None
+
+class FakeClock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class FakeBot:
+    """Só o ``send_message``; ``blocked`` são os usuários que bloquearam o bot"""
+
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise Unauthorized("Forbidden: bot was blocked by the user")
+        with self._lock:
+            self.sent.append(chat_id)
+
+def run_until_done(broadcaster, bot, budget=1.0, batches=50):
+    """Chama ``run_batch`` como o job do bot: o fim de cada lote dispara o próximo"""
+    progress = None
+    for _ in range(batches):
+        done = threading.Event()
+        started = broadcaster.run_batch(bot, budget, on_done=lambda progress, delay: done.set())
+        if started is None:
+            return progress
+        progress = started
+        if started['status'] != RUNNING:
+            return started
+        if not done.wait(5):
+            raise AssertionError("o lote não terminou")
+    return progress
+
+@unittest.skipIf(Unauthorized is None, "python-telegram-bot não instalado")
+class BroadcastTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "broadcasts.db")
+        self.clock = FakeClock()
+        self.store = self.open_store()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def open_store(self):
+        return BroadcastStore(self.path, clock=self.clock)
+
+    def statuses(self, broadcast_id):
+        return dict(self.store._query("SELECT user_id, status FROM broadcast_deliveries WHERE broadcast_id = ?",
+                                      (broadcast_id,)))
+
+class BroadcasterTest(BroadcastTestCase):
+    def test_run_batch_volta_antes_dos_envios(self):
+        broadcast_id = self.store.create("Aviso", range(1, 11))
+        release = threading.Event()
+        bot = FakeBot(blocked={3})
+        original = bot.send_message
+        bot.send_message = lambda *args, **kwargs: (release.wait(5), original(*args, **kwargs))
+        broadcaster = Broadcaster(self.store, rate=1000, owner="a", concurrency=2)
+        done = threading.Event()
+        results = []
+
+        progress = broadcaster.run_batch(bot, 1.0, on_done=lambda progress, delay: (results.append(progress),
+                                                                                      done.set()))
+        # O lote está reservado mas nenhum envio terminou: run_batch não esperou
+        self.assertEqual(progress['counts'][SENDING], 10)
+        # Com o lote saindo, outra chamada (o job de fundo) não faz nada
+        self.assertIsNone(broadcaster.run_batch(bot, 1.0))
+        release.set()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results[0]['counts'][SENT], 9)
+        self.assertEqual(results[0]['counts'][BLOCKED], 1)
+        self.assertTrue(self.store.is_unreachable(3))
+
+        progress = run_until_done(broadcaster, bot)
+        self.assertEqual(progress['status'], DONE)
+        self.assertEqual(sorted(bot.sent), [1, 2, 4, 5, 6, 7, 8, 9, 10])
+        self.assertEqual(self.store.get(broadcast_id)['status'], DONE)
+
+    def test_retoma_depois_de_reinicio(self):
+        broadcast_id = self.store.create("Aviso", range(1, 11))
+        # O processo anterior reservou um lote e morreu antes de gravar o resultado
+        self.assertIsNotNone(self.store.claim("antigo", 60))
+        self.assertEqual(self.store.take_batch(broadcast_id, "antigo", 4, 60), [1, 2, 3, 4])
+        self.store.close()
+
+        self.store = self.open_store()
+        bot = FakeBot()
+        broadcaster = Broadcaster(self.store, rate=1000, owner="novo")
+        # A concessão do dono anterior ainda vale
+        self.assertIsNone(run_until_done(broadcaster, bot))
+        self.assertEqual(bot.sent, [])
+
+        self.clock.advance(61)
+        progress = run_until_done(broadcaster, bot, budget=0.003)
+        self.assertEqual(progress['status'], DONE)
+        # Quem estava no lote interrompido não recebe de novo: fica incerto
+        self.assertEqual(sorted(bot.sent), [5, 6, 7, 8, 9, 10])
+        statuses = self.statuses(broadcast_id)
+        self.assertEqual({user_id for user_id, status in statuses.items() if status == UNKNOWN}, {1, 2, 3, 4})
+
+    def test_concessao_vencida_passa_o_envio_adiante(self):
+        broadcast_id = self.store.create("Aviso", range(1, 7))
+        bot = FakeBot()
+        first = Broadcaster(self.store, rate=1000, lease=30, owner="a")
+        second = Broadcaster(self.store, rate=1000, lease=30, owner="b")
+
+        done = threading.Event()
+        first.run_batch(bot, 0.002, on_done=lambda progress, delay: done.set())
+        self.assertTrue(done.wait(5))
+        self.assertEqual(sorted(bot.sent), [1, 2])
+        # Enquanto "a" renova a concessão, "b" não assume
+        self.assertIsNone(second.run_batch(bot, 0.002))
+
+        # "a" parou de dar notícias: passada a concessão, "b" assume e termina
+        self.clock.advance(31)
+        progress = run_until_done(second, bot, budget=0.002)
+        self.assertEqual(progress['status'], DONE)
+        self.assertEqual(self.store.get(broadcast_id)['owner'], None)
+        # "a" volta, mas o broadcast já não é dele
+        self.assertIsNone(first.run_batch(bot, 0.002))
+        self.assertEqual(sorted(bot.sent), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(set(self.statuses(broadcast_id).values()), {SENT})
+
+if __name__ == "__main__":
+    unittest.main()
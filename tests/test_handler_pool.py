@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Testes do HandlerPool: toques repetidos, falhas e contadores"""
+
+import threading
+import unittest
+from types import SimpleNamespace
+
+from handler_pool import HandlerPool
+
+class ThreadDispatcher:
+    """Só o ``run_async`` do dispatcher: cada chamada numa thread própria"""
+
+    def __init__(self):
+        self.threads = []
+        self.errors = []
+
+    def run_async(self, func, *args, update=None, **kwargs):
+        def run():
+            # Como a Promise do python-telegram-bot: o erro fica com ela
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self.errors.append(e)
+
+        thread = threading.Thread(target=run)
+        self.threads.append(thread)
+        thread.start()
+        return thread
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(5)
+
+class CallbackQuery:
+    def __init__(self):
+        self.answers = []
+
+    def answer(self, text):
+        self.answers.append(text)
+
+def make_update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), callback_query=CallbackQuery(),
+                           effective_message=None)
+
+class HandlerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = HandlerPool(workers=2)
+        self.dispatcher = ThreadDispatcher()
+        self.context = SimpleNamespace(dispatcher=self.dispatcher)
+        self.release = threading.Event()
+        self.started = threading.Semaphore(0)
+        self.calls = []
+
+    def tearDown(self):
+        self.release.set()
+        self.dispatcher.join()
+
+    def blocking(self, name):
+        def callback(update, context):
+            self.calls.append((name, update.effective_user.id))
+            self.started.release()
+            self.release.wait(5)
+            return name
+        return callback
+
+    def test_toque_repetido_e_recusado(self):
+        checkout = self.pool.wrap(self.blocking("checkout"))
+        cancel = self.pool.wrap(self.blocking("cancel"))
+        first = make_update(1)
+        repeat = make_update(1)
+
+        self.assertIsNotNone(checkout(first, self.context))
+        self.assertTrue(self.started.acquire(timeout=5))
+        # O segundo toque nem chega a um worker; ele é avisado na hora
+        self.assertIsNone(checkout(repeat, self.context))
+        self.assertEqual(repeat.callback_query.answers, [HandlerPool.BUSY_TEXT])
+        # Outro callback do mesmo usuário e outro usuário seguem normalmente
+        self.assertIsNotNone(cancel(make_update(1), self.context))
+        self.assertIsNotNone(checkout(make_update(2), self.context))
+        for _ in range(2):
+            self.assertTrue(self.started.acquire(timeout=5))
+        self.assertEqual(sorted(self.calls), [("cancel", 1), ("checkout", 1), ("checkout", 2)])
+
+        self.release.set()
+        self.dispatcher.join()
+        # Terminado o primeiro, o usuário pode tocar de novo
+        self.assertIsNotNone(checkout(make_update(1), self.context))
+        self.dispatcher.join()
+        self.assertEqual(self.calls.count(("checkout", 1)), 2)
+
+    def test_falha_libera_o_usuario(self):
+        def failing(update, context):
+            raise RuntimeError("Mercado Pago fora do ar")
+
+        checkout = self.pool.wrap(failing)
+        checkout(make_update(1), self.context)
+        self.dispatcher.join()
+        update = make_update(1)
+        self.assertIsNotNone(checkout(update, self.context))
+        self.dispatcher.join()
+        self.assertEqual(update.callback_query.answers, [])
+        self.assertEqual(len(self.dispatcher.errors), 2)
+        stats = self.pool.snapshot()
+        self.assertEqual((stats['enviados'], stats['concluidos'], stats['falhas'], stats['recusados']), (2, 2, 2, 0))
+
+    def test_contadores_do_snapshot(self):
+        checkout = self.pool.wrap(self.blocking("checkout"))
+        for user_id in (1, 2):
+            checkout(make_update(user_id), self.context)
+        for _ in range(2):
+            self.assertTrue(self.started.acquire(timeout=5))
+        checkout(make_update(1), self.context)
+
+        stats = self.pool.snapshot()
+        self.assertEqual((stats['ocupados'], stats['na_fila'], stats['saturacao']), (2, 0, 1.0))
+        self.assertEqual((stats['enviados'], stats['recusados']), (2, 1))
+        self.assertEqual(stats['saturados'], 1)
+
+        self.release.set()
+        self.dispatcher.join()
+        stats = self.pool.snapshot(reset=True)
+        self.assertEqual((stats['ocupados'], stats['concluidos'], stats['falhas'], stats['ocupados_max']),
+                         (0, 2, 0, 2))
+        # O reset zera só a janela; os totais continuam
+        stats = self.pool.snapshot()
+        self.assertEqual((stats['ocupados_max'], stats['saturados'], stats['enviados']), (0, 0, 2))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Testes do journal do DataStore: queda antes do snapshot, rotação e linha truncada"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import CartItem, DataStore
+
+def kill(store):
+    """Simula a queda do processo: nada do que está só em memória é gravado"""
+    with store._writer_cond:
+        store._stop = True
+        store._writer_cond.notify_all()
+    store._writer.join()
+    store._journal_handle.close()
+    store.orders.close()
+    store._process_lock.close()
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def open_store(self, **kwargs):
+        # snapshot_every alto: tudo fica só no journal até o close
+        return DataStore(self.data_dir, journal=True, snapshot_every=10000, **kwargs)
+
+    def journal_lines(self, name="journal.log"):
+        with open(os.path.join(self.data_dir, name), encoding='utf-8') as f:
+            return f.read().splitlines()
+
+class JournalReplayTest(JournalTestCase):
+    def test_queda_antes_do_snapshot(self):
+        store = self.open_store()
+        store.save_user(1, "Ana", "11999990000")
+        paid = store.create_order(1, [CartItem("Netflix", 19.9)], payment_id=123)
+        cancelled = store.create_order(1, [CartItem("Spotify", 9.9)])
+        store.update_order_status(paid.id, "pago")
+        store.update_order_status(paid.id, "entregue")
+        store.transition_order_status(cancelled.id, "cancelado", ("pendente",))
+        kill(store)
+
+        # Só o journal chegou ao disco
+        self.assertEqual(len(self.journal_lines()), 6)
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, "users.json")))
+
+        store = self.open_store()
+        try:
+            self.assertEqual(store.get_user(1).nome, "Ana")
+            self.assertEqual(store.get_order(paid.id).status, "entregue")
+            self.assertEqual(store.get_order(cancelled.id).status, "cancelado")
+            self.assertEqual(store.get_order_by_payment(123).id, paid.id)
+            self.assertEqual([order.id for order in store.get_user_orders(1)], [paid.id, cancelled.id])
+            self.assertEqual(store.list_orders_by_status("pendente", "pago"), [])
+        finally:
+            store.close()
+
+        # close grava o snapshot e descarta o journal
+        self.assertEqual(self.journal_lines(), [])
+        store = DataStore(self.data_dir)
+        try:
+            self.assertEqual(store.get_order(paid.id).status, "entregue")
+        finally:
+            store.close()
+
+    def test_replay_de_journal_rotacionado_mantem_a_ordem(self):
+        store = self.open_store()
+        order = store.create_order(1, [CartItem("Netflix", 19.9)])
+        store.update_order_status(order.id, "pago", payment_id=555)
+        # Snapshot interrompido logo após a rotação
+        with store._lock:
+            store._rotate_journal()
+        store.update_order_status(order.id, "entregue")
+        late = store.create_order(2, [CartItem("Spotify", 9.9)])
+        kill(store)
+
+        self.assertEqual(len(self.journal_lines("journal.log.1")), 2)
+        self.assertEqual(len(self.journal_lines()), 2)
+
+        store = self.open_store()
+        try:
+            # journal.log.1 é reaplicado antes de journal.log
+            self.assertEqual(store.get_order(order.id).status, "entregue")
+            self.assertEqual(store.get_order_by_payment(555).id, order.id)
+            self.assertEqual(store.get_order(late.id).user_id, 2)
+            self.assertEqual(store.list_orders_by_status("entregue")[0].id, order.id)
+        finally:
+            store.close()
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, "journal.log.1")))
+
+    def test_linha_final_truncada_e_ignorada(self):
+        store = self.open_store()
+        order = store.create_order(1, [CartItem("Netflix", 19.9)])
+        kill(store)
+        with open(os.path.join(self.data_dir, "journal.log"), 'a', encoding='utf-8') as f:
+            f.write('{"op":"status","id":"%s","sta' % order.id)
+
+        store = self.open_store()
+        self.assertEqual(store._journal_records, 1)
+        self.assertEqual(store.get_order(order.id).status, "pendente")
+        # O registro seguinte não pode ser colado na linha incompleta
+        store.update_order_status(order.id, "pago")
+        kill(store)
+
+        store = self.open_store()
+        try:
+            self.assertEqual(store.get_order(order.id).status, "pago")
+        finally:
+            store.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Testes da migração dos arquivos de dados para o SQLite"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from migration import JsonToSqliteMigrator
+from sqlite_store import SQLiteDataStore
+from storage import CartItem, DataStore
+
+class Interrupted(Exception):
+    pass
+
+class MigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp, "data")
+        self.db_path = os.path.join(self.tmp, "bot.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def populate(self, orders=30, **kwargs):
+        store = DataStore(self.data_dir, **kwargs)
+        for user_id in range(1, 4):
+            store.save_user(user_id, f"Cliente {user_id}", f"1199999000{user_id}")
+        created = [store.create_order(1 + i % 3, [CartItem("Netflix", 19.9), CartItem(f"Extra {i}", float(i))])
+                   for i in range(orders)]
+        return store, created
+
+    def query(self, sql, params=()):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+class MigrationTest(MigrationTestCase):
+    def test_retoma_depois_de_interrompida(self):
+        store, created = self.populate()
+        store.close()
+
+        calls = []
+
+        def progress(phase, count):
+            calls.append((phase, count))
+            if phase == "orders" and count >= 10:
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            JsonToSqliteMigrator(self.data_dir, self.db_path, batch_size=5, progress=progress).run()
+        # Os lotes já gravados ficaram no banco junto com o checkpoint
+        self.assertEqual(self.query("SELECT COUNT(*) FROM orders"), [(10,)])
+
+        migrator = JsonToSqliteMigrator(self.data_dir, self.db_path, batch_size=5)
+        counts = migrator.run()
+        # Só o que faltava foi lido de novo
+        self.assertEqual(counts["orders"], 20)
+        self.assertEqual(migrator.verify(), [])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM order_items"), [(60,)])
+
+    def test_versoes_repetidas_nao_duplicam_itens(self):
+        store, created = self.populate(orders=6)
+        store.close()
+        # Cada reabertura acrescenta novas versões dos pedidos a orders.jsonl
+        for status in ("pago", "entregue"):
+            store = DataStore(self.data_dir)
+            for order in created[:4]:
+                store.update_order_status(order.id, status)
+            store.close()
+        with open(os.path.join(self.data_dir, "orders.jsonl"), encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 14)
+
+        # Lotes pequenos: versões do mesmo pedido caem em lotes diferentes
+        migrator = JsonToSqliteMigrator(self.data_dir, self.db_path, batch_size=3)
+        counts = migrator.run()
+        self.assertEqual(counts["orders"], 6)
+        self.assertEqual(migrator.verify(), [])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM order_items"), [(12,)])
+        self.assertEqual(self.query("SELECT order_id, position, COUNT(*) FROM order_items "
+                                    "GROUP BY order_id, position HAVING COUNT(*) > 1"), [])
+        self.assertEqual(self.query("SELECT status, COUNT(*) FROM orders GROUP BY status ORDER BY status"),
+                         [("entregue", 4), ("pendente", 2)])
+
+    def test_reaplica_o_journal(self):
+        store, created = self.populate(orders=3, journal=True, snapshot_every=10000)
+        store.update_order_status(created[0].id, "pago", payment_id=777)
+        store.update_order_status(created[1].id, "cancelado")
+        # Queda antes do snapshot: os pedidos só existem no journal
+        with store._writer_cond:
+            store._stop = True
+            store._writer_cond.notify_all()
+        store._writer.join()
+        store._journal_handle.close()
+        store.orders.close()
+        store._process_lock.close()
+        self.assertFalse(os.path.getsize(os.path.join(self.data_dir, "orders.jsonl")))
+
+        migrator = JsonToSqliteMigrator(self.data_dir, self.db_path)
+        migrator.run()
+        self.assertEqual(migrator.verify(), [])
+
+        db = SQLiteDataStore(self.db_path)
+        try:
+            self.assertEqual(db.get_user(2).nome, "Cliente 2")
+            self.assertEqual(db.get_order_by_payment(777).id, created[0].id)
+            self.assertEqual(db.get_order(created[0].id).status, "pago")
+            self.assertEqual(db.get_order(created[1].id).status, "cancelado")
+            self.assertEqual(db.get_order(created[2].id).status, "pendente")
+        finally:
+            db.close()
+
+    def test_recusa_banco_com_dados(self):
+        store, _ = self.populate(orders=1)
+        store.close()
+        db = SQLiteDataStore(self.db_path)
+        db.save_user(99, "Já estava aqui", "0")
+        db.close()
+
+        with self.assertRaises(RuntimeError):
+            JsonToSqliteMigrator(self.data_dir, self.db_path).run()
+        self.assertEqual(self.query("SELECT id FROM users"), [(99,)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Testes do LazyOrderMap (orders.jsonl)"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import CartItem, DataStore, LazyOrderMap
+
+class LazyOrderMapTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.data_dir, "orders.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def test_somente_leitura_sem_arquivo_nao_o_cria(self):
+        orders = LazyOrderMap(self.path, read_only=True)
+        self.assertEqual(list(orders.load()), [])
+        self.assertEqual(len(orders), 0)
+        self.assertIsNone(orders.get("qualquer"))
+        self.assertEqual(orders.stale_ids(10), [])
+        orders.close()
+        self.assertFalse(os.path.exists(self.path))
+
+        store = DataStore(self.data_dir, read_only=True)
+        self.assertEqual(store.get_user_orders(1), [])
+        store.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_linha_corrompida_no_meio_nao_perde_as_seguintes(self):
+        store = DataStore(self.data_dir)
+        first = store.create_order(1, [CartItem("Netflix", 19.9)])
+        store.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'{"id": "quebrado", "user\n')
+        store = DataStore(self.data_dir)
+        second = store.create_order(1, [CartItem("Spotify", 9.9)])
+        store.close()
+
+        store = DataStore(self.data_dir, read_only=True)
+        try:
+            self.assertEqual([order.id for order in store.get_user_orders(1)], [first.id, second.id])
+        finally:
+            store.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Testes do Outbox: limites por chat e global, 429 e a volta antecipada"""
+
+import threading
+import time
+import unittest
+
+from outbox import QUEUED, Outbox, OutboxRequest, RetryAfter, as_notification, until_sent
+from webhook import FakeBotApi
+
+try:
+    from telegram import Bot, Message
+except ImportError:
+    Bot = None
+
+class OutboxTestCase(unittest.TestCase):
+    def start_outbox(self, **kwargs):
+        outbox = Outbox(**kwargs).start()
+        self.addCleanup(outbox.close, 5)
+        return outbox
+
+class RateLimitTest(OutboxTestCase):
+    def test_ritmo_por_chat(self):
+        outbox = self.start_outbox(global_rate=1000, chat_rate=20, chat_burst=1)
+        sent = []
+        started = time.monotonic()
+        with until_sent():
+            for i in range(5):
+                outbox.send(1, lambda i=i: sent.append((i, time.monotonic())))
+        # Um token por vez a 20/s: quatro intervalos de 50 ms
+        self.assertGreaterEqual(time.monotonic() - started, 0.19)
+        self.assertEqual([i for i, _ in sent], list(range(5)))
+        gaps = [b - a for (_, a), (_, b) in zip(sent, sent[1:])]
+        self.assertTrue(all(gap >= 0.04 for gap in gaps), gaps)
+
+    def test_limite_global_entre_chats(self):
+        outbox = self.start_outbox(global_rate=10, chat_rate=100, chat_burst=1, senders=4)
+        sent = []
+        threads = [threading.Thread(target=lambda chat_id=chat_id: outbox.send(
+            chat_id, lambda: sent.append(time.monotonic()), can_return_early=False)) for chat_id in range(15)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        # Rajada de 10 e depois 10/s para os outros 5
+        self.assertEqual(len(sent), 15)
+        self.assertGreaterEqual(max(sent) - started, 0.45)
+
+    def test_interativa_passa_na_frente_das_notificacoes(self):
+        outbox = self.start_outbox(global_rate=20, chat_rate=100, chat_burst=1, senders=1, caller_wait=0.05)
+        order = []
+        release = threading.Event()
+        # Segura a única thread de envio enquanto a fila se forma
+        outbox.send(0, release.wait, can_return_early=True)
+        with as_notification():
+            for chat_id in range(1, 6):
+                self.assertIs(outbox.send(chat_id, lambda chat_id=chat_id: order.append(chat_id)), QUEUED)
+        interactive = threading.Thread(target=lambda: outbox.send(99, lambda: order.append(99),
+                                                                  can_return_early=False))
+        interactive.start()
+        deadline = time.monotonic() + 5
+        while outbox.snapshot()['na_fila'] < 7 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+        interactive.join(5)
+        outbox.close(5)
+        self.assertEqual(order[0], 99)
+        self.assertEqual(sorted(order[1:]), [1, 2, 3, 4, 5])
+
+class RetryAfterTest(OutboxTestCase):
+    def test_429_repete_depois_do_retry_after(self):
+        outbox = self.start_outbox(chat_rate=100)
+        attempts = []
+
+        def call():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise RetryAfter(0.2)
+            return "ok"
+
+        self.assertEqual(outbox.send(1, call, can_return_early=False), "ok")
+        self.assertEqual(len(attempts), 2)
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.19)
+        self.assertEqual(outbox.snapshot()['limitados_429'], 1)
+
+    def test_desiste_depois_de_max_retries(self):
+        outbox = self.start_outbox(chat_rate=100, max_retries=2)
+        attempts = []
+
+        def call():
+            attempts.append(1)
+            raise RetryAfter(0.01)
+
+        with self.assertRaises(RetryAfter):
+            outbox.send(1, call, can_return_early=False)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(outbox.snapshot()['desistencias'], 1)
+
+class EarlyReturnTest(OutboxTestCase):
+    def test_chat_bloqueado_volta_sem_esperar(self):
+        outbox = self.start_outbox(chat_rate=100, caller_wait=0.3)
+        sent = []
+        first = []
+
+        def limited():
+            first.append(1)
+            if len(first) == 1:
+                raise RetryAfter(0.6)
+            sent.append("primeira")
+
+        # Volta quando o 429 chega, sem esperar o caller_wait inteiro
+        started = time.monotonic()
+        self.assertIs(outbox.send(1, limited), QUEUED)
+        self.assertLess(time.monotonic() - started, 0.25)
+
+        # O bloqueio passa do caller_wait: a próxima nem espera
+        started = time.monotonic()
+        self.assertIs(outbox.send(1, lambda: sent.append("segunda")), QUEUED)
+        self.assertLess(time.monotonic() - started, 0.1)
+
+        # Ambas saem depois do bloqueio, na ordem
+        outbox.close(5)
+        self.assertEqual(sent, ["primeira", "segunda"])
+
+@unittest.skipIf(Bot is None, "python-telegram-bot não instalado")
+class OutboxRequestTest(OutboxTestCase):
+    def test_bot_devolve_true_enquanto_a_mensagem_esta_na_fila(self):
+        api = FakeBotApi().start()
+        self.addCleanup(api.stop)
+        received = []
+        api.on_send = lambda chat_id, text: received.append(text)
+        outbox = self.start_outbox(chat_rate=5, chat_burst=1, caller_wait=0.1)
+        bot = Bot("123:fake", base_url=api.base_url, request=OutboxRequest(outbox))
+
+        # Com token livre a resposta chega a tempo: a Message de sempre
+        self.assertIsInstance(bot.send_message(5, "primeira"), Message)
+        # Sem token, a segunda só sairia em ~200 ms: True no lugar da Message
+        self.assertIs(bot.send_message(5, "segunda"), True)
+        # until_sent espera e devolve a Message
+        with until_sent():
+            self.assertIsInstance(bot.send_message(5, "terceira"), Message)
+        self.assertEqual(received, ["primeira", "segunda", "terceira"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Testes do redis_store contra o FakeRedisServer (python -m pytest)"""
+
+import threading
+import time
+import unittest
+
+from redis_store import FakeRedisServer, RedisCartStore, RedisClient, RedisPersistence
+from storage import CartItem
+
+try:
+    from telegram.ext import ConversationHandler
+    from telegram.ext.utils.promise import Promise
+except ImportError:
+    Promise = None
+
+class FakeClock:
+    """Relógio do FakeRedisServer: o tempo só anda com ``advance``"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class RedisTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.clock = FakeClock()
+        cls.server = FakeRedisServer(clock=cls.clock).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.client = RedisClient(self.server.url)
+        self.client.execute("FLUSHDB")
+
+    def tearDown(self):
+        self.client.close()
+
+class RedisCartStoreTest(RedisTestCase):
+    def test_preserva_a_ordem_dos_itens(self):
+        carts = RedisCartStore(self.client)
+        names = [f"produto {i}" for i in range(20)]
+        for name in names:
+            carts.add(1, CartItem(name, 10.0))
+        self.assertEqual([item.name for item in carts.get(1)], names)
+
+        carts.replace(1, [CartItem(name, 1.0) for name in reversed(names)])
+        self.assertEqual([item.name for item in carts.get(1)], names[::-1])
+
+    def test_add_devolve_o_carrinho_inteiro(self):
+        carts = RedisCartStore(self.client)
+        carts.add(1, CartItem("a", 1.0, {"plano": "mensal"}))
+        items = carts.add(1, CartItem("b", 2.5))
+        self.assertEqual([(item.name, item.price) for item in items], [("a", 1.0), ("b", 2.5)])
+        self.assertEqual(items[0].details, {"plano": "mensal"})
+
+    def test_carrinho_expira_pelo_ttl(self):
+        carts = RedisCartStore(self.client, ttl=60)
+        carts.add(1, CartItem("a", 1.0))
+        self.clock.advance(40)
+        # A leitura renova o TTL
+        self.assertEqual(len(carts.get(1)), 1)
+        self.clock.advance(40)
+        self.assertEqual(len(carts.get(1)), 1)
+        self.clock.advance(61)
+        self.assertEqual(carts.get(1), [])
+        self.assertEqual(len(carts), 0)
+
+    def test_sem_ttl_o_carrinho_nao_expira(self):
+        carts = RedisCartStore(self.client, ttl=None)
+        carts.add(1, CartItem("a", 1.0))
+        self.assertEqual(self.client.execute("PTTL", carts._key(1)), -1)
+
+    def test_clear_e_replace_vazio_removem_o_carrinho(self):
+        carts = RedisCartStore(self.client)
+        carts.add(1, CartItem("a", 1.0))
+        carts.add(2, CartItem("b", 1.0))
+        carts.clear(1)
+        carts.replace(2, [])
+        self.assertEqual((carts.get(1), carts.get(2)), ([], []))
+
+class TransactionTest(RedisTestCase):
+    def test_multi_exec_e_atomico(self):
+        # Leitores nunca podem ver o carrinho entre o DEL e o HSET do replace
+        carts = RedisCartStore(self.client)
+        carts.replace(1, [CartItem(f"item {i}", 1.0) for i in range(3)])
+        stop = threading.Event()
+        seen = []
+
+        def writer():
+            while not stop.is_set():
+                carts.replace(1, [CartItem(f"item {i}", 1.0) for i in range(3)])
+
+        def reader():
+            # Um número fixo de leituras em vez de um tempo fixo
+            for _ in range(300):
+                seen.append(len(carts.get(1)))
+            stop.set()
+
+        threads = [threading.Thread(target=writer) for _ in range(2)] + [threading.Thread(target=reader)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(seen), 300)
+        self.assertEqual(set(seen), {3})
+
+    def test_transacao_devolve_uma_resposta_por_comando(self):
+        replies = self.client.pipeline([("SET", "a", "1"), ("GET", "a"), ("DEL", "a")], transaction=True)
+        self.assertEqual(replies, ["OK", "1", 1])
+
+    def test_adicoes_concorrentes_nao_se_perdem(self):
+        carts = RedisCartStore(self.client)
+
+        def add(worker):
+            for i in range(25):
+                carts.add(1, CartItem(f"{worker}-{i}", 1.0))
+
+        threads = [threading.Thread(target=add, args=(worker,)) for worker in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(carts.get(1)), 100)
+
+class RedisPersistenceTest(RedisTestCase):
+    def test_user_data_passa_de_uma_replica_para_outra(self):
+        first = RedisPersistence(self.client)
+        second = RedisPersistence(RedisClient(self.server.url))
+        first.update_user_data(1, {"etapa": "telefone", "carrinho": [1, 2]})
+
+        user_data = {"velho": True}
+        second.refresh_user_data(1, user_data)
+        self.assertEqual(user_data, {"etapa": "telefone", "carrinho": [1, 2]})
+
+        # user_data vazio apaga a sessão
+        second.update_user_data(1, {})
+        first.refresh_user_data(1, user_data)
+        self.assertEqual(user_data, {})
+
+    def test_sessao_expira(self):
+        persistence = RedisPersistence(self.client, session_ttl=60)
+        persistence.update_user_data(1, {"etapa": "nome"})
+        self.clock.advance(59)
+        user_data = {}
+        persistence.refresh_user_data(1, user_data)
+        self.assertEqual(user_data, {"etapa": "nome"})
+        self.clock.advance(61)
+        user_data = {}
+        persistence.refresh_user_data(1, user_data)
+        self.assertEqual(user_data, {})
+
+    def test_conversa_passa_de_uma_replica_para_outra(self):
+        first = RedisPersistence(self.client).get_conversations("cadastro")
+        second = RedisPersistence(RedisClient(self.server.url)).get_conversations("cadastro")
+        key = (10, 20)
+
+        first[key] = 2
+        first.persistence.update_conversation("cadastro", key, 2)
+        self.assertEqual(second.get(key), 2)
+        self.assertIn(key, second)
+        # O estado fica só no Redis, não na memória do processo
+        self.assertEqual(dict.__len__(first), 0)
+
+        del second[key]
+        second.persistence.update_conversation("cadastro", key, None)
+        self.assertIsNone(first.get(key))
+        self.assertNotIn(key, first)
+
+    @unittest.skipIf(Promise is None, "python-telegram-bot não instalado")
+    def test_estado_assincrono_vai_para_o_redis_ao_terminar(self):
+        persistence = RedisPersistence(self.client)
+        conversations = persistence.get_conversations("compra")
+        other = RedisPersistence(RedisClient(self.server.url)).get_conversations("compra")
+
+        promise = Promise(lambda: 3, (), {})
+        state = (1, promise)
+        conversations[(1, 1)] = state
+        persistence.update_conversation("compra", (1, 1), state)
+        self.assertIs(conversations.get((1, 1)), state)
+        self.assertIsNone(other.get((1, 1)))
+
+        promise.run()
+        self.assertEqual(other.get((1, 1)), 3)
+        self.assertEqual(dict.__len__(conversations), 0)
+
+        # Sem resultado fica o estado anterior; END encerra a conversa
+        conversations[(2, 2)] = (4, Promise(lambda: None, (), {}))
+        conversations[(3, 3)] = (4, Promise(lambda: ConversationHandler.END, (), {}))
+        for key in ((2, 2), (3, 3)):
+            dict.get(conversations, key)[1].run()
+        self.assertEqual(other.get((2, 2)), 4)
+        self.assertIsNone(other.get((3, 3)))
+        self.assertEqual(dict.__len__(conversations), 0)
+
+if __name__ == "__main__":
+    unittest.main()
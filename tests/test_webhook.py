@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Testes do WebhookServer: segredo, fila cheia e entrega ao dispatcher"""
+
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+from webhook import SECRET_HEADER, WebhookServer
+
+try:
+    import telegram
+except ImportError:
+    telegram = None
+
+class BlockingDispatcher:
+    """Dispatcher que segura cada update até ``release`` ser sinalizado"""
+
+    bot = None
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.busy = threading.Event()
+        self.updates = []
+
+    def process_update(self, update):
+        self.busy.set()
+        self.release.wait(10)
+        self.updates.append(update.update_id)
+
+@unittest.skipIf(telegram is None, "python-telegram-bot não instalado")
+class WebhookServerTest(unittest.TestCase):
+    def start_server(self, **kwargs):
+        self.dispatcher = BlockingDispatcher()
+        server = WebhookServer(self.dispatcher, listen="127.0.0.1", port=0, secret_token="segredo", **kwargs)
+        server.start()
+        self.addCleanup(server.stop, 5)
+        self.addCleanup(self.dispatcher.release.set)
+        return server
+
+    def post(self, server, update_id, secret="segredo", path="/telegram"):
+        headers = {"Content-Type": "application/json"}
+        if secret is not None:
+            headers[SECRET_HEADER] = secret
+        request = urllib.request.Request(f"http://127.0.0.1:{server.port}{path}", method="POST", headers=headers,
+                                         data=json.dumps({'update_id': update_id}).encode())
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_segredo_ausente_ou_errado_e_recusado(self):
+        server = self.start_server()
+        self.assertEqual(self.post(server, 1, secret=None), 403)
+        self.assertEqual(self.post(server, 2, secret="outro"), 403)
+        self.assertEqual(self.post(server, 3, path="/outro"), 404)
+        self.assertEqual(self.post(server, 4), 200)
+        stats = server.snapshot()
+        self.assertEqual((stats['forbidden'], stats['not_found'], stats['received']), (2, 1, 1))
+
+        self.dispatcher.release.set()
+        server.stop(5)
+        # Só o update autenticado chegou ao dispatcher
+        self.assertEqual(self.dispatcher.updates, [4])
+
+    def test_fila_cheia_responde_503(self):
+        server = self.start_server(queue_size=2)
+        self.assertEqual(self.post(server, 1), 200)
+        self.assertTrue(self.dispatcher.busy.wait(5))
+        # Um update preso no dispatcher, dois na fila; o resto é recusado
+        statuses = [self.post(server, update_id) for update_id in range(2, 6)]
+        self.assertEqual(statuses, [200, 200, 503, 503])
+        self.assertEqual(server.snapshot()['queue_full'], 2)
+
+        self.dispatcher.release.set()
+        server.stop(5)
+        # Nada aceito se perde: o Telegram reenvia os recusados
+        self.assertEqual(self.dispatcher.updates, [1, 2, 3])
+
+if __name__ == "__main__":
+    unittest.main()
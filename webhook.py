@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""Recebimento de updates por webhook, alternativa ao long polling
+
+No polling o ``Updater`` dorme ``poll_interval`` entre uma chamada de
+getUpdates e a seguinte, o que soma até esse intervalo à latência de cada
+update, e só uma instância do bot pode chamar getUpdates por vez. Com
+webhook o Telegram entrega cada update num POST assim que ele existe, e
+várias réplicas atrás de um balanceador podem recebê-los (com o estado
+compartilhado no SQLite e no Redis).
+
+- ``WebhookServer``: listener HTTP próprio que confere o caminho e o
+  ``X-Telegram-Bot-Api-Secret-Token``, põe o update numa fila limitada e
+  responde na hora; uma thread entrega a fila ao dispatcher;
+- ``run_webhook``: o equivalente a ``start_webhook`` + ``idle`` do Updater;
+- ``FakeBotApi``: Bot API mínima em processo (getUpdates, setWebhook,
+  sendMessage...) para comparar as latências dos dois modos em benchmark.py.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import signal
+import threading
+import time
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+try:
+    from telegram import Update
+except ImportError:
+    # Só a FakeBotApi é usada sem o python-telegram-bot
+    Update = None
+
+logger = logging.getLogger('bot.webhook')
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Updates do Telegram têm poucos KB
+MAX_BODY_BYTES = 1024 * 1024
+
+def derive_secret_token(bot_token):
+    """Segredo do webhook derivado do token do bot
+
+    Igual em todas as réplicas sem precisar de mais uma variável de ambiente,
+    e não revela o token (o Telegram aceita só [A-Za-z0-9_-], até 256).
+    """
+    return hmac.new(bot_token.encode(), b"webhook-secret-token", hashlib.sha256).hexdigest()
+
+class WebhookServer:
+    """Listener HTTP dos updates do Telegram, com fila limitada até o dispatcher
+
+    Cada POST só é validado (caminho, segredo, JSON) e enfileirado; a
+    resposta sai sem esperar os handlers. Uma única thread tira os updates
+    da fila em ordem e chama ``dispatcher.process_update``, como a thread do
+    dispatcher faz no polling (handlers ``run_async`` seguem para o pool do
+    dispatcher). Com a fila cheia a resposta é 503 e o Telegram reenvia o
+    update mais tarde, em vez de o processo acumular memória.
+
+    Com ``metrics`` (função que devolve um dict), ``GET /metrics`` responde
+    em JSON o ``snapshot`` do listener junto com esse dict.
+
+        server = WebhookServer(updater.dispatcher, port=8443, secret_token=segredo).start()
+    """
+
+    def __init__(self, dispatcher, listen="0.0.0.0", port=8443, path="/telegram", secret_token="",
+                 queue_size=1000, metrics=None):
+        self.dispatcher = dispatcher
+        self.metrics = metrics
+        self.path = path
+        self.secret_token = secret_token.encode()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._last_full_warning = 0.0
+        self._consumer = None
+        self._thread = None
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Conexões persistentes: o Telegram reaproveita a conexão entre updates
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                status = server._receive(self)
+                self.send_response(status)
+                if status == 503:
+                    self.send_header("Retry-After", "1")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                if server.metrics is None or self.path != "/metrics":
+                    self.send_response(405)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = json.dumps({'webhook': server.snapshot(), **server.metrics()}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("%s - " + format, self.address_string(), *args)
+
+        self._server = ThreadingHTTPServer((listen, port), Handler, bind_and_activate=False)
+        self._server.daemon_threads = True
+        self._server.allow_reuse_address = True
+        self._server.server_bind()
+        self._server.server_activate()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._consumer = threading.Thread(target=self._consume, name="webhook-dispatch", daemon=True)
+        self._consumer.start()
+        self._thread = threading.Thread(target=self._server.serve_forever, name="webhook-http", daemon=True)
+        self._thread.start()
+        logger.info(f"Webhook escutando em {self._server.server_address[0]}:{self.port}{self.path}")
+        return self
+
+    def stop(self, timeout=30):
+        """Para de aceitar conexões e processa o que já estava na fila"""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._consumer is not None:
+            # Bloqueia se a fila estiver cheia: o consumidor a esvazia
+            self.queue.put(None)
+            self._consumer.join(timeout)
+            self._consumer = None
+        logger.info(f"Webhook parado: {self.snapshot()}")
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def snapshot(self):
+        """Contadores do listener mais a ocupação atual da fila"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['fila'] = self.queue.qsize()
+        stats['fila_max'] = self.queue.maxsize
+        return stats
+
+    def _receive(self, request):
+        """Valida e enfileira um POST; retorna o status HTTP da resposta"""
+        if request.path != self.path:
+            # O corpo não é lido: a conexão não pode ser reaproveitada
+            request.close_connection = True
+            self._count('not_found')
+            return 404
+        token = request.headers.get(SECRET_HEADER, "").encode()
+        if self.secret_token and not hmac.compare_digest(token, self.secret_token):
+            request.close_connection = True
+            self._count('forbidden')
+            return 403
+        try:
+            length = int(request.headers.get("Content-Length", ""))
+        except ValueError:
+            request.close_connection = True
+            self._count('invalid')
+            return 411
+        if length > MAX_BODY_BYTES:
+            request.close_connection = True
+            self._count('invalid')
+            return 413
+        try:
+            data = json.loads(request.rfile.read(length))
+            if not isinstance(data, dict) or 'update_id' not in data:
+                raise ValueError("sem update_id")
+        except ValueError:
+            self._count('invalid')
+            return 400
+        try:
+            self.queue.put_nowait((time.monotonic(), data))
+        except queue.Full:
+            self._count('queue_full')
+            now = time.monotonic()
+            if now - self._last_full_warning > 60:
+                self._last_full_warning = now
+                logger.warning(f"Fila do webhook cheia ({self.queue.maxsize}); respondendo 503 ao Telegram")
+            return 503
+        self._count('received')
+        return 200
+
+    def _consume(self):
+        bot = self.dispatcher.bot
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            received, data = item
+            # Tempo parado na fila: cresce antes de ela encher
+            waited_ms = int((time.monotonic() - received) * 1000)
+            with self._stats_lock:
+                self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], waited_ms)
+            try:
+                self.dispatcher.process_update(Update.de_json(data, bot))
+                self._count('processed')
+            except Exception as e:
+                # process_update já passa os erros dos handlers ao error handler
+                logger.error(f"Erro ao processar o update {data.get('update_id')}: {e}")
+                self._count('errors')
+
+def run_webhook(updater, server, url, allowed_updates=None,
+                stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT)):
+    """Registra o webhook, bloqueia até um dos ``stop_signals`` e desliga tudo
+
+    Na saída: o listener para de aceitar e esvazia a fila, depois jobs,
+    dispatcher e persistência param como no ``Updater.idle``. O webhook não
+    é removido do Telegram: outras réplicas podem continuar atendendo, e um
+    ``start_polling`` o remove sozinho.
+    """
+    stop = threading.Event()
+    for stop_signal in stop_signals:
+        signal.signal(stop_signal, lambda signum, frame: stop.set())
+
+    server.start()
+    updater.job_queue.start()
+    # Sem drop_pending_updates: com réplicas, um reinício descartaria os
+    # updates que o Telegram ainda não conseguiu entregar às outras
+    updater.bot.set_webhook(url=url, allowed_updates=allowed_updates,
+                            api_kwargs={'secret_token': server.secret_token.decode()} if server.secret_token else None)
+    logger.info(f"Webhook registrado em {url}")
+
+    while not stop.wait(1):
+        pass
+    logger.info("Sinal de parada recebido, encerrando o webhook...")
+    server.stop()
+    # Nada de updater.stop(): o Updater nunca foi iniciado (nem polling nem o
+    # webhook dele), então jobs e dispatcher (o pool run_async) param aqui
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    persistence = updater.dispatcher.persistence
+    if persistence:
+        updater.dispatcher.update_persistence()
+        persistence.flush()
+
+class FakeBotApi:
+    """Bot API em memória para benchmarks, sem rede nem token de verdade
+
+    Atende getMe, getUpdates (long polling), setWebhook, deleteWebhook e
+    sendMessage no formato do Telegram. ``push_update`` simula a mensagem de
+    um cliente: vai para o próximo getUpdates ou, com webhook registrado, é
+    entregue por POST (com o segredo) como o Telegram faria. ``on_send`` é
+    chamado a cada sendMessage do bot.
+
+        api = FakeBotApi().start()
+        updater = Updater("123:fake", base_url=api.base_url)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, on_send=None):
+        self.on_send = on_send or (lambda chat_id, text: None)
+        self._updates = []
+        self._cond = threading.Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._webhook = None  # (url, segredo)
+        self._deliveries = queue.Queue()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", "0") or 0))
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                self._reply(api._call(self.path.rsplit("/", 1)[-1], params))
+
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                self._reply(api._call(path.rsplit("/", 1)[-1], dict(parse_qsl(query))))
+
+            def _reply(self, result):
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler, bind_and_activate=False)
+        self._server.daemon_threads = True
+        self._server.allow_reuse_address = True
+        self._server.server_bind()
+        self._server.server_activate()
+        self._thread = None
+        self._delivery_thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        self._delivery_thread = threading.Thread(target=self._deliver, name="fake-bot-api-webhook", daemon=True)
+        self._delivery_thread.start()
+        return self
+
+    def stop(self):
+        self._deliveries.put(None)
+        self._server.shutdown()
+        self._server.server_close()
+        # Solta os getUpdates que estiverem esperando
+        with self._cond:
+            self._cond.notify_all()
+
+    def push_update(self, chat_id, text):
+        """Simula uma mensagem de texto de ``chat_id`` para o bot"""
+        with self._cond:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            update = {
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id, 'date': int(time.time()), 'text': text,
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': "Cliente"},
+                },
+            }
+            if self._webhook is None:
+                self._updates.append(update)
+                self._cond.notify_all()
+                return
+        self._deliveries.put(update)
+
+    def _deliver(self):
+        """Entrega por POST, em ordem, como o Telegram faz para um mesmo bot"""
+        while True:
+            update = self._deliveries.get()
+            if update is None:
+                return
+            url, secret = self._webhook
+            request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST",
+                                             headers={"Content-Type": "application/json", SECRET_HEADER: secret})
+            try:
+                urllib.request.urlopen(request, timeout=10).close()
+            except OSError as e:
+                logger.warning(f"FakeBotApi: entrega do update {update['update_id']} falhou: {e}")
+
+    def _call(self, method, params):
+        if method == "getMe":
+            return {'id': 1, 'is_bot': True, 'first_name': "Bot", 'username': "fake_bot"}
+        if method == "getUpdates":
+            return self._get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        if method == "setWebhook":
+            self._webhook = (params['url'], params.get('secret_token', ""))
+            return True
+        if method == "deleteWebhook":
+            self._webhook = None
+            return True
+        if method == "sendMessage":
+            chat_id = int(params['chat_id'])
+            self.on_send(chat_id, params.get('text', ""))
+            with self._cond:
+                message_id = self._next_message_id
+                self._next_message_id += 1
+            return {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ""),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': 1, 'is_bot': True, 'first_name': "Bot"}}
+        return True
+
+    def _get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Confirmados pelo offset saem da fila
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._server_alive():
+                    break
+                self._cond.wait(remaining)
+            return list(self._updates)
+
+    def _server_alive(self):
+        return self._thread is not None and self._thread.is_alive()